@@ -0,0 +1,90 @@
+import logging
+import logging.handlers
+import queue
+import random
+import time
+
+access_logger = logging.getLogger('access')
+DEBUG_SAMPLE_RATE = 0.0  # Fraction of requests that get per-request debug logging
+listener = None
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted, so message formatting happens on the listener thread.
+
+    Safe here because every record is logged with immutable arguments and the
+    queue never leaves the process.
+    """
+    def prepare(self, record):
+        return record
+
+def start(debug_sample_rate=0.0):
+    """Moves the root logger's handlers behind a queue drained by a background thread."""
+    global listener, DEBUG_SAMPLE_RATE
+    DEBUG_SAMPLE_RATE = debug_sample_rate
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    log_queue = queue.SimpleQueue()
+    root.addHandler(DeferredQueueHandler(log_queue))
+    if debug_sample_rate > 0:
+        root.setLevel(logging.DEBUG)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+def stop():
+    """Flushes queued records and stops the background writer."""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+def _skip(msg, *args):
+    pass
+
+def request_debug_log():
+    """Returns the function to use for one request's debug detail.
+
+    A sampled request gets logging.debug; every other request gets a no-op,
+    so its debug calls cost only the call itself.
+    """
+    if DEBUG_SAMPLE_RATE > 0 and random.random() < DEBUG_SAMPLE_RATE:
+        return logging.debug
+    return _skip
+
+class AccessRecord:
+    """One request's access log entry, written once its response has been sent.
+
+    first_byte() is called just before the response starts going out and
+    finish() once it is done; both times are also recorded in `metrics` if given.
+    A timing.RequestTimer given as `timer` gets its 'send' phase and is finished too.
+    """
+    __slots__ = ('client_address', 'method', 'path', 'status', 'nbytes', 'start', 'first_byte_at', 'metrics', 'timer')
+
+    def __init__(self, client_address, method, path, status, nbytes, start, metrics=None, timer=None):
+        self.client_address = client_address
+        self.method = method
+        self.path = path
+        self.status = status
+        self.nbytes = nbytes
+        self.start = start
+        self.first_byte_at = None
+        self.metrics = metrics
+        self.timer = timer
+
+    def first_byte(self):
+        self.first_byte_at = time.perf_counter()
+
+    def finish(self):
+        now = time.perf_counter()
+        duration = now - self.start
+        if self.metrics is not None:
+            ttfb = (self.first_byte_at or now) - self.start
+            self.metrics.record_request(self.status, self.nbytes, ttfb, duration)
+        if self.timer is not None:
+            self.timer.mark('send')
+            self.timer.label(self.method, self.path)
+            self.timer.finish(self.status, self.nbytes)
+        access_logger.info('client=%s method=%s path=%s status=%d bytes=%d duration_ms=%.3f',
+                           self.client_address[0], self.method, self.path, self.status, self.nbytes, duration * 1000)
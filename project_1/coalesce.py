@@ -0,0 +1,189 @@
+import asyncio
+import threading
+from http_stream import header_value, response_body_length
+
+class InFlightResponse:
+    """An origin response being fetched for one request, shared with identical requests that arrive meanwhile.
+
+    The leader (the request that fetches) publishes the status line and
+    headers with start(), every piece of the body as it relays it, chunk
+    framing included, with append(), and finish() at the end. The pieces go
+    into one list that grows as they arrive; each follower walks it from
+    its own position and sends the very same bytes objects, so followers
+    cost no copy of the body each. A leader that cannot share its response
+    (it is not cacheable, or the fetch failed) calls abandon() instead, and
+    its followers fetch for themselves.
+
+    With max_size set, a body without a Content-Length is not handed out
+    as it arrives: followers wait until it is all in, and if it grows past
+    max_size first it is dropped and they fetch for themselves, so no more
+    than max_size bytes are ever held.
+    """
+    def __init__(self, request_headers, max_size=None):
+        self.request_headers = request_headers  # The leader's, to check a Vary header against
+        self.max_size = max_size
+        self.status = None
+        self.reason = None
+        self.headers = None
+        self.shared = None  # Whether followers can use the response; None until the leader knows
+        self.entry = None  # Set instead of a body when the leader revalidated a cached entry
+        self.chunks = []
+        self.size = 0
+        self.done = False
+        self.complete = False  # Whether the body ended where its framing said
+        self.changed = threading.Condition()
+
+    def _notify(self):
+        self.changed.notify_all()
+
+    def start(self, status, reason, headers):
+        with self.changed:
+            self.status, self.reason, self.headers = status, reason, headers
+            # Only a body of known length can be streamed to followers; otherwise they wait for finish()
+            if self.max_size is None or isinstance(response_body_length('GET', status, headers), int):
+                self.shared = True
+                self._notify()
+
+    def append(self, data):
+        with self.changed:
+            if self.shared is False:
+                return
+            self.size += len(data)
+            if self.shared is None and self.size > self.max_size:
+                self.chunks = []
+                self.shared = False
+                self._notify()
+                return
+            self.chunks.append(data)
+            if self.shared:
+                self._notify()
+
+    def finish(self, complete):
+        with self.changed:
+            self.complete = complete
+            if self.shared is None:
+                self.shared = complete
+            self.done = True
+            self._notify()
+
+    def serve_entry(self, entry):
+        """Shares a cache entry the leader revalidated with the origin instead of a response body."""
+        with self.changed:
+            self.entry = entry
+            self.shared = True
+            self.complete = True
+            self.done = True
+            self._notify()
+
+    def abandon(self):
+        """Ends the fetch; followers still waiting for the headers will fetch for themselves. No-op once finished."""
+        with self.changed:
+            if self.done:
+                return
+            if self.shared is None:
+                self.shared = False
+            self.done = True
+            self._notify()
+
+    def matches(self, request_headers):
+        """Whether another request selects the same response, as far as the response's Vary header says."""
+        if self.entry is not None:
+            return self.entry.matches(request_headers)
+        for name in (header_value(self.headers, 'vary') or '').split(','):
+            name = name.strip().lower()
+            if name and request_headers.get(name) != self.request_headers.get(name):
+                return False
+        return True
+
+    def wait_started(self):
+        """Blocks until the leader knows whether the response can be shared; returns whether it can."""
+        with self.changed:
+            while self.shared is None:
+                self.changed.wait()
+            return self.shared
+
+    def pieces(self):
+        """Yields every piece of the body, waiting for more until the leader is done."""
+        index = 0
+        while True:
+            with self.changed:
+                while index == len(self.chunks) and not self.done:
+                    self.changed.wait()
+                new = self.chunks[index:]
+            if not new:
+                return
+            index += len(new)
+            yield from new
+
+class AsyncInFlightResponse(InFlightResponse):
+    """InFlightResponse whose followers are tasks on the leader's event loop and wait on an asyncio.Event."""
+    def __init__(self, request_headers, max_size=None):
+        super().__init__(request_headers, max_size)
+        self.event = asyncio.Event()
+
+    def _notify(self):
+        # Wake everyone waiting on the current event; later waits use a fresh one
+        self.event.set()
+        self.event = asyncio.Event()
+
+    async def wait_started_async(self):
+        while self.shared is None:
+            await self.event.wait()
+        return self.shared
+
+    async def pieces_async(self):
+        index = 0
+        while True:
+            while index == len(self.chunks) and not self.done:
+                await self.event.wait()
+            if index == len(self.chunks):
+                return
+            yield self.chunks[index]
+            index += 1
+
+class Coalescer:
+    """In-flight origin fetches by URL, so concurrent identical requests share one.
+
+    The first request for a URL leads a new fetch; requests for it that
+    arrive before the leader calls leave() follow that fetch instead of
+    starting their own. max_size caps the body each fetch holds for its
+    followers; see InFlightResponse.
+    """
+    def __init__(self, in_flight_class=InFlightResponse, max_size=None):
+        self.in_flight_class = in_flight_class
+        self.max_size = max_size
+        self.fetches = {}  # URL -> InFlightResponse
+        self.leaders = 0
+        self.followers = 0
+        self.fallbacks = 0  # Followers that found the response unshareable and fetched for themselves
+        self.lock = threading.Lock()
+
+    def join(self, url, request_headers):
+        """Returns (in-flight response for url, whether the caller leads it and must fetch it)."""
+        with self.lock:
+            in_flight = self.fetches.get(url)
+            if in_flight is not None:
+                self.followers += 1
+                return in_flight, False
+            in_flight = self.fetches[url] = self.in_flight_class(request_headers, self.max_size)
+            self.leaders += 1
+            return in_flight, True
+
+    def leave(self, url, in_flight):
+        """Called by the leader once the response is stored; later requests no longer join it."""
+        with self.lock:
+            if self.fetches.get(url) is in_flight:
+                del self.fetches[url]
+
+    def fallback(self):
+        with self.lock:
+            self.fallbacks += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': len(self.fetches),
+                'leaders': self.leaders,
+                'followers': self.followers,
+                'fallbacks': self.fallbacks,
+            }
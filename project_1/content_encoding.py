@@ -0,0 +1,169 @@
+import os
+import gzip
+import zlib
+import threading
+from collections import OrderedDict
+
+# Content types worth compressing; everything else is sent as-is
+COMPRESSIBLE_TYPES = {
+    'application/javascript', 'application/json', 'application/xml',
+    'application/xhtml+xml', 'image/svg+xml', 'text/javascript',
+}
+MIN_COMPRESS_SIZE = 256  # Smaller bodies don't shrink enough to be worth it
+SUPPORTED_ENCODINGS = ('gzip', 'deflate')  # In order of preference
+
+def is_compressible(content_type):
+    return content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES
+
+def negotiate(accept_encoding):
+    """Picks gzip or deflate from an Accept-Encoding header, or None for identity."""
+    if not accept_encoding:
+        return None
+    qvalues = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qvalues[coding.strip().lower()] = q
+
+    best, best_q = None, 0.0
+    for coding in SUPPORTED_ENCODINGS:
+        q = qvalues.get(coding, qvalues.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+class Variant:
+    """A content-coded representation of one version of a cached file.
+
+    It exposes the same fields the server reads from a CacheEntry, so either
+    can be answered the same way. The body is in memory, or for a large `.gz`
+    sibling on disk at `path`.
+    """
+    __slots__ = ('path', 'size', 'body', 'etag', 'last_modified', 'file_time',
+                 'content_type', 'encoding', 'ok_prefix', 'not_modified_prefix')
+
+    def __init__(self, entry, encoding, body, path=None, size=None):
+        self.path = path
+        self.body = body
+        self.size = len(body) if body is not None else size
+        # A strong ETag must differ between encodings of the same file
+        self.etag = f'{entry.etag[:-1]}-{encoding}"'
+        self.last_modified = entry.last_modified
+        self.file_time = entry.file_time
+        self.content_type = entry.content_type
+        self.encoding = encoding
+        self.ok_prefix = (
+            'HTTP/1.1 200 OK\r\n'
+            f'Content-Type: {self.content_type}\r\n'
+            f'Content-Encoding: {encoding}\r\n'
+            f'Content-Length: {self.size}\r\n'
+            f'Last-Modified: {self.last_modified}\r\n'
+            f'ETag: {self.etag}\r\n'
+            'Vary: Accept-Encoding\r\n'
+        ).encode()
+        self.not_modified_prefix = (
+            'HTTP/1.1 304 Not Modified\r\n'
+            f'Last-Modified: {self.last_modified}\r\n'
+            f'ETag: {self.etag}\r\n'
+            'Vary: Accept-Encoding\r\n'
+        ).encode()
+
+class VariantCache:
+    """Bounded LRU cache of compressed variants, built once per file version.
+
+    Keyed by (path, encoding) and tied to the source entry's st_mtime_ns and
+    st_size, so a changed file gets a fresh variant. A fresh `.gz` sibling is
+    used for gzip instead of compressing; its own st_mtime_ns and st_size are
+    checked too, so a replaced sibling is picked up. Files that don't shrink are
+    remembered too, so they aren't recompressed on every request.
+    """
+    def __init__(self, max_bytes=16 * 1024 * 1024, max_entries=4096):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (path, encoding) -> ((mtime_ns, size, sibling stamp), Variant or None)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, entry, encoding):
+        """Returns the Variant of entry for encoding, or None to send the identity body."""
+        key = (entry.path, encoding)
+        sibling_st = self._sibling_stat(entry) if encoding == 'gzip' else None
+        version = (entry.mtime_ns, entry.size,
+                   (sibling_st.st_mtime_ns, sibling_st.st_size) if sibling_st is not None else None)
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None and cached[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        variant = self._build(entry, encoding, sibling_st)
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None and old[1] is not None and old[1].body is not None:
+                self.current_bytes -= len(old[1].body)
+            self.entries[key] = (version, variant)
+            if variant is not None and variant.body is not None:
+                self.current_bytes += len(variant.body)
+            self._evict()
+        return variant
+
+    def _sibling_stat(self, entry):
+        try:
+            return os.stat(entry.path + '.gz')
+        except OSError:
+            return None
+
+    def _build(self, entry, encoding, st=None):
+        if encoding == 'gzip':
+            # Prefer a precompressed sibling that is at least as new as the file
+            sibling = entry.path + '.gz'
+            if st is not None and st.st_mtime_ns >= entry.mtime_ns:
+                if entry.body is None:
+                    # Large file: send the sibling from disk like the original would be
+                    return Variant(entry, encoding, None, path=sibling, size=st.st_size)
+                if st.st_size < len(entry.body):
+                    with open(sibling, 'rb') as f:
+                        return Variant(entry, encoding, f.read())
+
+        # Only bodies already held by the file cache are compressed on the fly
+        if entry.body is None or len(entry.body) < MIN_COMPRESS_SIZE:
+            return None
+        if encoding == 'gzip':
+            body = gzip.compress(entry.body, compresslevel=9, mtime=0)
+        else:
+            body = zlib.compress(entry.body, 9)
+        if len(body) >= len(entry.body):
+            return None
+        return Variant(entry, encoding, body)
+
+    def _evict(self):
+        # Called with the lock held; drops least recently used variants until within budget
+        while self.entries and (self.current_bytes > self.max_bytes or len(self.entries) > self.max_entries):
+            _, (_, old) = self.entries.popitem(last=False)
+            if old is not None and old.body is not None:
+                self.current_bytes -= len(old.body)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,142 @@
+import os
+import stat
+import datetime
+import mimetypes
+import threading
+from collections import OrderedDict
+import timing
+from content_encoding import is_compressible
+
+def format_http_date(timestamp):
+    """Formats a timestamp into an HTTP-date string."""
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc).strftime('%a, %d %b %Y %H:%M:%S GMT')
+
+class CacheEntry:
+    """Everything needed to answer a GET for one version of a file.
+
+    `body` holds the file bytes for files small enough to cache; larger files
+    keep only their metadata and precomputed headers and are sent from disk.
+    """
+    __slots__ = ('path', 'mtime_ns', 'size', 'file_time', 'last_modified', 'etag',
+                 'content_type', 'compressible', 'body', 'ok_prefix', 'not_modified_prefix')
+
+    def __init__(self, path, st, body):
+        self.path = path
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+        self.file_time = datetime.datetime.fromtimestamp(st.st_mtime, tz=datetime.timezone.utc)
+        self.last_modified = format_http_date(st.st_mtime)
+        self.etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        self.body = body
+
+        # Determine Content-Type based on file extension using mimetypes
+        content_type, _ = mimetypes.guess_type(path)
+        self.content_type = content_type or 'application/octet-stream'
+        self.compressible = is_compressible(self.content_type)
+        vary = 'Vary: Accept-Encoding\r\n' if self.compressible else ''
+
+        # Header blocks up to (not including) the Connection header and the blank line
+        self.ok_prefix = (
+            'HTTP/1.1 200 OK\r\n'
+            f'Content-Type: {self.content_type}\r\n'
+            f'Content-Length: {self.size}\r\n'
+            f'Last-Modified: {self.last_modified}\r\n'
+            f'ETag: {self.etag}\r\n'
+            'Accept-Ranges: bytes\r\n'
+            + vary
+        ).encode()
+        self.not_modified_prefix = (
+            'HTTP/1.1 304 Not Modified\r\n'
+            f'Last-Modified: {self.last_modified}\r\n'
+            f'ETag: {self.etag}\r\n'
+            + vary
+        ).encode()
+
+    def is_current(self, st):
+        return st.st_mtime_ns == self.mtime_ns and st.st_size == self.size
+
+class FileCache:
+    """LRU cache of static files with a byte budget for cached bodies.
+
+    Entries are keyed by absolute path and revalidated against st_mtime_ns and
+    st_size on every lookup, so a changed file is never served stale; a hit
+    costs one stat() and no reads.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_file_size=1024 * 1024, max_entries=4096):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, filepath):
+        """Returns the CacheEntry for filepath, or None if it is not a regular file."""
+        key = os.path.abspath(filepath)
+        try:
+            st = os.stat(key)
+        except OSError:
+            self._discard(key)
+            return None
+        finally:
+            timing.mark('stat')
+        if not stat.S_ISREG(st.st_mode):
+            self._discard(key)
+            return None
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.is_current(st):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        body = None
+        if st.st_size <= self.max_file_size and st.st_size <= self.max_bytes:
+            with open(key, 'rb') as f:
+                body = f.read()
+            timing.mark('read')
+            if len(body) != st.st_size:
+                # The file changed while it was being read; serve it uncached from disk
+                body = None
+        entry = CacheEntry(key, st, body)
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None and old.body is not None:
+                self.current_bytes -= len(old.body)
+            self.entries[key] = entry
+            if body is not None:
+                self.current_bytes += len(body)
+            self._evict()
+        return entry
+
+    def _discard(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None and old.body is not None:
+                self.current_bytes -= len(old.body)
+
+    def _evict(self):
+        # Called with the lock held; drops least recently used entries until within budget
+        while self.entries and (self.current_bytes > self.max_bytes or len(self.entries) > self.max_entries):
+            _, old = self.entries.popitem(last=False)
+            if old.body is not None:
+                self.current_bytes -= len(old.body)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
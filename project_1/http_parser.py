@@ -0,0 +1,177 @@
+MAX_HEADER_SIZE = 8192  # Request line plus headers, including the blank line
+MAX_BODY_SIZE = 1024 * 1024
+
+class HTTPParseError(Exception):
+    """Raised when the buffered bytes can't be parsed as a request.
+
+    `status` is the response status line to send before closing the connection.
+    """
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+class HTTPRequest:
+    """One parsed request. Header names are lower-cased; repeated headers are joined with ', '."""
+    __slots__ = ('method', 'path', 'version', 'headers', 'head', 'body')
+
+    def __init__(self, method, path, version, headers, head, body=b''):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.head = head
+        self.body = body
+
+    def keep_alive(self):
+        """Whether the client wants the connection kept open after this request."""
+        connection_header = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            # HTTP/1.1 defaults to keep-alive unless specified otherwise
+            return connection_header != 'close'
+        # HTTP/1.0 defaults to close unless keep-alive is specified
+        return connection_header == 'keep-alive'
+
+class HTTPRequestParser:
+    """Per-connection request parser.
+
+    Call feed() with each chunk received, then iterate over the parser to get
+    every complete request buffered so far. Iteration raises HTTPParseError
+    at the first request that can't be parsed, after yielding the ones before it.
+    """
+    def __init__(self, max_header_size=MAX_HEADER_SIZE, max_body_size=MAX_BODY_SIZE):
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.buffer = bytearray()
+        self.pos = 0  # Start of the first unparsed request in buffer
+        self.scan_from = 0  # Where to resume searching for the end of the header block
+
+    def feed(self, data):
+        if self.pos:
+            # Drop requests already handed out before growing the buffer
+            del self.buffer[:self.pos]
+            self.scan_from = max(self.scan_from - self.pos, 0)
+            self.pos = 0
+        self.buffer += data
+
+    def __iter__(self):
+        while True:
+            request = self.next_request()
+            if request is None:
+                return
+            yield request
+
+    def pending(self):
+        """Number of buffered bytes that don't form a complete request yet."""
+        return len(self.buffer) - self.pos
+
+    def next_request(self):
+        """Returns the next complete request, or None if more bytes are needed."""
+        buffer = self.buffer
+        # Tolerate stray CRLFs between pipelined requests
+        while buffer.startswith(b'\r\n', self.pos):
+            self.pos += 2
+        if self.pos >= len(buffer):
+            return None
+
+        head_end = buffer.find(b'\r\n\r\n', max(self.scan_from, self.pos))
+        if head_end == -1:
+            if len(buffer) - self.pos > self.max_header_size:
+                raise HTTPParseError('431 Request Header Fields Too Large', "Request header block too large")
+            # Resume the search just before the end on the next feed, in case the terminator is split
+            self.scan_from = max(len(buffer) - 3, self.pos)
+            return None
+        if head_end + 4 - self.pos > self.max_header_size:
+            raise HTTPParseError('431 Request Header Fields Too Large', "Request header block too large")
+
+        # Only the header block of this request is decoded, never the whole buffer
+        head = buffer[self.pos:head_end].decode('latin-1')
+        lines = head.split('\r\n')
+        parts = lines[0].split()
+        if len(parts) != 3:
+            raise HTTPParseError('400 Bad Request', f"Malformed request line: {lines[0]}")
+        method, path, version = parts
+
+        headers = {}
+        for line in lines[1:]:
+            if ':' not in line:
+                raise HTTPParseError('400 Bad Request', f"Malformed header line: {line}")
+            header_key, header_value = line.split(':', 1)
+            header_key = header_key.strip().lower()
+            header_value = header_value.strip()
+            if header_key in headers:
+                headers[header_key] += ', ' + header_value
+            else:
+                headers[header_key] = header_value
+
+        if 'transfer-encoding' in headers:
+            raise HTTPParseError('501 Not Implemented', "Chunked request bodies are not supported")
+        body_length = 0
+        if 'content-length' in headers:
+            try:
+                body_length = int(headers['content-length'])
+            except ValueError:
+                raise HTTPParseError('400 Bad Request', f"Invalid Content-Length: {headers['content-length']}")
+            if body_length < 0:
+                raise HTTPParseError('400 Bad Request', f"Invalid Content-Length: {body_length}")
+            if body_length > self.max_body_size:
+                raise HTTPParseError('413 Payload Too Large', f"Request body of {body_length} bytes is too large")
+
+        body_start = head_end + 4
+        if len(buffer) - body_start < body_length:
+            self.scan_from = head_end  # The header block is complete; wait for the body
+            return None
+        body = bytes(buffer[body_start:body_start + body_length])
+        self.pos = body_start + body_length
+        self.scan_from = self.pos
+        return HTTPRequest(method, path, version, headers, head, body)
+
+MAX_RANGES = 16  # More ranges than this in one request are ignored and the full entity is sent
+
+def parse_byte_ranges(value, size):
+    """Parses a Range header against an entity of `size` bytes.
+
+    Returns a sorted list of (start, end) inclusive offsets with overlapping
+    and adjacent ranges merged, an empty list when no range is satisfiable
+    (answer 416), or None when the header should be ignored (answer 200).
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+    specs = spec.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for item in specs:
+        first, dash, last = item.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if first == '':
+                # Suffix range: the last N bytes
+                length = int(last)
+                if length < 0:
+                    return None
+                if length == 0 or size == 0:
+                    continue
+                ranges.append((max(size - length, 0), size - 1))
+                continue
+            start = int(first)
+            end = int(last) if last != '' else size - 1
+        except ValueError:
+            return None
+        if start < 0 or (last != '' and end < start):
+            return None
+        if start >= size:
+            continue  # Unsatisfiable on its own; the others may still be served
+        ranges.append((start, min(end, size - 1)))
+
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
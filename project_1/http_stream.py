@@ -0,0 +1,293 @@
+import asyncio
+from http_parser import HTTPParseError
+
+MAX_LINE_SIZE = 8192  # Longest chunk-size or trailer line accepted
+HEX_DIGITS = b'0123456789abcdefABCDEF'
+ASYNC_READ_SIZE = 64 * 1024  # Most bytes taken from an asyncio StreamReader at once
+# Headers that describe one connection: never forwarded, stored or replayed
+HOP_BY_HOP = {'connection', 'keep-alive', 'proxy-connection', 'te', 'trailer',
+              'transfer-encoding', 'upgrade', 'proxy-authenticate', 'proxy-authorization'}
+
+class SocketReader:
+    """Buffered reads from a socket into one preallocated bytearray.
+
+    The buffer is allocated once and filled with recv_into(), so relaying a
+    body allocates nothing per read. Views returned by read() point into the
+    buffer and are only valid until the next call. The reader can be moved
+    to another socket with attach() once everything buffered is consumed.
+    """
+    def __init__(self, sock, size=64 * 1024):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # Buffered, unconsumed bytes are buffer[start:end]
+        self.end = 0
+
+    def attach(self, sock):
+        self.sock = sock
+        self.start = self.end = 0
+
+    def pending(self):
+        return self.end - self.start
+
+    def fill(self):
+        """Reads more bytes from the socket into the buffer; returns how many, 0 at EOF."""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            # Move the unconsumed tail to the front to make room
+            n = self.end - self.start
+            self.buffer[:n] = self.view[self.start:self.end]
+            self.start, self.end = 0, n
+            if n == len(self.buffer):
+                raise HTTPParseError('431 Request Header Fields Too Large', "line or header block fills the buffer")
+        n = self.sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def read_until(self, delimiter, limit):
+        """Returns the bytes up to and including delimiter, or None at EOF before any byte.
+
+        Raises HTTPParseError if more than limit bytes arrive without the
+        delimiter, or ConnectionError if the peer closes part way through.
+        """
+        while True:
+            idx = self.buffer.find(delimiter, self.start, self.end)
+            if idx != -1:
+                data = bytes(self.view[self.start:idx + len(delimiter)])
+                self.start = idx + len(delimiter)
+                return data
+            if self.pending() > limit:
+                raise HTTPParseError('431 Request Header Fields Too Large', f"no {delimiter!r} in {limit} bytes")
+            if not self.fill():
+                if self.pending():
+                    raise ConnectionError("connection closed part way through a message")
+                return None
+
+    def read(self, n):
+        """Consumes and returns a view of up to n bytes, reading once if nothing is buffered; empty at EOF."""
+        if self.start == self.end and not self.fill():
+            return self.view[0:0]
+        take = min(n, self.end - self.start)
+        data = self.view[self.start:self.start + take]
+        self.start += take
+        return data
+
+def parse_head(head):
+    """Splits a request or response header block into (first line parts, [(name, value), ...]).
+
+    The first line is split into at most three parts, so a reason phrase
+    with spaces stays whole.
+    """
+    lines = head.decode('iso-8859-1').split('\r\n')
+    first = lines[0].split(' ', 2)
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if sep:
+            headers.append((name.strip(), value.strip()))
+    return first, headers
+
+def parse_response_head(head):
+    """Splits a response header block into (status, reason, [(name, value), ...])."""
+    first, headers = parse_head(head)
+    if len(first) < 2 or not first[0].startswith('HTTP/') or not first[1].isdigit():
+        raise ValueError(f"Bad status line: {' '.join(first)!r}")
+    return int(first[1]), first[2] if len(first) > 2 else '', headers
+
+def header_value(headers, name):
+    """Returns the first value of a header from a list of (name, value) pairs, or None."""
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+def request_body_length(headers):
+    """How a request body is delimited: a byte count or 'chunked'."""
+    transfer_encoding = header_value(headers, 'transfer-encoding')
+    if transfer_encoding is not None:
+        if transfer_encoding.lower() != 'chunked':
+            raise HTTPParseError('501 Not Implemented', f"Transfer-Encoding {transfer_encoding} not supported")
+        return 'chunked'
+    length = header_value(headers, 'content-length')
+    if length is None:
+        return 0
+    if not length.isdigit():
+        raise HTTPParseError('400 Bad Request', "invalid Content-Length")
+    return int(length)
+
+def response_body_length(method, status, headers):
+    """How a response body is delimited: a byte count, 'chunked', or None to read until the sender closes."""
+    if method == 'HEAD' or 100 <= status < 200 or status in (204, 304):
+        return 0
+    transfer_encoding = header_value(headers, 'transfer-encoding')
+    if transfer_encoding is not None:
+        return 'chunked' if transfer_encoding.lower().endswith('chunked') else None
+    length = header_value(headers, 'content-length')
+    if length is not None and length.isdigit():
+        return int(length)
+    return None
+
+def connection_tokens(headers):
+    """Lower-cased options of a Connection header, including any extra hop-by-hop header names."""
+    return {token.strip().lower() for token in (header_value(headers, 'connection') or '').split(',')}
+
+def keep_alive(version, headers):
+    """Whether a message's sender intends to keep the connection open after it."""
+    tokens = connection_tokens(headers)
+    if version == 'HTTP/1.1':
+        return 'close' not in tokens
+    return 'keep-alive' in tokens
+
+def parse_chunk_size(line):
+    """The size from a chunk-size line; only hex digits are accepted before any extension."""
+    digits = line.split(b';', 1)[0].strip()
+    if not digits or digits.strip(HEX_DIGITS):
+        raise HTTPParseError('400 Bad Request', "invalid chunk size")
+    return int(digits, 16)
+
+def relay_body(reader, dest, length, capture_limit=0, tee=None):
+    """Copies one message body from reader to the dest socket, as framed by length.
+
+    length is a byte count, 'chunked' or None (until EOF). Chunked bodies are
+    relayed with their framing intact. dest may be None to only read the
+    body. Returns (bytes sent, whether the body ended where its framing said,
+    the decoded body or None). The body is only kept if capture_limit is set
+    and it fits. tee, if given, is called with a bytes copy of every piece
+    before it is sent, framing included.
+    """
+    sent = 0
+    captured = bytearray() if capture_limit else None
+
+    def send(data, body):
+        nonlocal sent, captured
+        if tee is not None:
+            tee(bytes(data))
+        if dest is not None:
+            dest.sendall(data)
+        sent += len(data)
+        if body and captured is not None:
+            captured += data
+            if len(captured) > capture_limit:
+                captured = None
+
+    def copy(n, body=True):
+        while n:
+            data = reader.read(n)
+            if not data:
+                return False
+            send(data, body)
+            n -= len(data)
+        return True
+
+    if length is None:
+        while True:
+            data = reader.read(len(reader.buffer))
+            if not data:
+                break
+            send(data, True)
+        complete = True
+    elif length == 'chunked':
+        complete = False
+        while True:
+            line = reader.read_until(b'\n', MAX_LINE_SIZE)
+            if line is None:
+                break
+            send(line, False)
+            size = parse_chunk_size(line)
+            if size == 0:
+                # Trailers, if any, then the blank line ending the body
+                while True:
+                    line = reader.read_until(b'\n', MAX_LINE_SIZE)
+                    if line is None:
+                        break
+                    send(line, False)
+                    if not line.strip():
+                        complete = True
+                        break
+                break
+            if not copy(size) or not copy(2, body=False):
+                break
+    else:
+        complete = copy(length)
+
+    return sent, complete, bytes(captured) if complete and captured is not None else None
+
+async def read_line_async(reader):
+    """Reads one line from an asyncio StreamReader, or None at EOF before any byte."""
+    try:
+        return await reader.readuntil(b'\n')
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ConnectionError("connection closed part way through a message")
+        return None
+    except asyncio.LimitOverrunError:
+        raise HTTPParseError('431 Request Header Fields Too Large', "line too long")
+
+async def relay_body_async(reader, writer, length, capture_limit=0, tee=None):
+    """relay_body() for asyncio streams.
+
+    Every write waits on writer.drain(), so a receiver that reads slowly
+    slows down reading from the sender instead of letting data pile up in
+    memory; the StreamReader likewise stops reading its socket while its own
+    buffer is full.
+    """
+    sent = 0
+    captured = bytearray() if capture_limit else None
+
+    async def send(data, body):
+        nonlocal sent, captured
+        if tee is not None:
+            tee(data)
+        if writer is not None:
+            writer.write(data)
+            await writer.drain()
+        sent += len(data)
+        if body and captured is not None:
+            captured += data
+            if len(captured) > capture_limit:
+                captured = None
+
+    async def copy(n, body=True):
+        while n:
+            data = await reader.read(min(n, ASYNC_READ_SIZE))
+            if not data:
+                return False
+            await send(data, body)
+            n -= len(data)
+        return True
+
+    if length is None:
+        while True:
+            data = await reader.read(ASYNC_READ_SIZE)
+            if not data:
+                break
+            await send(data, True)
+        complete = True
+    elif length == 'chunked':
+        complete = False
+        while True:
+            line = await read_line_async(reader)
+            if line is None:
+                break
+            await send(line, False)
+            size = parse_chunk_size(line)
+            if size == 0:
+                # Trailers, if any, then the blank line ending the body
+                while True:
+                    line = await read_line_async(reader)
+                    if line is None:
+                        break
+                    await send(line, False)
+                    if not line.strip():
+                        complete = True
+                        break
+                break
+            if not await copy(size) or not await copy(2, body=False):
+                break
+    else:
+        complete = await copy(length)
+
+    return sent, complete, bytes(captured) if complete and captured is not None else None
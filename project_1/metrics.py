@@ -0,0 +1,156 @@
+import threading
+import time
+
+# Upper bounds (milliseconds) of the latency histogram buckets; the last bucket is unbounded
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+PERCENTILES = (50, 90, 99)
+
+class Shard:
+    """One thread's counters. Only its owning thread writes to it, so recording needs no lock."""
+    __slots__ = ('status_counts', 'bytes_sent', 'active', 'idle', 'ttfb', 'total', 'ttfb_max', 'total_max')
+
+    def __init__(self):
+        self.status_counts = {}
+        self.bytes_sent = 0
+        self.active = 0
+        self.idle = 0
+        self.ttfb = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.ttfb_max = 0.0  # Largest value (ms) recorded in ttfb
+        self.total_max = 0.0
+
+    def merge(self, other):
+        # list() copies in one step, so a concurrent insert by the owning thread can't break the loop
+        for status, count in list(other.status_counts.items()):
+            self.status_counts[status] = self.status_counts.get(status, 0) + count
+        self.bytes_sent += other.bytes_sent
+        self.active += other.active
+        self.idle += other.idle
+        for i, count in enumerate(other.ttfb):
+            self.ttfb[i] += count
+        for i, count in enumerate(other.total):
+            self.total[i] += count
+        self.ttfb_max = max(self.ttfb_max, other.ttfb_max)
+        self.total_max = max(self.total_max, other.total_max)
+
+def bucket_index(value_ms):
+    for i, bound in enumerate(LATENCY_BUCKETS_MS):
+        if value_ms <= bound:
+            return i
+    return len(LATENCY_BUCKETS_MS)
+
+def percentile(buckets, p, max_ms=None):
+    """Estimates the p-th percentile (ms) from bucket counts by interpolating within the bucket.
+
+    Interpolation assumes values spread evenly across the bucket, so it can
+    land above every value actually seen; pass the largest one as max_ms to
+    cap the estimate.
+    """
+    total = sum(buckets)
+    if total == 0:
+        return 0.0
+    rank = total * p / 100
+    seen = 0
+    for i, count in enumerate(buckets):
+        if count and seen + count >= rank:
+            lower = LATENCY_BUCKETS_MS[i - 1] if i > 0 else 0.0
+            if i == len(LATENCY_BUCKETS_MS):
+                return lower  # Unbounded bucket: report its lower bound
+            upper = LATENCY_BUCKETS_MS[i]
+            estimate = lower + (upper - lower) * (rank - seen) / count
+            return estimate if max_ms is None else min(estimate, max_ms)
+        seen += count
+    return LATENCY_BUCKETS_MS[-1]
+
+class Metrics:
+    """Request, connection and latency metrics for one process.
+
+    Each thread records into its own Shard, so the hot path takes no lock;
+    the lock is only taken when a thread's shard is created or released and
+    when a snapshot is rendered. Extra sources (such as cache stats) are
+    registered with add_source() and read at render time.
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = set()
+        self.retired = Shard()  # Counters folded in from threads that have exited
+        self.sources = {}
+        self.started = time.time()
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard()
+            with self.lock:
+                self.shards.add(shard)
+            return shard
+
+    def release_thread(self):
+        """Folds the calling thread's shard into the totals; call before a worker thread exits."""
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            return
+        del self.local.shard
+        with self.lock:
+            self.shards.discard(shard)
+            self.retired.merge(shard)
+
+    def record_request(self, status, nbytes, ttfb, total):
+        """Records one finished request; ttfb and total are in seconds."""
+        shard = self.shard()
+        shard.status_counts[status] = shard.status_counts.get(status, 0) + 1
+        shard.bytes_sent += nbytes
+        ttfb_ms, total_ms = ttfb * 1000, total * 1000
+        shard.ttfb[bucket_index(ttfb_ms)] += 1
+        shard.total[bucket_index(total_ms)] += 1
+        if ttfb_ms > shard.ttfb_max:
+            shard.ttfb_max = ttfb_ms
+        if total_ms > shard.total_max:
+            shard.total_max = total_ms
+
+    def connection_opened(self):
+        self.shard().active += 1
+
+    def connection_closed(self):
+        self.shard().active -= 1
+
+    def connection_idle(self, idle):
+        """Marks a keep-alive connection as idle (waiting for a request) or busy again."""
+        self.shard().idle += 1 if idle else -1
+
+    def add_source(self, name, stats):
+        """Registers a callable returning a dict of numbers, exported as name_key lines."""
+        self.sources[name] = stats
+
+    def snapshot(self):
+        combined = Shard()
+        with self.lock:
+            combined.merge(self.retired)
+            for shard in self.shards:
+                combined.merge(shard)
+        return combined
+
+    def render(self):
+        """Renders the current metrics in a Prometheus-style text format."""
+        snap = self.snapshot()
+        lines = [f'uptime_seconds {time.time() - self.started:.0f}']
+        for status in sorted(snap.status_counts):
+            lines.append(f'requests_total{{status="{status}"}} {snap.status_counts[status]}')
+        lines.append(f'bytes_sent_total {snap.bytes_sent}')
+        lines.append(f'connections_active {snap.active}')
+        lines.append(f'connections_idle {snap.idle}')
+
+        for name, buckets, max_ms in (('ttfb_ms', snap.ttfb, snap.ttfb_max), ('response_ms', snap.total, snap.total_max)):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS_MS + ('+Inf',), buckets):
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            for p in PERCENTILES:
+                lines.append(f'{name}{{quantile="0.{p}"}} {percentile(buckets, p, max_ms):.3f}')
+
+        for source, stats in self.sources.items():
+            for key, value in stats().items():
+                lines.append(f'{source}_{key} {value}')
+        return '\n'.join(lines) + '\n'
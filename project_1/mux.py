@@ -0,0 +1,259 @@
+import collections
+import struct
+
+# Sent by a client instead of a request line to switch the connection to multiplexed framing
+MUX_PREFACE = b'PRI * MUX/1\r\n\r\n'
+FRAME_HEADER = struct.Struct('!IBBI')  # Payload length, type, flags, stream id
+MAX_FRAME_SIZE = 16 * 1024  # Largest DATA payload sent, and so the unit streams take turns in
+MAX_INCOMING_FRAME = 64 * 1024  # Largest frame accepted from a client
+INITIAL_WINDOW = 65535  # Starting flow-control window of the connection and of each stream, as in HTTP/2
+MAX_WINDOW = 2 ** 31 - 1
+MAX_STREAMS = 100  # Streams open at once on one connection; requests beyond that are refused
+DEFAULT_URGENCY = 3  # RFC 9218 urgency: 0 is the most urgent, 7 the least
+
+# Frame types, numbered as in HTTP/2
+DATA = 0
+HEADERS = 1
+PRIORITY = 2  # Payload: a new Priority field value for the stream, e.g. b'u=1'
+RST_STREAM = 3
+SETTINGS = 4
+GOAWAY = 7
+WINDOW_UPDATE = 8
+END_STREAM = 0x1
+SETTINGS_INITIAL_WINDOW = 0x4
+
+# Error codes carried by RST_STREAM and GOAWAY
+NO_ERROR = 0x0
+PROTOCOL_ERROR = 0x1
+FLOW_CONTROL_ERROR = 0x3
+REFUSED_STREAM = 0x7
+
+class MuxError(Exception):
+    """The client broke the framing protocol; the connection ends with a GOAWAY carrying `code`."""
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+def parse_priority(value):
+    """Reads an RFC 9218 Priority field value such as 'u=1, i' into (urgency, incremental)."""
+    urgency, incremental = DEFAULT_URGENCY, False
+    for item in (value or '').split(','):
+        key, _, param = item.strip().partition('=')
+        if key == 'u' and param.isdigit() and int(param) <= 7:
+            urgency = int(param)
+        elif key == 'i':
+            incremental = param in ('', '?1')
+    return urgency, incremental
+
+class Stream:
+    """One request and its response on a multiplexed connection."""
+    __slots__ = ('id', 'header', 'parts', 'files', 'remaining', 'record', 'window', 'urgency', 'incremental',
+                 'header_sent')
+
+    def __init__(self, stream_id, header, parts, record, window, priority):
+        self.id = stream_id
+        self.header = header
+        # Body parts: memoryviews, and file slices that split with take(n)
+        self.parts = collections.deque(part if hasattr(part, 'take') else memoryview(part) for part in parts)
+        self.files = [part for part in self.parts if hasattr(part, 'take')]
+        self.remaining = sum(part.count if hasattr(part, 'take') else len(part) for part in self.parts)
+        self.record = record
+        self.window = window
+        self.urgency, self.incremental = parse_priority(priority)
+        self.header_sent = False
+
+    def take(self, n):
+        """Removes and returns up to n bytes from the front of the body, without copying them."""
+        part = self.parts[0]
+        if hasattr(part, 'take'):
+            piece = part.take(n)
+            if part.count == 0:
+                self.parts.popleft()
+            self.remaining -= piece.count
+            return piece
+        if len(part) <= n:
+            piece = self.parts.popleft()
+        else:
+            self.parts[0] = part[n:]
+            piece = part[:n]
+        self.remaining -= len(piece)
+        return piece
+
+    def close(self):
+        for part in self.files:
+            part.close()
+
+class MuxSession:
+    """Server side of one multiplexed connection, without any socket I/O of its own.
+
+    Every request arrives as a HEADERS frame holding an HTTP/1.1 request
+    head and is answered on the same stream with a HEADERS frame (the
+    response head) and DATA frames carrying the body exactly as it would
+    follow that head on an HTTP/1.1 connection. Streams are independent:
+    the caller feeds received bytes to feed() and, whenever `outbuf` has
+    been written out, calls schedule() to queue the next frame. That frame
+    comes from the most urgent stream that has data and flow-control window
+    left (RFC 9218 urgency). Streams of equal urgency go one after another,
+    the one with the fewest bytes left first, so a large response never
+    holds back a small one queued behind it; streams that asked to be
+    incremental take turns frame by frame instead.
+
+    `handle(head)` answers one request head with (response header, body
+    parts, access record, Priority header value). `outbuf` holds
+    memoryviews, file slices and callables in the same form the server's
+    HTTP/1.1 writer uses: callables run when the writer reaches them.
+    """
+    def __init__(self, handle):
+        self.handle = handle
+        self.inbuf = bytearray()
+        self.outbuf = collections.deque()
+        self.streams = {}  # Stream id -> Stream, for streams not yet fully sent
+        self.last_stream_id = 0
+        self.window = INITIAL_WINDOW  # Connection-level send window
+        self.initial_window = INITIAL_WINDOW  # For new streams; set by the client's SETTINGS
+        self.last_served = {}  # Urgency -> id of the incremental stream that sent last
+        self.closing = False  # GOAWAY queued: no new streams are accepted
+
+    def feed(self, data):
+        """Takes received bytes and acts on every complete frame; raises MuxError on a protocol violation."""
+        self.inbuf += data
+        offset = 0
+        try:
+            while len(self.inbuf) - offset >= FRAME_HEADER.size:
+                length, frame_type, flags, stream_id = FRAME_HEADER.unpack_from(self.inbuf, offset)
+                if length > MAX_INCOMING_FRAME:
+                    raise MuxError(PROTOCOL_ERROR, f"frame of {length} bytes is too large")
+                end = offset + FRAME_HEADER.size + length
+                if len(self.inbuf) < end:
+                    break
+                payload = bytes(self.inbuf[offset + FRAME_HEADER.size:end])
+                offset = end
+                self._frame(frame_type, flags, stream_id & 0x7FFFFFFF, payload)
+        finally:
+            del self.inbuf[:offset]
+
+    def _frame(self, frame_type, flags, stream_id, payload):
+        if frame_type == HEADERS:
+            if stream_id <= self.last_stream_id:
+                raise MuxError(PROTOCOL_ERROR, f"stream {stream_id} is not new")
+            self.last_stream_id = stream_id
+            if self.closing:
+                return
+            if len(self.streams) >= MAX_STREAMS:
+                self._control(RST_STREAM, stream_id, struct.pack('!I', REFUSED_STREAM))
+                return
+            header, parts, record, priority = self.handle(payload)
+            self.streams[stream_id] = Stream(stream_id, header, parts, record, self.initial_window, priority)
+        elif frame_type == WINDOW_UPDATE:
+            if len(payload) != 4:
+                raise MuxError(PROTOCOL_ERROR, "bad WINDOW_UPDATE")
+            increment = struct.unpack('!I', payload)[0] & MAX_WINDOW
+            if stream_id == 0:
+                self.window += increment
+                if self.window > MAX_WINDOW:
+                    raise MuxError(FLOW_CONTROL_ERROR, "connection window overflow")
+            elif stream_id in self.streams:
+                self.streams[stream_id].window += increment
+        elif frame_type == SETTINGS:
+            for key, value in struct.iter_unpack('!HI', payload[:len(payload) - len(payload) % 6]):
+                if key == SETTINGS_INITIAL_WINDOW:
+                    if value > MAX_WINDOW:
+                        raise MuxError(FLOW_CONTROL_ERROR, "initial window too large")
+                    # As in HTTP/2, the change applies to the windows of streams already open
+                    for stream in self.streams.values():
+                        stream.window += value - self.initial_window
+                    self.initial_window = value
+        elif frame_type == PRIORITY:
+            stream = self.streams.get(stream_id)
+            if stream is not None:
+                stream.urgency, stream.incremental = parse_priority(payload.decode('latin-1'))
+        elif frame_type == RST_STREAM:
+            stream = self.streams.pop(stream_id, None)
+            if stream is not None:
+                # Frames of it already queued still go out; nothing more is scheduled
+                self.outbuf.append(stream.record.finish)
+                self.outbuf.append(stream.close)
+        elif frame_type == GOAWAY:
+            self.goaway()
+        # DATA (requests carry no body here) and unknown frame types are ignored
+
+    def _control(self, frame_type, stream_id, payload=b''):
+        self.outbuf.append(memoryview(FRAME_HEADER.pack(len(payload), frame_type, 0, stream_id) + payload))
+
+    def goaway(self, code=NO_ERROR):
+        """Stops accepting streams; those already open are still answered unless code is an error."""
+        if self.closing:
+            return
+        self.closing = True
+        if code != NO_ERROR:
+            self.close_streams()
+        self._control(GOAWAY, 0, struct.pack('!II', self.last_stream_id, code))
+
+    def finished(self):
+        """Whether the connection can be closed once outbuf is written."""
+        return self.closing and not self.streams
+
+    def schedule(self):
+        """Queues the next frame on outbuf; returns False if no stream can send anything now."""
+        waiting = [stream for stream in self.streams.values() if not stream.header_sent]
+        if waiting:
+            stream = min(waiting, key=lambda s: (s.urgency, s.id))
+            stream.header_sent = True
+            self.outbuf.append(stream.record.first_byte)
+            if not stream.parts:
+                self._send(stream, HEADERS, END_STREAM, memoryview(stream.header))
+                self._finish(stream)
+            else:
+                self._send(stream, HEADERS, 0, memoryview(stream.header))
+            return True
+
+        if self.window <= 0:
+            return False
+        ready = [stream for stream in self.streams.values() if stream.window > 0]
+        if not ready:
+            return False
+        urgency = min(stream.urgency for stream in ready)
+        ready = sorted((stream for stream in ready if stream.urgency == urgency), key=lambda s: s.id)
+        sequential = [stream for stream in ready if not stream.incremental]
+        if sequential:
+            stream = min(sequential, key=lambda s: (s.remaining, s.id))
+        else:
+            # Round robin: the next incremental stream after the one that sent last
+            last = self.last_served.get(urgency, 0)
+            stream = next((s for s in ready if s.id > last), ready[0])
+            self.last_served[urgency] = stream.id
+
+        payload = stream.take(min(MAX_FRAME_SIZE, stream.window, self.window))
+        size = payload.count if hasattr(payload, 'count') else len(payload)
+        stream.window -= size
+        self.window -= size
+        self._send(stream, DATA, 0 if stream.parts else END_STREAM, payload, size)
+        if not stream.parts:
+            self._finish(stream)
+        return True
+
+    def _send(self, stream, frame_type, flags, payload, size=None):
+        size = len(payload) if size is None else size
+        self.outbuf.append(memoryview(FRAME_HEADER.pack(size, frame_type, flags, stream.id)))
+        self.outbuf.append(payload)
+
+    def _finish(self, stream):
+        del self.streams[stream.id]
+        self.outbuf.append(stream.record.finish)
+        self.outbuf.append(stream.close)
+
+    def close_streams(self):
+        for stream in self.streams.values():
+            stream.record.finish()
+            stream.close()
+        self.streams.clear()
+
+    def close(self):
+        """Drops everything unsent when the connection goes away; pending callbacks still run."""
+        for item in self.outbuf:
+            if callable(item):
+                item()
+            elif not isinstance(item, memoryview):
+                item.close()
+        self.outbuf.clear()
+        self.close_streams()
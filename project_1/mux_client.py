@@ -0,0 +1,80 @@
+import argparse
+import socket
+import struct
+import time
+from mux import (MUX_PREFACE, FRAME_HEADER, DATA, HEADERS, RST_STREAM, SETTINGS, GOAWAY, WINDOW_UPDATE,
+                 END_STREAM, SETTINGS_INITIAL_WINDOW, INITIAL_WINDOW)
+
+RECEIVE_WINDOW = 1024 * 1024  # Window granted to the server per stream and for the connection
+
+def frame(frame_type, stream_id, payload=b'', flags=0):
+    return FRAME_HEADER.pack(len(payload), frame_type, flags, stream_id) + payload
+
+def read_exactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("server closed the connection")
+        data += chunk
+    return bytes(data)
+
+def fetch_all(host, port, paths, priorities):
+    """Requests every path at once over one multiplexed connection.
+
+    Returns [(path, status line, body bytes, seconds until its stream ended), ...] in the order the streams ended.
+    """
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    start = time.perf_counter()
+    out = [MUX_PREFACE,
+           frame(SETTINGS, 0, struct.pack('!HI', SETTINGS_INITIAL_WINDOW, RECEIVE_WINDOW)),
+           frame(WINDOW_UPDATE, 0, struct.pack('!I', RECEIVE_WINDOW - INITIAL_WINDOW))]
+    streams = {}
+    for i, path in enumerate(paths):
+        stream_id = 2 * i + 1
+        head = f'GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\n'
+        if priorities[i]:
+            head += f'Priority: {priorities[i]}\r\n'
+        out.append(frame(HEADERS, stream_id, (head + '\r\n').encode(), END_STREAM))
+        streams[stream_id] = [path, None, 0]
+    sock.sendall(b''.join(out))
+
+    results = []
+    while streams:
+        length, frame_type, flags, stream_id = FRAME_HEADER.unpack(read_exactly(sock, FRAME_HEADER.size))
+        payload = read_exactly(sock, length)
+        if frame_type == GOAWAY:
+            raise ConnectionError(f"server sent GOAWAY {struct.unpack('!II', payload)}")
+        stream = streams.get(stream_id)
+        if stream is None:
+            continue
+        if frame_type == HEADERS:
+            stream[1] = payload.split(b'\r\n', 1)[0].decode()
+        elif frame_type == DATA:
+            stream[2] += length
+            # Hand the window straight back, for the stream and for the connection
+            sock.sendall(frame(WINDOW_UPDATE, 0, struct.pack('!I', length)) +
+                         frame(WINDOW_UPDATE, stream_id, struct.pack('!I', length)))
+        elif frame_type == RST_STREAM:
+            stream[1] = f"refused ({struct.unpack('!I', payload)[0]})"
+            flags |= END_STREAM
+        if flags & END_STREAM:
+            path, status, nbytes = streams.pop(stream_id)
+            results.append((path, status, nbytes, time.perf_counter() - start))
+    sock.close()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fetch several paths at once over one multiplexed connection to server.py')
+    parser.add_argument('paths', nargs='+', help='paths to fetch; append @u=N (RFC 9218 priority) to set one, e.g. /big.bin@u=5,i')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    paths, priorities = [], []
+    for spec in args.paths:
+        path, _, priority = spec.partition('@')
+        paths.append(path)
+        priorities.append(priority)
+    for path, status, nbytes, elapsed in fetch_all(args.host, args.port, paths, priorities):
+        print(f"{elapsed * 1000:9.1f} ms  {status}  {nbytes:>10} bytes  {path}")
@@ -0,0 +1,62 @@
+import cProfile
+import io
+import pstats
+import random
+import threading
+
+class SampledProfiler:
+    """Runs cProfile on a sampled fraction of connections and aggregates the results.
+
+    A profile only sees the thread it was enabled on, so a sampled
+    connection is profiled for as long as its own thread serves it (call()),
+    or around each event handled for it on an event loop (start() once,
+    then enable()/disable() on the returned profile and add() it at the
+    end). dump() writes the stats gathered so far, on demand.
+    """
+    def __init__(self, rate=0.0):
+        self.rate = rate
+        self.stats = None  # pstats.Stats over every finished profile
+        self.profiled = 0  # Connections whose profiles are in stats
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Returns a new cProfile.Profile for a sampled connection, or None if it is not sampled."""
+        if self.rate > 0 and random.random() < self.rate:
+            return cProfile.Profile()
+        return None
+
+    def add(self, profile):
+        """Folds a finished (or still enabled, which stops it) profile into the aggregate."""
+        profile.disable()
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.profiled += 1
+
+    def call(self, fn, *args):
+        """Calls fn(*args), under a profile of its own if the connection is sampled."""
+        profile = self.start()
+        if profile is None:
+            return fn(*args)
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one active profiler per process; this connection goes unprofiled
+            return fn(*args)
+        try:
+            return fn(*args)
+        finally:
+            self.add(profile)
+
+    def dump(self, path, limit=25):
+        """Writes the aggregated stats to path (for pstats or snakeviz) and returns the top `limit` functions as text."""
+        with self.lock:
+            if self.stats is None:
+                return "no connections profiled yet"
+            self.stats.dump_stats(path)
+            out = io.StringIO()
+            self.stats.stream = out
+            self.stats.sort_stats('cumulative').print_stats(limit)
+            return f"{self.profiled} connections profiled, written to {path}\n{out.getvalue()}"
@@ -1,86 +1,914 @@
+import asyncio
+import signal
 import socket
 import threading
+import argparse
+import os
+import time
+import timing
+from metrics import Metrics
+from profiler import SampledProfiler
+from http_parser import HTTPParseError
+from http_stream import HOP_BY_HOP, SocketReader, parse_head, parse_response_head, header_value
+from http_stream import connection_tokens, keep_alive, request_body_length, response_body_length
+from http_stream import relay_body, relay_body_async
+from upstream_pool import UpstreamPool, AsyncUpstreamPool, has_buffered
+from tunnel import TunnelStats, tunnel, tunnel_async
+from resolver import ResolverCache, connect, connect_async
+from coalesce import Coalescer, AsyncInFlightResponse
+from proxy_cache import ResponseCache, CachedResponse, request_allows_cache, request_wants_revalidation
+
+METRICS_ENABLED = False  # Answer METRICS_PATH requests made directly to the proxy (opt-in)
+METRICS_PATH = '/__metrics'
+MAX_REQUEST_HEAD = 16 * 1024  # Request line plus headers, including the blank line
+MAX_RESPONSE_HEAD = 64 * 1024  # Largest origin response header accepted
+CLIENT_KEEPALIVE_TIMEOUT = 15  # Seconds a client connection may sit idle between requests
+LISTEN_BACKLOG = 1024
+MAX_CONNECTIONS = 4096  # Client connections relayed at once in asyncio mode; each also holds an origin socket
+SHUTDOWN_TIMEOUT = 10  # Seconds in-flight relays get to finish on SIGTERM or Ctrl-C in asyncio mode
+SHED_LINGER = 1.0  # Seconds a refused connection's request is read and discarded before it is closed
+TUNNEL_IDLE_TIMEOUT = 300  # Seconds a CONNECT tunnel may go without traffic in either direction
+CONNECTION_ESTABLISHED = b'HTTP/1.1 200 Connection Established\r\n\r\n'
+CONTINUE = b'HTTP/1.1 100 Continue\r\n\r\n'  # Sent for Expect: 100-continue once the origin connection is open
+SERVICE_UNAVAILABLE = b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+UPSTREAM_MAX_PER_HOST = 8  # Connections to one origin, idle or in use
+UPSTREAM_IDLE_TIMEOUT = 10  # Seconds an idle origin connection is kept; below server.py's keep-alive timeout
+DNS_TTL = 60  # Seconds a resolved origin address is reused
+DNS_NEGATIVE_TTL = 5  # Seconds a failed lookup is remembered
+CACHE_MAX_BYTES = 64 * 1024 * 1024  # Memory budget for cached origin responses; 0 disables caching
+CACHE_MAX_OBJECT_SIZE = 8 * 1024 * 1024  # Larger responses are relayed but not cached
+SLOW_REQUEST_MS = 0  # Print the phase timings of requests slower than this (0: off)
+PROFILE_SAMPLE_RATE = 0.0  # Fraction of client connections run under cProfile (thread mode)
+PROFILE_PATH = 'proxy-{pid}.prof'  # Where SIGUSR1 (and Ctrl-C) writes the aggregated profile
+
+# Runtime metrics for the proxy, exposed at METRICS_PATH when enabled
+METRICS = Metrics()
+
+# Per-phase latency histograms, fed by timing hooks when metrics are enabled
+PHASE_STATS = timing.PhaseStats()
+
+# cProfile of sampled client connections, dumped on SIGUSR1
+PROFILER = SampledProfiler(PROFILE_SAMPLE_RATE)
+
+# Origin host lookups, run off the relay path and cached
+RESOLVER = ResolverCache(ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL)
+METRICS.add_source('resolver', RESOLVER.stats)
+
+# Keep-alive connections to origins, shared by all client threads
+UPSTREAM_POOL = UpstreamPool(UPSTREAM_MAX_PER_HOST, UPSTREAM_IDLE_TIMEOUT, resolver=RESOLVER)
+METRICS.add_source('upstream_pool', UPSTREAM_POOL.stats)
+
+# CONNECT tunnel counters
+TUNNEL_STATS = TunnelStats()
+METRICS.add_source('tunnels', TUNNEL_STATS.stats)
+
+# Cached GET responses keyed by absolute URL, set up by main()
+RESPONSE_CACHE = None
+
+# Origin fetches of cacheable GETs in progress, joined by identical requests arriving meanwhile
+COALESCER = Coalescer(max_size=CACHE_MAX_OBJECT_SIZE)
+METRICS.add_source('coalesce', COALESCER.stats)
+
+# asyncio mode state, owned by the event loop thread
+ASYNC_UPSTREAM_POOL = None
+ASYNC_COALESCER = None
+ASYNC_CLIENTS = {}  # Client connection task -> whether it is idle between requests
+SHUTTING_DOWN = False
+
+def metrics_response(persist):
+    """The full response to a request for METRICS_PATH, header and body."""
+    body = METRICS.render().encode()
+    connection = 'keep-alive' if persist else 'close'
+    header = f'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: {connection}\r\n\r\n'
+    return header.encode() + body
+
+def send_metrics(client_socket, persist):
+    response = metrics_response(persist)
+    client_socket.sendall(response)
+    return 200, len(response)
+
+def send_error(client_socket, status):
+    """Sends an empty error response; the connection is closed after it."""
+    response = f'HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.encode()
+    try:
+        client_socket.sendall(response)
+    except OSError:
+        return 0
+    return len(response)
 
 def handle_client(client_socket):
-    # Receive the request from the client
-    request = client_socket.recv(4096)
-    if not request:
+    """Serves requests from one client connection until it closes or stops asking for keep-alive."""
+    METRICS.connection_opened()
+    client = SocketReader(client_socket)
+    upstream = SocketReader(None)  # Reused for every origin connection this client's requests go over
+    client_socket.settimeout(CLIENT_KEEPALIVE_TIMEOUT)
+    # Response heads and bodies go out as separate writes; don't let Nagle hold back the second
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        while True:
+            try:
+                head = client.read_until(b'\r\n\r\n', MAX_REQUEST_HEAD)
+            except HTTPParseError as e:
+                send_error(client_socket, e.status)
+                break
+            except OSError:
+                break  # Idle past CLIENT_KEEPALIVE_TIMEOUT, or the client went away
+            if head is None:
+                break
+
+            start = time.perf_counter()
+            timer = timing.start()
+            try:
+                status, nbytes, first_byte_at, persist = relay_request(head, client, upstream)
+            except OSError:
+                break
+            if status is not None:
+                now = time.perf_counter()
+                METRICS.record_request(status, nbytes, (first_byte_at or now) - start, now - start)
+                timer.mark('relay')
+                timer.finish(status, nbytes)
+            if not persist:
+                break
+    finally:
         client_socket.close()
-        return
+        METRICS.connection_closed()
+        METRICS.release_thread()
+
+def relay_request(head, client, upstream):
+    """Forwards one request and relays the response.
+
+    Returns (status, bytes sent, time of first byte, whether the client
+    connection stays open for another request).
+    """
+    client_socket = client.sock
 
     # Decode the request to extract information
     try:
-        request_line = request.decode().split('\n')[0]
-        method, url, protocol = request_line.split()
+        (method, url, protocol), headers = parse_head(head)
+        length = request_body_length(headers)
     except ValueError:
-        client_socket.close()
-        return
+        return None, 0, None, False
+    except HTTPParseError as e:
+        return int(e.status[:3]), send_error(client_socket, e.status), None, False
+    timing.mark('parse')
+    timing.label(method, url)
+    persist = keep_alive(protocol, headers)
+
+    if METRICS_ENABLED and url == METRICS_PATH:
+        # A body is never read here, so the connection can't be used for another request after it
+        status, nbytes = send_metrics(client_socket, persist and not length)
+        return status, nbytes, None, persist and not length
+
+    if method == 'CONNECT':
+        return relay_connect(client, url)
 
     # Only handle absolute URLs (required for proxy)
     if not url.startswith('http://'):
-        response = 'HTTP/1.1 400 Bad Request\r\n\r\n'
-        client_socket.sendall(response.encode())
-        client_socket.close()
-        return
+        return 400, send_error(client_socket, '400 Bad Request'), None, False
+
+    try:
+        host, port, path = split_url(url)
+    except ValueError:
+        return 400, send_error(client_socket, '400 Bad Request'), None, False
+    if RESPONSE_CACHE is not None and method == 'GET' and not length:
+        request_headers = {name.lower(): value for name, value in headers}
+        if request_allows_cache(request_headers):
+            return relay_cached(client_socket, upstream, url, host, port, path, headers, request_headers, persist)
+
+    try:
+        # Send the request, with its request line made relative, over a pooled connection
+        status, reason, response_headers = open_upstream(upstream, host, port,
+                                                         forward_request(method, path, headers, length),
+                                                         client, length, expects_continue(headers))
+    except HTTPParseError as e:
+        return int(e.status[:3]), send_error(client_socket, e.status), None, False
+    except Exception as e:
+        print(f"Error: {e}")
+        return 502, send_error(client_socket, '502 Bad Gateway'), None, False
+    first_byte_at = time.perf_counter()
+    try:
+        nbytes, persist, _ = relay_response(upstream, client_socket, host, port, method,
+                                            status, reason, response_headers, persist)
+    except Exception as e:
+        print(f"Error: {e}")
+        return status, 0, first_byte_at, False
+    return status, nbytes, first_byte_at, persist
+
+def split_authority(target):
+    """Splits a CONNECT target (host:port) into (host, port), or returns None if it isn't one."""
+    host, _, port = target.rpartition(':')
+    if not host or not port.isdigit():
+        return None
+    return host.strip('[]'), int(port)
 
+def relay_connect(client, target):
+    """Answers a CONNECT request by tunnelling the client connection to target until either side closes it.
+
+    The tunnel is served from this thread alone. Returns the same as
+    relay_request(); the connection is never kept for another request.
+    """
+    client_socket = client.sock
+    address = split_authority(target)
+    if address is None:
+        return 400, send_error(client_socket, '400 Bad Request'), None, False
+    try:
+        timeout = UPSTREAM_POOL.connect_timeout
+        upstream_socket = connect(RESOLVER.resolve(*address, timeout), timeout)
+    except OSError as e:
+        print(f"Error: {e}")
+        return 502, send_error(client_socket, '502 Bad Gateway'), None, False
+    timing.mark('connect')
+
+    up = down = 0
+    idle = False
+    TUNNEL_STATS.tunnel_opened()
+    try:
+        client_socket.sendall(CONNECTION_ESTABLISHED)
+        first_byte_at = time.perf_counter()
+        # Anything the client sent straight after the CONNECT request goes first
+        initial = bytes(client.read(client.pending())) if client.pending() else b''
+        up, down, idle = tunnel(client_socket, upstream_socket, TUNNEL_IDLE_TIMEOUT, initial)
+    finally:
+        upstream_socket.close()
+        TUNNEL_STATS.tunnel_closed(up, down, idle)
+    print(f"Tunnel to {target} closed{' after idling' if idle else ''}: {up} bytes up, {down} bytes down")
+    return 200, len(CONNECTION_ESTABLISHED) + down, first_byte_at, False
+
+def split_url(url):
+    """Splits an absolute http:// URL into (host, port, path); raises ValueError if its authority is malformed."""
     # Extract the hostname and the path
     url = url[7:]  # Remove 'http://'
     host_end = url.find('/')
     if host_end == -1:
-        host = url
+        authority = url
         path = '/'
     else:
-        host = url[:host_end]
+        authority = url[:host_end]
         path = url[host_end:]
 
-    # Split host and port if specified
-    if ':' in host:
-        host, port = host.split(':')
-        port = int(port)
+    # Split host and port if specified; an IPv6 literal is bracketed and has colons of its own
+    if authority.startswith('['):
+        host, sep, port = authority[1:].partition(']')
+        if not sep or (port and not port.startswith(':')):
+            raise ValueError(f"Bad authority in URL: {authority!r}")
+        port = port[1:]
     else:
-        port = 80
+        host, sep, port = authority.rpartition(':')
+        if not sep:
+            host, port = authority, ''
+        elif ':' in host:
+            raise ValueError(f"Unbracketed IPv6 literal in URL: {authority!r}")
+    if not host or (port and not port.isdigit()) or int(port or 80) > 65535:
+        raise ValueError(f"Bad authority in URL: {authority!r}")
+    return host, int(port or 80), path
+
+def forward_request(method, path, headers, length=0, extra_headers=()):
+    """Builds the request header sent to the origin, with a relative request line and no hop-by-hop headers.
+
+    The body is framed the same way the client framed it, as `length` from
+    request_body_length() says, and is streamed after the header by
+    open_upstream(). If extra_headers are given they replace the client's
+    own conditional headers. The origin is asked to keep the connection
+    open, so it can go back to UPSTREAM_POOL once the response has been read.
+    """
+    dropped = HOP_BY_HOP | connection_tokens(headers) | {'content-length', 'expect'}
+    if extra_headers:
+        dropped |= {'if-modified-since', 'if-none-match'}
+    lines = [f"{method} {path} HTTP/1.1"]
+    lines += [f'{name}: {value}' for name, value in headers if name.lower() not in dropped]
+    lines += [f'{name}: {value}' for name, value in extra_headers]
+    if length == 'chunked':
+        lines.append('Transfer-Encoding: chunked')
+    elif length or header_value(headers, 'content-length') is not None:
+        lines.append(f'Content-Length: {length}')
+    lines.append('Connection: keep-alive')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1')
+
+def expects_continue(headers):
+    """Whether the client waits for a 100 Continue before sending its request body."""
+    return (header_value(headers, 'expect') or '').lower() == '100-continue'
+
+def open_upstream(upstream, host, port, request, client=None, length=0, expect_continue=False):
+    """Sends a request to the origin over a pooled connection and reads the response header.
 
+    A request body, framed by length, is streamed from the `client` reader
+    straight after the header, one buffer at a time, so uploads of any size
+    pass through in bounded memory. With expect_continue the client is told
+    to send it once the origin connection is open. The connection is
+    attached to the `upstream` reader; returns (status, reason, headers). If
+    a reused connection turns out to have been closed by the origin while
+    it sat idle, the request is retried on another one, unless part of the
+    body has already been taken from the client.
+    """
+    while True:
+        try:
+            sock, reused = UPSTREAM_POOL.acquire(host, port)
+        finally:
+            timing.mark('connect')
+        upstream.attach(sock)
+        body_started = False
+        try:
+            sock.sendall(request)
+            if length:
+                body_started = True
+                if expect_continue:
+                    client.sock.sendall(CONTINUE)
+                _, complete, _ = relay_body(client, sock, length)
+                if not complete:
+                    raise ConnectionError("client closed the connection part way through the request body")
+            timing.mark('upload')
+            try:
+                head = upstream.read_until(b'\r\n\r\n', MAX_RESPONSE_HEAD)
+            except HTTPParseError as e:
+                # Its status is meant for a client's request; an origin's bad response is a 502
+                raise ValueError(f"origin response head: {e}")
+            if head is None:
+                raise ConnectionError("origin closed the connection without responding")
+            timing.mark('origin')
+            return parse_response_head(head)
+        except Exception as e:
+            UPSTREAM_POOL.release(host, port, sock, False)
+            if reused and isinstance(e, OSError) and not body_started:
+                continue
+            raise
+
+def client_response_head(status, reason, headers, persist):
+    """Rebuilds an origin response header for the client, keeping Transfer-Encoding as the body is relayed as is."""
+    dropped = (HOP_BY_HOP - {'transfer-encoding'}) | connection_tokens(headers)
+    lines = [f'HTTP/1.1 {status} {reason}']
+    lines += [f'{name}: {value}' for name, value in headers if name.lower() not in dropped]
+    lines.append('Connection: keep-alive' if persist else 'Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1')
+
+def relay_response(upstream, client_socket, host, port, method, status, reason, headers, persist, capture_limit=0,
+                   in_flight=None):
+    """Relays a response whose header has been read from `upstream`, then returns its connection to the pool.
+
+    Returns (bytes sent, whether the client connection can stay open, the
+    decoded body or None); the body is kept only if capture_limit is set,
+    it fits and it arrived complete. The body is also published to
+    `in_flight`, if given, for requests following this one.
+    """
+    length = response_body_length(method, status, headers)
+    # A body that ends when the origin closes can only be passed on the same way
+    persist = persist and length is not None
+    reusable = complete = False
     try:
-        # Create a socket to connect to the destination server
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.connect((host, port))
+        head = client_response_head(status, reason, headers, persist)
+        client_socket.sendall(head)
+        nbytes, complete, body = relay_body(upstream, client_socket, length, capture_limit,
+                                            in_flight.append if in_flight else None)
+        reusable = complete and length is not None and not upstream.pending() and keep_alive('HTTP/1.1', headers)
+        return len(head) + nbytes, persist and complete, body
+    finally:
+        UPSTREAM_POOL.release(host, port, upstream.sock, reusable)
+        if in_flight is not None:
+            in_flight.finish(complete)
 
-        # Modify the request line to be relative to the server
-        new_request_line = f"{method} {path} {protocol}\r\n"
-        headers = request.decode().split('\r\n')[1:]
-        headers = [header for header in headers if not header.lower().startswith('proxy-connection')]
-        new_request = new_request_line + '\r\n'.join(headers)
-    
+def send_cached(client_socket, entry, request_headers, persist):
+    """Answers the client from a cache entry, with a 304 if its own conditional headers allow."""
+    not_modified = entry.not_modified_for(request_headers)
+    data = entry.response_head(time.time(), not_modified, persist)
+    if not not_modified:
+        data += entry.body
+    client_socket.sendall(data)
+    return (304 if not_modified else entry.status), len(data)
 
-        # Send the modified request to the destination server
-        server_socket.sendall(new_request.encode())
+def relay_cached(client_socket, upstream, url, host, port, path, headers, request_headers, persist):
+    """Serves a cacheable GET from RESPONSE_CACHE, revalidating or fetching from the origin as needed.
 
-        # Receive the response from the server and send it back to the client
-        while True:
-            data = server_socket.recv(4096)
-            if len(data) > 0:
-                client_socket.sendall(data)
-            else:
-                break
+    A fresh entry is answered without contacting the origin. Otherwise the
+    request joins any fetch of the same URL already in flight (see
+    coalesce.py), so a burst of misses reaches the origin once. Returns the
+    same as relay_request().
+    """
+    entry = RESPONSE_CACHE.lookup(url, request_headers)
+    timing.mark('cache')
+    if entry is not None and entry.is_fresh(time.time()) and not request_wants_revalidation(request_headers):
+        status, nbytes = send_cached(client_socket, entry, request_headers, persist)
+        return status, nbytes, time.perf_counter(), persist
 
-        # Close both sockets
-        server_socket.close()
-        client_socket.close()
+    in_flight, leading = COALESCER.join(url, request_headers)
+    if not leading:
+        started = in_flight.wait_started()
+        timing.mark('coalesce')
+        if started and in_flight.matches(request_headers):
+            return send_in_flight(client_socket, in_flight, request_headers, persist)
+        COALESCER.fallback()
+        in_flight = None  # Fetch for this request alone
+    try:
+        return fetch_cached(client_socket, upstream, url, host, port, path, headers, request_headers, persist,
+                            entry, in_flight)
+    finally:
+        if leading:
+            in_flight.abandon()
+            COALESCER.leave(url, in_flight)
+
+def fetch_cached(client_socket, upstream, url, host, port, path, headers, request_headers, persist, entry, in_flight):
+    """Fetches a cacheable GET from the origin for relay_cached(), sharing the response through `in_flight` if given.
+
+    A stale entry is revalidated with If-Modified-Since / If-None-Match, and
+    an origin 304 refreshes it. Anything else is relayed to the client as it
+    arrives and stored if its headers allow.
+    """
+    request = forward_request('GET', path, headers, 0, entry.conditional_headers() if entry else ())
+    try:
+        status, reason, response_headers = open_upstream(upstream, host, port, request)
     except Exception as e:
         print(f"Error: {e}")
-        client_socket.close()
+        return 502, send_error(client_socket, '502 Bad Gateway'), None, False
+    first_byte_at = time.perf_counter()
+    age = header_value(response_headers, 'age')
+    age = int(age) if age and age.isdigit() else 0
+
+    if status == 304 and entry is not None:
+        # Our revalidation succeeded: the client gets the cached copy, not this 304
+        UPSTREAM_POOL.release(host, port, upstream.sock,
+                              keep_alive('HTTP/1.1', response_headers) and not upstream.pending())
+        entry = RESPONSE_CACHE.refresh(entry, response_headers, age)
+        if in_flight is not None:
+            in_flight.serve_entry(entry)
+        status, nbytes = send_cached(client_socket, entry, request_headers, persist)
+        return status, nbytes, first_byte_at, persist
+
+    vary = vary_values(response_headers, request_headers)
+    if in_flight is not None:
+        if shareable(url, status, reason, response_headers, vary):
+            in_flight.start(status, reason, response_headers)
+        else:
+            in_flight.abandon()
+            in_flight = None
+    try:
+        nbytes, persist, body = relay_response(upstream, client_socket, host, port, 'GET', status, reason,
+                                               response_headers, persist, CACHE_MAX_OBJECT_SIZE, in_flight)
+    except Exception as e:
+        print(f"Error: {e}")
+        return status, 0, first_byte_at, False
+    if body is not None:
+        RESPONSE_CACHE.store(CachedResponse(url, status, reason, response_headers, body, vary, time.time(), age))
+    elif entry is not None:
+        RESPONSE_CACHE.remove(url)
+    return status, nbytes, first_byte_at, persist
+
+def vary_values(response_headers, request_headers):
+    """The request's values of the headers a response varies on, as stored with a cache entry."""
+    vary = {}
+    for name in (header_value(response_headers, 'vary') or '').split(','):
+        name = name.strip().lower()
+        if name:
+            vary[name] = request_headers.get(name)
+    return vary
+
+def shareable(url, status, reason, headers, vary):
+    """Whether requests following a fetch may be given its response: only what the cache could store itself."""
+    length = header_value(headers, 'content-length')
+    if length is not None and length.isdigit() and int(length) > CACHE_MAX_OBJECT_SIZE:
+        return False
+    return CachedResponse(url, status, reason, headers, b'', vary, time.time()).storable()
+
+def send_in_flight(client_socket, in_flight, request_headers, persist):
+    """Answers the client with a response another request is fetching, sending its body as it arrives.
+
+    Returns the same as relay_request().
+    """
+    if in_flight.entry is not None:
+        status, nbytes = send_cached(client_socket, in_flight.entry, request_headers, persist)
+        return status, nbytes, time.perf_counter(), persist
+    length = response_body_length('GET', in_flight.status, in_flight.headers)
+    persist = persist and length is not None
+    head = client_response_head(in_flight.status, in_flight.reason, in_flight.headers, persist)
+    client_socket.sendall(head)
+    first_byte_at = time.perf_counter()
+    nbytes = len(head)
+    for piece in in_flight.pieces():
+        client_socket.sendall(piece)
+        nbytes += len(piece)
+    return in_flight.status, nbytes, first_byte_at, persist and in_flight.complete
 
 def start_proxy_server(host='127.0.0.1', port=8888):
     proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     proxy_socket.bind((host, port))
-    proxy_socket.listen(100)
+    proxy_socket.listen(LISTEN_BACKLOG)
     print(f"Proxy server listening on {host}:{port}")
 
     while True:
         client_socket, addr = proxy_socket.accept()
         print(f"Received connection from {addr}")
-        client_thread = threading.Thread(target=handle_client, args=(client_socket,))
+        client_thread = threading.Thread(target=PROFILER.call, args=(handle_client, client_socket))
         client_thread.start()
 
+# asyncio engine: every client connection is a task on one event loop
+
+async def write(writer, data):
+    writer.write(data)
+    await writer.drain()
+
+async def send_metrics_async(writer, persist):
+    """send_metrics() for an asyncio client connection."""
+    response = metrics_response(persist)
+    await write(writer, response)
+    return 200, len(response)
+
+async def send_error_async(writer, status):
+    """send_error() for an asyncio client connection."""
+    response = f'HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.encode()
+    try:
+        await write(writer, response)
+    except OSError:
+        return 0
+    return len(response)
+
+async def cache_call(method, *args):
+    """Calls a RESPONSE_CACHE method, in a thread when it may read or write the disk tier."""
+    if RESPONSE_CACHE.disk_dir is None:
+        return method(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, method, *args)
+
+async def discard_until_eof(reader):
+    while await reader.read(MAX_REQUEST_HEAD):
+        pass
+
+async def handle_client_async(reader, writer):
+    """handle_client() for one asyncio client connection."""
+    task = asyncio.current_task()
+    if len(ASYNC_CLIENTS) >= MAX_CONNECTIONS or SHUTTING_DOWN:
+        # Over the concurrency limit: refuse straight away rather than queue
+        writer.write(SERVICE_UNAVAILABLE)
+        METRICS.record_request(503, len(SERVICE_UNAVAILABLE), 0, 0)
+        try:
+            writer.write_eof()
+            # Closing with the request unread would send a RST that can destroy the 503 before the client reads it
+            await asyncio.wait_for(discard_until_eof(reader), SHED_LINGER)
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+        return
+
+    ASYNC_CLIENTS[task] = True
+    METRICS.connection_opened()
+    try:
+        while True:
+            ASYNC_CLIENTS[task] = True  # Idle: may be closed straight away on shutdown
+            try:
+                first = await asyncio.wait_for(reader.read(1), CLIENT_KEEPALIVE_TIMEOUT)
+                if not first:
+                    break
+                # A request has started arriving, so shutdown has to let it finish
+                ASYNC_CLIENTS[task] = False
+                head = first + await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), CLIENT_KEEPALIVE_TIMEOUT)
+            except asyncio.LimitOverrunError:
+                await send_error_async(writer, '431 Request Header Fields Too Large')
+                break
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+                break
+
+            start = time.perf_counter()
+            timer = timing.start()  # Each connection task has its own context, so its own current timer
+            try:
+                status, nbytes, first_byte_at, persist = await relay_request_async(head, reader, writer)
+            except OSError:
+                break
+            if status is not None:
+                now = time.perf_counter()
+                METRICS.record_request(status, nbytes, (first_byte_at or now) - start, now - start)
+                timer.mark('relay')
+                timer.finish(status, nbytes)
+            if not persist or SHUTTING_DOWN:
+                break
+    except asyncio.CancelledError:
+        pass  # Closed by shutdown
+    finally:
+        del ASYNC_CLIENTS[task]
+        writer.close()
+        METRICS.connection_closed()
+
+async def relay_request_async(head, reader, writer):
+    """relay_request() for an asyncio client connection."""
+    try:
+        (method, url, protocol), headers = parse_head(head)
+        length = request_body_length(headers)
+    except ValueError:
+        return None, 0, None, False
+    except HTTPParseError as e:
+        return int(e.status[:3]), await send_error_async(writer, e.status), None, False
+    timing.mark('parse')
+    timing.label(method, url)
+    persist = keep_alive(protocol, headers) and not SHUTTING_DOWN
+
+    if METRICS_ENABLED and url == METRICS_PATH:
+        persist = persist and not length
+        status, nbytes = await send_metrics_async(writer, persist)
+        return status, nbytes, None, persist
+
+    if method == 'CONNECT':
+        return await relay_connect_async(reader, writer, url)
+
+    # Only handle absolute URLs (required for proxy)
+    if not url.startswith('http://'):
+        return 400, await send_error_async(writer, '400 Bad Request'), None, False
+
+    try:
+        host, port, path = split_url(url)
+    except ValueError:
+        return 400, await send_error_async(writer, '400 Bad Request'), None, False
+    if RESPONSE_CACHE is not None and method == 'GET' and not length:
+        request_headers = {name.lower(): value for name, value in headers}
+        if request_allows_cache(request_headers):
+            return await relay_cached_async(writer, url, host, port, path, headers, request_headers, persist)
+
+    try:
+        upstream, status, reason, response_headers = await open_upstream_async(
+            host, port, forward_request(method, path, headers, length), (reader, writer), length,
+            expects_continue(headers))
+    except HTTPParseError as e:
+        return int(e.status[:3]), await send_error_async(writer, e.status), None, False
+    except Exception as e:
+        print(f"Error: {e}")
+        return 502, await send_error_async(writer, '502 Bad Gateway'), None, False
+    first_byte_at = time.perf_counter()
+    try:
+        nbytes, persist, _ = await relay_response_async(upstream, writer, host, port, method,
+                                                        status, reason, response_headers, persist)
+    except Exception as e:
+        print(f"Error: {e}")
+        return status, 0, first_byte_at, False
+    return status, nbytes, first_byte_at, persist
+
+async def relay_connect_async(reader, writer, target):
+    """relay_connect() for an asyncio client connection."""
+    address = split_authority(target)
+    if address is None:
+        return 400, await send_error_async(writer, '400 Bad Request'), None, False
+    try:
+        timeout = ASYNC_UPSTREAM_POOL.connect_timeout
+        sock = await connect_async(await RESOLVER.resolve_async(*address, timeout), timeout)
+        upstream_reader, upstream_writer = await asyncio.open_connection(sock=sock)
+    except (OSError, asyncio.TimeoutError) as e:
+        print(f"Error: {e!r}")
+        return 502, await send_error_async(writer, '502 Bad Gateway'), None, False
+    timing.mark('connect')
+
+    up = down = 0
+    idle = False
+    TUNNEL_STATS.tunnel_opened()
+    try:
+        await write(writer, CONNECTION_ESTABLISHED)
+        first_byte_at = time.perf_counter()
+        up, down, idle = await tunnel_async(reader, writer, upstream_reader, upstream_writer, TUNNEL_IDLE_TIMEOUT)
+    finally:
+        upstream_writer.close()
+        TUNNEL_STATS.tunnel_closed(up, down, idle)
+    print(f"Tunnel to {target} closed{' after idling' if idle else ''}: {up} bytes up, {down} bytes down")
+    return 200, len(CONNECTION_ESTABLISHED) + down, first_byte_at, False
+
+async def open_upstream_async(host, port, request, client=None, length=0, expect_continue=False):
+    """open_upstream() over ASYNC_UPSTREAM_POOL, streaming a request body from the client (reader, writer).
+
+    Returns ((reader, writer), status, reason, headers) for the origin connection.
+    """
+    while True:
+        try:
+            reader, writer, reused = await ASYNC_UPSTREAM_POOL.acquire(host, port)
+        finally:
+            timing.mark('connect')
+        body_started = False
+        try:
+            await write(writer, request)
+            if length:
+                body_started = True
+                client_reader, client_writer = client
+                if expect_continue:
+                    await write(client_writer, CONTINUE)
+                _, complete, _ = await relay_body_async(client_reader, writer, length)
+                if not complete:
+                    raise ConnectionError("client closed the connection part way through the request body")
+            timing.mark('upload')
+            head = await reader.readuntil(b'\r\n\r\n')
+            timing.mark('origin')
+            status, reason, headers = parse_response_head(head)
+        except Exception as e:
+            ASYNC_UPSTREAM_POOL.release(host, port, reader, writer, False)
+            if reused and isinstance(e, (OSError, asyncio.IncompleteReadError)) and not body_started:
+                continue
+            raise
+        return (reader, writer), status, reason, headers
+
+async def relay_response_async(upstream, writer, host, port, method, status, reason, headers, persist, capture_limit=0,
+                               in_flight=None):
+    """relay_response() from an asyncio origin connection to an asyncio client connection."""
+    up_reader, up_writer = upstream
+    length = response_body_length(method, status, headers)
+    # A body that ends when the origin closes can only be passed on the same way
+    persist = persist and length is not None
+    reusable = complete = False
+    try:
+        head = client_response_head(status, reason, headers, persist)
+        await write(writer, head)
+        nbytes, complete, body = await relay_body_async(up_reader, writer, length, capture_limit,
+                                                        in_flight.append if in_flight else None)
+        # Bytes past the end of the body would be taken for the start of the next response
+        reusable = (complete and length is not None and not has_buffered(up_reader)
+                    and keep_alive('HTTP/1.1', headers))
+        return len(head) + nbytes, persist and complete, body
+    finally:
+        ASYNC_UPSTREAM_POOL.release(host, port, up_reader, up_writer, reusable)
+        if in_flight is not None:
+            in_flight.finish(complete)
+
+async def relay_cached_async(writer, url, host, port, path, headers, request_headers, persist):
+    """relay_cached() for an asyncio client connection."""
+    entry = await cache_call(RESPONSE_CACHE.lookup, url, request_headers)
+    timing.mark('cache')
+    if entry is not None and entry.is_fresh(time.time()) and not request_wants_revalidation(request_headers):
+        status, nbytes = await send_cached_async(writer, entry, request_headers, persist)
+        return status, nbytes, time.perf_counter(), persist
+
+    in_flight, leading = ASYNC_COALESCER.join(url, request_headers)
+    if not leading:
+        started = await in_flight.wait_started_async()
+        timing.mark('coalesce')
+        if started and in_flight.matches(request_headers):
+            return await send_in_flight_async(writer, in_flight, request_headers, persist)
+        ASYNC_COALESCER.fallback()
+        in_flight = None  # Fetch for this request alone
+    try:
+        return await fetch_cached_async(writer, url, host, port, path, headers, request_headers, persist,
+                                        entry, in_flight)
+    finally:
+        if leading:
+            in_flight.abandon()
+            ASYNC_COALESCER.leave(url, in_flight)
+
+async def fetch_cached_async(writer, url, host, port, path, headers, request_headers, persist, entry, in_flight):
+    """fetch_cached() for an asyncio client connection."""
+    request = forward_request('GET', path, headers, 0, entry.conditional_headers() if entry else ())
+    try:
+        upstream, status, reason, response_headers = await open_upstream_async(host, port, request)
+    except Exception as e:
+        print(f"Error: {e}")
+        return 502, await send_error_async(writer, '502 Bad Gateway'), None, False
+    first_byte_at = time.perf_counter()
+    age = header_value(response_headers, 'age')
+    age = int(age) if age and age.isdigit() else 0
+
+    if status == 304 and entry is not None:
+        # Our revalidation succeeded: the client gets the cached copy, not this 304
+        ASYNC_UPSTREAM_POOL.release(host, port, *upstream,
+                                    keep_alive('HTTP/1.1', response_headers) and not has_buffered(upstream[0]))
+        entry = await cache_call(RESPONSE_CACHE.refresh, entry, response_headers, age)
+        if in_flight is not None:
+            in_flight.serve_entry(entry)
+        status, nbytes = await send_cached_async(writer, entry, request_headers, persist)
+        return status, nbytes, first_byte_at, persist
+
+    vary = vary_values(response_headers, request_headers)
+    if in_flight is not None:
+        if shareable(url, status, reason, response_headers, vary):
+            in_flight.start(status, reason, response_headers)
+        else:
+            in_flight.abandon()
+            in_flight = None
+    try:
+        nbytes, persist, body = await relay_response_async(upstream, writer, host, port, 'GET', status, reason,
+                                                           response_headers, persist, CACHE_MAX_OBJECT_SIZE,
+                                                           in_flight)
+    except Exception as e:
+        print(f"Error: {e}")
+        return status, 0, first_byte_at, False
+    if body is not None:
+        await cache_call(RESPONSE_CACHE.store,
+                         CachedResponse(url, status, reason, response_headers, body, vary, time.time(), age))
+    elif entry is not None:
+        await cache_call(RESPONSE_CACHE.remove, url)
+    return status, nbytes, first_byte_at, persist
+
+async def send_cached_async(writer, entry, request_headers, persist):
+    """send_cached() for an asyncio client connection."""
+    not_modified = entry.not_modified_for(request_headers)
+    data = entry.response_head(time.time(), not_modified, persist)
+    if not not_modified:
+        data += entry.body
+    await write(writer, data)
+    return (304 if not_modified else entry.status), len(data)
+
+async def send_in_flight_async(writer, in_flight, request_headers, persist):
+    """send_in_flight() for an asyncio client connection; each piece waits for the client to drain."""
+    if in_flight.entry is not None:
+        status, nbytes = await send_cached_async(writer, in_flight.entry, request_headers, persist)
+        return status, nbytes, time.perf_counter(), persist
+    length = response_body_length('GET', in_flight.status, in_flight.headers)
+    persist = persist and length is not None
+    head = client_response_head(in_flight.status, in_flight.reason, in_flight.headers, persist)
+    await write(writer, head)
+    first_byte_at = time.perf_counter()
+    nbytes = len(head)
+    async for piece in in_flight.pieces_async():
+        await write(writer, piece)
+        nbytes += len(piece)
+    return in_flight.status, nbytes, first_byte_at, persist and in_flight.complete
+
+async def drain_async_clients(server):
+    """Stops accepting, closes idle client connections and gives busy ones SHUTDOWN_TIMEOUT to finish."""
+    global SHUTTING_DOWN
+    SHUTTING_DOWN = True
+    server.close()
+    busy = 0
+    for task, idle in list(ASYNC_CLIENTS.items()):
+        if idle:
+            task.cancel()
+        else:
+            busy += 1
+    if busy:
+        print(f"Waiting for {busy} connections to finish ...")
+    if ASYNC_CLIENTS:
+        _, pending = await asyncio.wait(list(ASYNC_CLIENTS), timeout=SHUTDOWN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    ASYNC_UPSTREAM_POOL.close_all()
+
+async def run_async_proxy(host, port):
+    global ASYNC_UPSTREAM_POOL, ASYNC_COALESCER
+    ASYNC_UPSTREAM_POOL = AsyncUpstreamPool(UPSTREAM_POOL.max_per_host, UPSTREAM_POOL.idle_timeout,
+                                            limit=MAX_RESPONSE_HEAD, resolver=RESOLVER)
+    METRICS.add_source('upstream_pool', ASYNC_UPSTREAM_POOL.stats)
+    ASYNC_COALESCER = Coalescer(AsyncInFlightResponse, CACHE_MAX_OBJECT_SIZE)
+    METRICS.add_source('coalesce', ASYNC_COALESCER.stats)
+    server = await asyncio.start_server(handle_client_async, host, port, limit=MAX_REQUEST_HEAD,
+                                        backlog=LISTEN_BACKLOG, reuse_address=True)
+    print(f"Proxy server listening on {host}:{port} (asyncio)")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+    print("Shutting down the proxy.")
+    await drain_async_clients(server)
+    RESOLVER.close()
+
+def start_async_proxy_server(host='127.0.0.1', port=8888):
+    """Relays every client connection from one asyncio event loop instead of a thread each."""
+    asyncio.run(run_async_proxy(host, port))
+
 if __name__ == '__main__':
-    start_proxy_server()
+    parser = argparse.ArgumentParser(description='Simple HTTP forward proxy')
+    parser.add_argument('--mode', choices=('asyncio', 'thread'), default='asyncio',
+                        help='relay every connection from one asyncio event loop, or with one thread each')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help='client connections relayed at once in asyncio mode; beyond this they get a 503')
+    parser.add_argument('--metrics', action='store_true',
+                        help=f'answer {METRICS_PATH} requests made directly to the proxy with runtime metrics')
+    parser.add_argument('--cache-mb', type=int, default=CACHE_MAX_BYTES // (1024 * 1024),
+                        help='memory budget for cached GET responses in MB (0 disables the cache)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory for a disk tier holding responses evicted from memory')
+    parser.add_argument('--cache-disk-mb', type=int, default=512,
+                        help='size limit of the disk tier in MB')
+    parser.add_argument('--upstream-per-host', type=int, default=UPSTREAM_MAX_PER_HOST,
+                        help='most connections kept to one origin, idle or in use')
+    parser.add_argument('--upstream-idle', type=float, default=UPSTREAM_IDLE_TIMEOUT,
+                        help='seconds an idle origin connection is kept for reuse')
+    parser.add_argument('--tunnel-idle', type=float, default=TUNNEL_IDLE_TIMEOUT,
+                        help='seconds a CONNECT tunnel may go without traffic before it is closed')
+    parser.add_argument('--dns-ttl', type=float, default=DNS_TTL,
+                        help='seconds a resolved origin address is reused before it is looked up again')
+    parser.add_argument('--slow-ms', type=float, default=SLOW_REQUEST_MS,
+                        help='print how long each phase (parse, cache, connect, upload, origin, relay) of a request slower than this took')
+    parser.add_argument('--profile-sample', type=float, default=PROFILE_SAMPLE_RATE,
+                        help='fraction of client connections (0-1) to run under cProfile in thread mode; SIGUSR1 writes the aggregated stats')
+    parser.add_argument('--profile-out', default=PROFILE_PATH,
+                        help='file the aggregated profile is written to; {pid} is replaced by the process id')
+    args = parser.parse_args()
+    METRICS_ENABLED = args.metrics
+    MAX_CONNECTIONS = args.max_connections
+    TUNNEL_IDLE_TIMEOUT = args.tunnel_idle
+    RESOLVER.ttl = args.dns_ttl
+    UPSTREAM_POOL.max_per_host = args.upstream_per_host
+    UPSTREAM_POOL.idle_timeout = args.upstream_idle
+    if args.cache_mb > 0:
+        RESPONSE_CACHE = ResponseCache(args.cache_mb * 1024 * 1024, CACHE_MAX_OBJECT_SIZE,
+                                       disk_dir=args.cache_dir, disk_max_bytes=args.cache_disk_mb * 1024 * 1024)
+        METRICS.add_source('proxy_cache', RESPONSE_CACHE.stats)
+    if METRICS_ENABLED:
+        timing.add_hook(PHASE_STATS)
+        METRICS.add_source('phase', PHASE_STATS.stats)
+    if args.slow_ms > 0:
+        timing.add_hook(timing.slow_request_logger(args.slow_ms, print))
+    PROFILER.rate = args.profile_sample
+    PROFILE_PATH = args.profile_out.format(pid=os.getpid())
+    if args.mode == 'asyncio':
+        if PROFILER.rate > 0:
+            # One profile per thread can't tell the tasks of one event loop apart
+            print("--profile-sample only applies to --mode thread; not profiling")
+        start_async_proxy_server()
+    else:
+        if PROFILER.rate > 0:
+            signal.signal(signal.SIGUSR1, lambda signum, frame: print(PROFILER.dump(PROFILE_PATH)))
+        try:
+            start_proxy_server()
+        finally:
+            if PROFILER.rate > 0:
+                print(PROFILER.dump(PROFILE_PATH))
@@ -0,0 +1,347 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import email.utils
+from collections import OrderedDict
+from http_stream import HOP_BY_HOP, header_value
+
+# Statuses that may be stored without the origin saying so explicitly
+CACHEABLE_STATUSES = {200, 203, 300, 301, 404, 410}
+# Without Cache-Control or Expires, a response stays fresh for this fraction of the
+# time since its Last-Modified, up to HEURISTIC_MAX_AGE seconds
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX_AGE = 3600
+
+def parse_http_date(value):
+    """Parses an HTTP-date into a timestamp, or None if it isn't one."""
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def parse_cache_control(value):
+    """Parses a Cache-Control header into a dict of lowercase directive -> argument (or None)."""
+    directives = {}
+    for item in (value or '').split(','):
+        name, _, arg = item.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else None
+    return directives
+
+def request_allows_cache(request_headers):
+    """Whether a request (lowercase header dict) may be answered from or stored in a shared cache."""
+    if 'authorization' in request_headers:
+        return False
+    return 'no-store' not in parse_cache_control(request_headers.get('cache-control'))
+
+def request_wants_revalidation(request_headers):
+    """Whether the client asked for the cached copy to be checked with the origin first."""
+    cc = parse_cache_control(request_headers.get('cache-control'))
+    if 'no-cache' in cc or cc.get('max-age') == '0':
+        return True
+    return request_headers.get('pragma', '').lower() == 'no-cache'
+
+class CachedResponse:
+    """One stored origin response for an absolute URL.
+
+    Freshness is worked out from Cache-Control, then Expires, then a
+    Last-Modified heuristic; a stale entry is revalidated with its
+    Last-Modified and ETag. `vary` holds the request header values the
+    response was selected by, as named in its Vary header.
+    """
+    __slots__ = ('url', 'status', 'reason', 'headers', 'body', 'vary',
+                 'stored_at', 'initial_age', 'lifetime', 'size')
+
+    def __init__(self, url, status, reason, headers, body, vary, stored_at, initial_age=0):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.vary = vary
+        self.headers = []
+        self.update(headers, stored_at, initial_age)
+
+    def update(self, headers, stored_at, initial_age=0):
+        """Merges in headers from the origin (a full response or a 304) and restarts the entry's age."""
+        replaced = {name.lower() for name, _ in headers}
+        kept = [(name, value) for name, value in self.headers if name.lower() not in replaced]
+        self.headers = kept + [(name, value) for name, value in headers
+                               if name.lower() not in HOP_BY_HOP and name.lower() not in ('age', 'content-length')]
+        self.stored_at = stored_at
+        self.initial_age = initial_age
+        self.lifetime = self._lifetime()
+        self.size = len(self.body) + sum(len(name) + len(value) + 4 for name, value in self.headers)
+
+    def _lifetime(self):
+        cc = parse_cache_control(self.get('cache-control'))
+        if 'no-cache' in cc:
+            return 0
+        for directive in ('s-maxage', 'max-age'):
+            if directive in cc:
+                try:
+                    return max(0, int(cc[directive]))
+                except (TypeError, ValueError):
+                    return 0
+        date = parse_http_date(self.get('date')) or self.stored_at
+        expires = self.get('expires')
+        if expires is not None:
+            expires_at = parse_http_date(expires)
+            return max(0, expires_at - date) if expires_at is not None else 0
+        last_modified = parse_http_date(self.get('last-modified'))
+        if last_modified is not None:
+            return min(HEURISTIC_MAX_AGE, max(0, date - last_modified) * HEURISTIC_FRACTION)
+        return 0
+
+    def get(self, name):
+        return header_value(self.headers, name)
+
+    def storable(self):
+        cc = parse_cache_control(self.get('cache-control'))
+        if self.status not in CACHEABLE_STATUSES or 'no-store' in cc or 'private' in cc:
+            return False
+        if (self.get('vary') or '').strip() == '*':
+            return False
+        # An entry that is never fresh is only useful if it can be revalidated
+        return self.lifetime > 0 or self.get('last-modified') is not None or self.get('etag') is not None
+
+    def age(self, now):
+        return self.initial_age + max(0, now - self.stored_at)
+
+    def is_fresh(self, now):
+        return self.age(now) < self.lifetime
+
+    def matches(self, request_headers):
+        """Whether this entry was selected by the same Vary header values as the request."""
+        return all(request_headers.get(name) == value for name, value in self.vary.items())
+
+    def conditional_headers(self):
+        """Validators to send the origin when revalidating this entry."""
+        headers = []
+        last_modified = self.get('last-modified')
+        if last_modified is not None:
+            headers.append(('If-Modified-Since', last_modified))
+        etag = self.get('etag')
+        if etag is not None:
+            headers.append(('If-None-Match', etag))
+        return headers
+
+    def not_modified_for(self, request_headers):
+        """Whether the client's own conditional headers allow a 304 for this entry."""
+        if self.status != 200:
+            return False
+        etag = self.get('etag')
+        if_none_match = request_headers.get('if-none-match')
+        if if_none_match is not None:
+            return etag is not None and (if_none_match.strip() == '*' or
+                                         etag in (tag.strip() for tag in if_none_match.split(',')))
+        since = parse_http_date(request_headers.get('if-modified-since'))
+        modified = parse_http_date(self.get('last-modified'))
+        return since is not None and modified is not None and modified <= since
+
+    def response_head(self, now, not_modified=False, keep_alive=False):
+        """Builds the header block for replaying this entry to a client, ending in a blank line."""
+        if not_modified:
+            lines = ['HTTP/1.1 304 Not Modified']
+            headers = [(name, value) for name, value in self.headers
+                       if name.lower() not in ('content-type', 'content-encoding')]
+        else:
+            lines = [f'HTTP/1.1 {self.status} {self.reason}']
+            headers = self.headers + [('Content-Length', str(len(self.body)))]
+        lines += [f'{name}: {value}' for name, value in headers]
+        lines.append(f'Age: {int(self.age(now))}')
+        lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1')
+
+    def to_bytes(self):
+        meta = {
+            'url': self.url, 'status': self.status, 'reason': self.reason, 'headers': self.headers,
+            'vary': self.vary, 'stored_at': self.stored_at, 'initial_age': self.initial_age,
+        }
+        return json.dumps(meta).encode() + b'\n' + self.body
+
+    @classmethod
+    def from_bytes(cls, data):
+        meta, _, body = data.partition(b'\n')
+        meta = json.loads(meta)
+        return cls(meta['url'], meta['status'], meta['reason'], [tuple(h) for h in meta['headers']],
+                   body, meta['vary'], meta['stored_at'], meta['initial_age'])
+
+class ResponseCache:
+    """LRU cache of origin responses keyed by absolute URL, with a byte budget.
+
+    Entries pushed out of memory are written to `disk_dir` when one is given,
+    bounded by `disk_max_bytes`, and brought back into memory on their next
+    hit; an entry lives in only one of the two tiers at a time.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_object_size=8 * 1024 * 1024, max_entries=4096,
+                 disk_dir=None, disk_max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # url -> CachedResponse
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_entries = OrderedDict()  # file name -> size, oldest first
+        self.disk_bytes = 0
+        self.disk_hits = 0
+        self.disk_lock = threading.Lock()
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            # Pick up what an earlier run left behind, oldest first
+            files = [e for e in os.scandir(disk_dir) if e.is_file() and e.name.endswith('.cache')]
+            for e in sorted(files, key=lambda e: e.stat().st_mtime):
+                self.disk_entries[e.name] = e.stat().st_size
+                self.disk_bytes += e.stat().st_size
+
+    def lookup(self, url, request_headers):
+        """Returns the stored response for url if it matches the request, fresh or not, else None."""
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+        if entry is None and self.disk_dir is not None:
+            entry = self._load(url)
+            if entry is not None:
+                self.store(entry)
+        with self.lock:
+            if entry is None or not entry.matches(request_headers):
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry
+
+    def store(self, entry):
+        """Adds or replaces the entry for its URL; returns False if it can't be cached."""
+        if entry.size > self.max_object_size or entry.size > self.max_bytes or not entry.storable():
+            self.remove(entry.url)
+            return False
+        with self.lock:
+            old = self.entries.pop(entry.url, None)
+            if old is not None:
+                self.current_bytes -= old.size
+            self.entries[entry.url] = entry
+            self.current_bytes += entry.size
+            evicted = self._evict()
+        for old in evicted:
+            self._spill(old)
+        return True
+
+    def refresh(self, entry, headers, initial_age=0):
+        """Applies a 304 from the origin to a stale entry; returns the fresh entry that replaces it.
+
+        The stored entry is left as it is, so its size still matches what
+        current_bytes counted for it and requests reading it meanwhile never
+        see it half updated.
+        """
+        with self.lock:
+            self.revalidations += 1
+        fresh = CachedResponse(entry.url, entry.status, entry.reason, entry.headers, entry.body, entry.vary,
+                               entry.stored_at, entry.initial_age)
+        fresh.update(headers, time.time(), initial_age)
+        self.store(fresh)
+        return fresh
+
+    def remove(self, url):
+        with self.lock:
+            old = self.entries.pop(url, None)
+            if old is not None:
+                self.current_bytes -= old.size
+        if self.disk_dir is not None:
+            self._unlink(self._file_name(url))
+
+    def _evict(self):
+        # Called with the lock held; returns the least recently used entries removed to get within budget
+        evicted = []
+        while self.entries and (self.current_bytes > self.max_bytes or len(self.entries) > self.max_entries):
+            _, old = self.entries.popitem(last=False)
+            self.current_bytes -= old.size
+            self.evictions += 1
+            evicted.append(old)
+        return evicted
+
+    def _file_name(self, url):
+        return hashlib.sha256(url.encode()).hexdigest() + '.cache'
+
+    def _spill(self, entry):
+        if self.disk_dir is None or entry.size > self.disk_max_bytes:
+            return
+        name = self._file_name(entry.url)
+        data = entry.to_bytes()
+        path = os.path.join(self.disk_dir, name)
+        tmp = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        with self.disk_lock:
+            self.disk_bytes += len(data) - self.disk_entries.pop(name, 0)
+            self.disk_entries[name] = len(data)
+            stale = []
+            while self.disk_bytes > self.disk_max_bytes:
+                old_name, old_size = self.disk_entries.popitem(last=False)
+                self.disk_bytes -= old_size
+                stale.append(old_name)
+        for old_name in stale:
+            try:
+                os.unlink(os.path.join(self.disk_dir, old_name))
+            except OSError:
+                pass
+
+    def _load(self, url):
+        name = self._file_name(url)
+        with self.disk_lock:
+            if name not in self.disk_entries:
+                return None
+        try:
+            with open(os.path.join(self.disk_dir, name), 'rb') as f:
+                entry = CachedResponse.from_bytes(f.read())
+        except (OSError, ValueError, KeyError):
+            entry = None
+        # Promoted to memory (or unreadable); either way the file is no longer needed
+        self._unlink(name)
+        if entry is None or entry.url != url:
+            return None
+        with self.disk_lock:
+            self.disk_hits += 1
+        return entry
+
+    def _unlink(self, name):
+        with self.disk_lock:
+            size = self.disk_entries.pop(name, None)
+            if size is None:
+                return
+            self.disk_bytes -= size
+        try:
+            os.unlink(os.path.join(self.disk_dir, name))
+        except OSError:
+            pass
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            stats = {
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+        if self.disk_dir is not None:
+            with self.disk_lock:
+                stats['disk_entries'] = len(self.disk_entries)
+                stats['disk_bytes'] = self.disk_bytes
+                stats['disk_hits'] = self.disk_hits
+        return stats
@@ -0,0 +1,169 @@
+import asyncio
+import concurrent.futures
+import ipaddress
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+def getaddrinfo_resolver(host, port):
+    """Default resolve function: the system resolver, TCP addresses only."""
+    return socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+
+def lookup_error(error):
+    """A new socket.gaierror for a failure cached as (errno, message)."""
+    errno, message = error
+    return socket.gaierror(errno, message) if errno is not None else socket.gaierror(message)
+
+class ResolverCache:
+    """Cache of upstream host lookups with TTLs, a size bound and negative caching.
+
+    Lookups run on a small dedicated thread pool, never on the caller's
+    thread or the event loop. They call the `resolve` function given, which
+    defaults to getaddrinfo(). A stub can be passed instead to test the
+    cache without DNS: any callable taking (host, port) that returns
+    getaddrinfo-style tuples or raises socket.gaierror.
+
+    getaddrinfo() reports no record TTLs, so every answer is kept for `ttl`
+    seconds and every failure for `negative_ttl`. A failure is kept as its
+    errno and message, and each caller gets a socket.gaierror of its own.
+    Concurrent lookups of the same name share one resolution.
+    """
+    def __init__(self, resolve=getaddrinfo_resolver, ttl=60, negative_ttl=5, max_entries=1024, workers=4):
+        self.resolve_fn = resolve
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='resolver')
+        self.entries = OrderedDict()  # (host, port) -> (expires_at, addresses, (errno, message) of a failure or None)
+        self.inflight = {}  # (host, port) -> Futures waiting for the lookup in progress
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.shared = 0  # Lookups that joined one already in progress
+        self.failures = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, host, port):
+        """Returns a concurrent.futures.Future for the addresses of (host, port)."""
+        future = concurrent.futures.Future()
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            pass
+        else:
+            # Literal addresses need no lookup (or a thread) at all
+            future.set_result(socket.getaddrinfo(host, port, type=socket.SOCK_STREAM, flags=socket.AI_NUMERICHOST))
+            return future
+
+        key = (host, port)
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                expires_at, addresses, error = cached
+                if time.monotonic() < expires_at:
+                    self.entries.move_to_end(key)
+                    if error is not None:
+                        self.negative_hits += 1
+                        future.set_exception(lookup_error(error))
+                    else:
+                        self.hits += 1
+                        future.set_result(addresses)
+                    return future
+                del self.entries[key]
+            inflight = self.inflight.get(key)
+            if inflight is not None:
+                self.shared += 1
+                inflight.append(future)
+                return future
+            self.misses += 1
+            self.inflight[key] = [future]
+
+        self.executor.submit(self._resolve, key)
+        return future
+
+    def _resolve(self, key):
+        addresses = error = None
+        try:
+            addresses = self.resolve_fn(*key)
+            ttl = self.ttl
+        except Exception as e:
+            # Keep no exception object: one raised in many threads would collect all their tracebacks
+            error = (e.errno, e.strerror) if isinstance(e, OSError) and e.errno is not None else (None, str(e))
+            ttl = self.negative_ttl
+        with self.lock:
+            waiters = self.inflight.pop(key)
+            if error is not None:
+                self.failures += 1
+            if ttl > 0:
+                self.entries[key] = (time.monotonic() + ttl, addresses, error)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        for waiter in waiters:
+            if not waiter.set_running_or_notify_cancel():
+                continue  # Its caller timed out and cancelled it
+            if error is not None:
+                waiter.set_exception(lookup_error(error))
+            else:
+                waiter.set_result(addresses)
+
+    def resolve(self, host, port, timeout=None):
+        """Blocks until (host, port) is resolved; returns getaddrinfo-style tuples."""
+        return self.lookup(host, port).result(timeout)
+
+    async def resolve_async(self, host, port, timeout=None):
+        """resolve() for coroutines: waits without blocking the event loop."""
+        return await asyncio.wait_for(asyncio.wrap_future(self.lookup(host, port)), timeout)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'shared': self.shared,
+                'failures': self.failures,
+                'evictions': self.evictions,
+            }
+
+def connect(addresses, timeout):
+    """Connects to the first of the resolved addresses that accepts, like socket.create_connection().
+
+    Nagle's algorithm is turned off, as asyncio does for its own sockets: a
+    request header and the start of its body go out as separate writes, and
+    the second must not wait for the first to be acknowledged.
+    """
+    error = None
+    for family, type_, proto, _, sockaddr in addresses:
+        sock = socket.socket(family, type_, proto)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(sockaddr)
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error or OSError("no addresses to connect to")
+
+async def connect_async(addresses, timeout):
+    """connect() for coroutines; returns a connected non-blocking socket."""
+    loop = asyncio.get_running_loop()
+    error = None
+    for family, type_, proto, _, sockaddr in addresses:
+        sock = socket.socket(family, type_, proto)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, sockaddr), timeout)
+            return sock
+        except (OSError, asyncio.TimeoutError) as e:
+            sock.close()
+            error = e
+    raise error or OSError("no addresses to connect to")
@@ -1,189 +1,582 @@
 import socket
 import os
 import datetime
-import mimetypes
 from email.utils import parsedate_to_datetime
 import threading
+import selectors
+import collections
+import concurrent.futures
+import queue
+import mmap
+import argparse
+import signal
 import logging
 import time
+from file_cache import FileCache
+from content_encoding import VariantCache, negotiate
+from http_parser import HTTPRequestParser, HTTPParseError, parse_byte_ranges
+import workers
+import access_log
+from access_log import AccessRecord
+from metrics import Metrics
+from profiler import SampledProfiler
+import timing
+from mux import MUX_PREFACE, MuxSession, MuxError
 
 # Configuration
 HOST, PORT = '', 8080
 BUFFER_SIZE = 4096
+SERVE_MODE = 'thread'  # 'thread' (one thread per connection) or 'event' (single selectors loop)
+TRANSFER_MODE = 'sendfile'  # 'sendfile' (Content-Length + zero-copy) or 'hol-demo' (interleaved chunks with delay)
+HOL_CHUNK_SIZE = 4096
+HOL_CHUNK_DELAY = 0.005
+DEBUG_SAMPLE_RATE = 0.0  # Fraction of requests logged in full detail at DEBUG level
+METRICS_ENABLED = False  # Serve METRICS_PATH (opt-in)
+METRICS_PATH = '/__metrics'
+SLOW_REQUEST_MS = 0  # Log the phase timings of requests slower than this (0: off)
+PROFILE_SAMPLE_RATE = 0.0  # Fraction of connections run under cProfile
+PROFILE_PATH = 'server-{pid}.prof'  # Where SIGUSR1 (and shutdown) writes the aggregated profile
+MAX_CONNECTIONS = 256  # Concurrent connections per process; more are answered with 503
+KEEPALIVE_TIMEOUT = 15  # Seconds an idle keep-alive connection is kept open
+HEADER_READ_TIMEOUT = 10  # Seconds a client has to send a complete request once it starts one
+SEND_TIMEOUT = 30  # Seconds a write may stall before the connection is dropped
+SHED_LINGER = 1.0  # Seconds a shed connection's request is read and discarded before the socket is closed
+MAX_REQUESTS_PER_CONNECTION = 100
+CACHE_MAX_BYTES = 64 * 1024 * 1024  # Budget for cached file bodies
+CACHE_MAX_FILE_SIZE = 1024 * 1024  # Larger files are served from disk with sendfile()
+VARIANT_CACHE_MAX_BYTES = 16 * 1024 * 1024  # Budget for gzip/deflate variants of cached files
+
+CONNECTION_KEEP_ALIVE = b'Connection: keep-alive\r\n\r\n'
+CONNECTION_CLOSE = b'Connection: close\r\n\r\n'
+SERVICE_UNAVAILABLE = b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+MULTIPART_BOUNDARY = os.urandom(12).hex()
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def format_http_date(timestamp):
-    """Formats a timestamp into an HTTP-date string."""
-    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc).strftime('%a, %d %b %Y %H:%M:%S GMT')
+# Set once the server stops accepting, so connections close after their current response
+SHUTTING_DOWN = threading.Event()
 
-def handle_client(client_connection, client_address):
+# Static file cache shared by every connection
+FILE_CACHE = FileCache(CACHE_MAX_BYTES, CACHE_MAX_FILE_SIZE)
+VARIANT_CACHE = VariantCache(VARIANT_CACHE_MAX_BYTES)
+
+# Runtime metrics for this process, exposed at METRICS_PATH when enabled
+METRICS = Metrics()
+METRICS.add_source('file_cache', FILE_CACHE.stats)
+METRICS.add_source('variant_cache', VARIANT_CACHE.stats)
+
+# Per-phase latency histograms, fed by timing hooks once main() enables them
+PHASE_STATS = timing.PhaseStats()
+
+# cProfile of sampled connections, dumped on SIGUSR1
+PROFILER = SampledProfiler()
+
+# Shed connections whose 503 has been sent, waiting to be drained and closed off the accept path
+SHED_QUEUE = queue.SimpleQueue()
+SHED_DRAINER = None  # Thread running drain_shed_connections(), started by the first shed connection
+
+class FileSlice:
+    """A byte range of a file on disk, sent with sendfile() instead of being read into memory."""
+    __slots__ = ('path', 'offset', 'count', 'file', 'mapping', 'borrowed')
+
+    def __init__(self, path, offset, count):
+        self.path = path
+        self.offset = offset
+        self.count = count
+        self.file = None  # Opened lazily by the event loop, which sends a slice across several writes
+        self.mapping = None  # mmap of the file, used where os.sendfile() is unavailable
+        self.borrowed = False  # file belongs to the slice this one was taken from
+
+    def take(self, n):
+        """Splits the first n bytes off into a slice of their own, sharing this slice's open file."""
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+        part = FileSlice(self.path, self.offset, min(n, self.count))
+        part.file = self.file
+        part.borrowed = True
+        self.offset += part.count
+        self.count -= part.count
+        return part
+
+    def close(self):
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+        if self.file is not None and not self.borrowed:
+            self.file.close()
+        self.file = None
+
+class Response:
+    """A response ready to be written: the encoded header block plus its body.
+
+    `parts` is a list of bytes and FileSlice objects sent in order after the
+    header. In the HOL demo transfer mode the file content is kept in `content`
+    instead, so the caller decides how to frame it (interleaved chunks with a
+    delay in the threaded server, one pre-encoded chunked body in the event loop).
+    """
+    def __init__(self, header, parts=(), keep_alive=False, content=None):
+        self.header = header
+        self.parts = list(parts)
+        self.keep_alive = keep_alive
+        self.content = content
+
+    def status(self):
+        return int(self.header[9:12])
+
+    def length(self):
+        """Bytes on the wire for this response (the entity size for HOL demo content)."""
+        length = len(self.header)
+        for part in self.parts:
+            length += part.count if isinstance(part, FileSlice) else len(part)
+        if self.content is not None:
+            length += len(self.content)
+        return length
+
+def error_response(status, message):
+    """Builds an HTML error response that closes the connection."""
+    header = f'HTTP/1.1 {status}\r\nContent-Type: text/html\r\nConnection: close\r\n\r\n'
+    return Response(header.encode(), [message.encode()])
+
+def encode_chunked(content, chunk_size=4096):
+    """Encodes content with chunked transfer encoding, including the terminating chunk."""
+    parts = []
+    for i in range(0, len(content), chunk_size):
+        chunk = content[i:i+chunk_size]
+        parts.append(f"{len(chunk):X}\r\n".encode())
+        parts.append(chunk)
+        parts.append(b"\r\n")
+    parts.append(b"0\r\n\r\n")
+    return b''.join(parts)
+
+def metrics_response(keep_alive):
+    """Builds the generated metrics page, sent with chunked transfer encoding."""
+    header = (
+        'HTTP/1.1 200 OK\r\n'
+        'Content-Type: text/plain; version=0.0.4\r\n'
+        'Cache-Control: no-store\r\n'
+        'Transfer-Encoding: chunked\r\n'
+    )
+    connection_line = CONNECTION_KEEP_ALIVE if keep_alive else CONNECTION_CLOSE
+    return Response(header.encode() + connection_line, [encode_chunked(METRICS.render().encode())], keep_alive=keep_alive)
+
+def if_range_matches(value, entry):
+    """Whether an If-Range validator (absent, a strong ETag or an HTTP-date) still matches the file."""
+    if value is None:
+        return True
+    if value.startswith('"'):
+        return value == entry.etag
+    return value == entry.last_modified
+
+def entry_slice(entry, start, end):
+    """Returns bytes start..end (inclusive) of a cached file without copying them."""
+    if entry.body is not None:
+        return memoryview(entry.body)[start:end + 1]
+    return FileSlice(entry.path, start, end - start + 1)
+
+def range_response(entry, ranges, connection_line, keep_alive):
+    """Builds a 206 response for one range, or a multipart/byteranges response for several."""
+    common = (
+        f'Last-Modified: {entry.last_modified}\r\n'
+        f'ETag: {entry.etag}\r\n'
+        'Accept-Ranges: bytes\r\n'
+    )
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        header = (
+            'HTTP/1.1 206 Partial Content\r\n'
+            f'Content-Type: {entry.content_type}\r\n'
+            f'Content-Range: bytes {start}-{end}/{entry.size}\r\n'
+            f'Content-Length: {end - start + 1}\r\n'
+            + common
+        )
+        return Response(header.encode() + connection_line, [entry_slice(entry, start, end)], keep_alive=keep_alive)
+
+    parts = []
+    length = 0
+    for start, end in ranges:
+        part_header = (
+            f'\r\n--{MULTIPART_BOUNDARY}\r\n'
+            f'Content-Type: {entry.content_type}\r\n'
+            f'Content-Range: bytes {start}-{end}/{entry.size}\r\n'
+            '\r\n'
+        ).encode()
+        parts.append(part_header)
+        parts.append(entry_slice(entry, start, end))
+        length += len(part_header) + end - start + 1
+    closing = f'\r\n--{MULTIPART_BOUNDARY}--\r\n'.encode()
+    parts.append(closing)
+    length += len(closing)
+
+    header = (
+        'HTTP/1.1 206 Partial Content\r\n'
+        f'Content-Type: multipart/byteranges; boundary={MULTIPART_BOUNDARY}\r\n'
+        f'Content-Length: {length}\r\n'
+        + common
+    )
+    return Response(header.encode() + connection_line, parts, keep_alive=keep_alive)
+
+def process_request(request, client_address, allow_keep_alive=True):
+    """Runs one parsed request through the 400/501/404/304/200 checks and returns the Response to send."""
+    debug_log = access_log.request_debug_log()
+    debug_log("Received request from %s:\n%s", client_address, request.head)
+    method, path, version = request.method, request.path, request.version
+
+    # Only support HTTP/1.1 or HTTP/1.0
+    if version not in ['HTTP/1.1', 'HTTP/1.0']:
+        debug_log("Unsupported HTTP version from %s: %s", client_address, version)
+        return error_response('400 Bad Request', "<h1>400 Bad Request</h1>")
+
+    # Only support GET method
+    if method.upper() != 'GET':
+        debug_log("Unsupported method from %s: %s", client_address, method)
+        return error_response('501 Not Implemented', f"<h1>501 Not Implemented</h1><p>The method {method} is not supported.</p>")
+
+    if METRICS_ENABLED and path == METRICS_PATH:
+        return metrics_response(allow_keep_alive and request.keep_alive())
+
+    # Handle the root ("/") request as an index file
+    if path == "/":
+        path = "/index.html"
+
+    # Remove the leading slash ("/") from the filename
+    filepath = path.lstrip('/')
+
+    # Prevent directory traversal attacks
+    if '..' in filepath or filepath.startswith('/'):
+        logging.warning("Directory traversal attempt from %s: %s", client_address, filepath)
+        return error_response('400 Bad Request', "<h1>400 Bad Request</h1>")
+
+    # Look the file up in the static file cache (one stat() on a hit, no reads)
     try:
-        logging.info(f"Connection established with {client_address}")
-        while True:
-            request = client_connection.recv(BUFFER_SIZE).decode()
-            if not request:
-                logging.info(f"Connection closed by {client_address}")
-                break
-            logging.info(f"Received request from {client_address}:\n{request}")
-
-            # Split request into lines
-            request_lines = request.split('\r\n')
-            request_line = request_lines[0]
-
-            # Parse the request line
-            parts = request_line.split()
-            if len(parts) != 3:
-                # Malformed request line
-                logging.error(f"Malformed request line from {client_address}: {request_line}")
-                header = 'HTTP/1.1 400 Bad Request\r\nContent-Type: text/html\r\nConnection: close\r\n\r\n'
-                error_message = "<h1>400 Bad Request</h1>"
-                client_connection.sendall(header.encode() + error_message.encode())
-                break  # Close connection after bad request
+        entry = FILE_CACHE.lookup(filepath)
+    except IOError as e:
+        logging.error(f"Error reading file {filepath}: {e}")
+        return error_response('500 Internal Server Error', "<h1>500 Internal Server Error</h1>")
+    if entry is None:
+        debug_log("File not found for %s: %s", client_address, filepath)
+        return error_response('404 Not Found', "<h1>404 Not Found</h1>")
+    debug_log("File last modified: %s", entry.last_modified)
 
-            method, path, version = parts
+    # Determine if the client wants to keep the connection alive
+    headers = request.headers
+    keep_alive = allow_keep_alive and request.keep_alive()
+    connection_line = CONNECTION_KEEP_ALIVE if keep_alive else CONNECTION_CLOSE
 
-            # Only support HTTP/1.1 or HTTP/1.0
-            if version not in ['HTTP/1.1', 'HTTP/1.0']:
-                logging.error(f"Unsupported HTTP version from {client_address}: {version}")
-                header = 'HTTP/1.1 400 Bad Request\r\nContent-Type: text/html\r\nConnection: close\r\n\r\n'
-                error_message = "<h1>400 Bad Request</h1>"
-                client_connection.sendall(header.encode() + error_message.encode())
-                break  # Close connection after bad request
+    # Pick a compressed variant if the client accepts one; byte ranges are only served on the identity body
+    representation = entry
+    if entry.compressible and 'range' not in headers and TRANSFER_MODE != 'hol-demo':
+        encoding = negotiate(headers.get('accept-encoding'))
+        if encoding is not None:
+            variant = VARIANT_CACHE.get(entry, encoding)
+            if variant is not None:
+                representation = variant
+            timing.mark('encode')
 
-            # Only support GET method
-            if method.upper() != 'GET':
-                logging.warning(f"Unsupported method from {client_address}: {method}")
-                header = 'HTTP/1.1 501 Not Implemented\r\nContent-Type: text/html\r\nConnection: close\r\n\r\n'
-                error_message = f"<h1>501 Not Implemented</h1><p>The method {method} is not supported.</p>"
-                client_connection.sendall(header.encode() + error_message.encode())
-                break  # Close connection after unsupported method
-
-            # Handle the root ("/") request as an index file
-            if path == "/":
-                path = "/index.html"
-
-            # Remove the leading slash ("/") from the filename
-            filepath = path.lstrip('/')
-
-            # Prevent directory traversal attacks
-            if '..' in filepath or filepath.startswith('/'):
-                logging.error(f"Directory traversal attempt from {client_address}: {filepath}")
-                header = 'HTTP/1.1 400 Bad Request\r\nContent-Type: text/html\r\nConnection: close\r\n\r\n'
-                error_message = "<h1>400 Bad Request</h1>"
-                client_connection.sendall(header.encode() + error_message.encode())
-                break  # Close connection after bad request
+    # If-None-Match takes precedence over If-Modified-Since
+    if 'if-none-match' in headers:
+        tags = [tag.strip() for tag in headers['if-none-match'].split(',')]
+        if representation.etag in tags or '*' in tags:
+            debug_log("ETag %s matches. Sending 304 Not Modified.", representation.etag)
+            return Response(representation.not_modified_prefix + connection_line, keep_alive=keep_alive)
 
-            # Check if the file exists
-            if not os.path.exists(filepath):
-                logging.warning(f"File not found for {client_address}: {filepath}")
-                header = 'HTTP/1.1 404 Not Found\r\nContent-Type: text/html\r\nConnection: close\r\n\r\n'
-                error_message = "<h1>404 Not Found</h1>"
-                client_connection.sendall(header.encode() + error_message.encode())
-                logging.info(f"File not found: {filepath}")
-                break  # Close connection after not found
-
-            # Get file's last modification time
-            file_mtime = os.path.getmtime(filepath)
-            file_last_modified = format_http_date(file_mtime)
-            logging.info(f"File last modified: {file_last_modified}")
-
-            # Parse headers to check for If-Modified-Since
-            headers = {}
-            for line in request_lines[1:]:
-                if line == '':
-                    break
-                if ':' in line:
-                    header_key, header_value = line.split(":", 1)
-                    headers[header_key.strip().lower()] = header_value.strip()
-
-            # Determine if the client wants to keep the connection alive
-            connection_header = headers.get('connection', '').lower()
-            keep_alive = False
-            if version == 'HTTP/1.1':
-                # HTTP/1.1 defaults to keep-alive unless specified otherwise
-                keep_alive = connection_header != 'close'
-            elif version == 'HTTP/1.0':
-                # HTTP/1.0 defaults to close unless keep-alive is specified
-                keep_alive = connection_header == 'keep-alive'
-
-            # Check for If-Modified-Since header
-            if 'if-modified-since' in headers:
-                try:
-                    ims = parsedate_to_datetime(headers['if-modified-since'])
-                    if ims.tzinfo is None:
-                        ims = ims.replace(tzinfo=datetime.timezone.utc)
-                    else:
-                        ims = ims.astimezone(datetime.timezone.utc)
-                    logging.info(f"If-Modified-Since: {ims}")
-
-                    # Convert file_mtime to datetime
-                    file_time = datetime.datetime.fromtimestamp(file_mtime, tz=datetime.timezone.utc)
-                    logging.info(f"File time: {file_time}")
-
-                    # Compare times
-                    if file_time <= ims:
-                        logging.info(f"Not modified since {ims}. Sending 304 Not Modified.")
-                        header = 'HTTP/1.1 304 Not Modified\r\n'
-                        header += f'Last-Modified: {file_last_modified}\r\n'
-                        header += f'Connection: {"keep-alive" if keep_alive else "close"}\r\n'
-                        header += '\r\n'
-                        client_connection.sendall(header.encode())
-                        if not keep_alive:
-                            break  # Close connection if not keep-alive
-                        else:
-                            continue  # Wait for next request
-                    else:
-                        logging.info(f"Modified since {ims}. Sending 200 OK.")
-                except (TypeError, ValueError, OverflowError) as e:
-                    logging.error(f"Error parsing If-Modified-Since header: {e}")
-                    # If the header is malformed, ignore it and proceed
-
-            # Read and send the file content in interleaved chunks (simulating frame-based transmission)
+    # Check for If-Modified-Since header
+    elif 'if-modified-since' in headers:
+        try:
+            ims = parsedate_to_datetime(headers['if-modified-since'])
+            if ims.tzinfo is None:
+                ims = ims.replace(tzinfo=datetime.timezone.utc)
+            else:
+                ims = ims.astimezone(datetime.timezone.utc)
+            debug_log("If-Modified-Since: %s, file time: %s", ims, entry.file_time)
+
+            # Compare times
+            if entry.file_time <= ims:
+                debug_log("Not modified since %s. Sending 304 Not Modified.", ims)
+                return Response(representation.not_modified_prefix + connection_line, keep_alive=keep_alive)
+            else:
+                debug_log("Modified since %s. Sending 200 OK.", ims)
+        except (TypeError, ValueError, OverflowError) as e:
+            debug_log("Error parsing If-Modified-Since header: %s", e)
+            # If the header is malformed, ignore it and proceed
+
+    if TRANSFER_MODE == 'hol-demo':
+        # Read the file content; framing into interleaved chunks is left to the connection handler
+        content = entry.body
+        if content is None:
             try:
                 with open(filepath, 'rb') as f:
                     content = f.read()
-
-                # Determine Content-Type based on file extension using mimetypes
-                content_type, _ = mimetypes.guess_type(filepath)
-                if content_type is None:
-                    content_type = 'application/octet-stream'
-
-                # HTTP response headers with chunked transfer encoding
-                header = 'HTTP/1.1 200 OK\r\n'
-                header += f'Content-Type: {content_type}\r\n'
-                header += 'Transfer-Encoding: chunked\r\n'
-                header += f'Last-Modified: {file_last_modified}\r\n'
-                header += f'Connection: {"keep-alive" if keep_alive else "close"}\r\n'
-                header += '\r\n'
-
-                client_connection.sendall(header.encode())
-
-                # Send the content in interleaved frames (chunks) with artificial delay for simulation
-                chunk_size = 4096  # 4KB chunks
-                for i in range(0, len(content), chunk_size):
-                    chunk = content[i:i+chunk_size]
-                    # Simulate HOL blocking by sending chunks interleaved
-                    client_connection.sendall(f"{len(chunk):X}\r\n".encode())
-                    client_connection.sendall(chunk + b"\r\n")
-                    time.sleep(0.005)  # Simulate small delay to interleave the frame transmission
-
-                # Send the terminating chunk
-                client_connection.sendall(b"0\r\n\r\n")
-                logging.info(f"Sent 200 OK response to {client_address}")
+                timing.mark('read')
             except IOError as e:
                 logging.error(f"Error reading file {filepath}: {e}")
-                header = 'HTTP/1.1 500 Internal Server Error\r\nContent-Type: text/html\r\nConnection: close\r\n\r\n'
-                error_message = "<h1>500 Internal Server Error</h1>"
-                client_connection.sendall(header.encode() + error_message.encode())
-                break  # Close connection after server error
+                return error_response('500 Internal Server Error', "<h1>500 Internal Server Error</h1>")
+
+        # HTTP response headers with chunked transfer encoding
+        header = 'HTTP/1.1 200 OK\r\n'
+        header += f'Content-Type: {entry.content_type}\r\n'
+        header += 'Transfer-Encoding: chunked\r\n'
+        header += f'Last-Modified: {entry.last_modified}\r\n'
+        header += f'Connection: {"keep-alive" if keep_alive else "close"}\r\n'
+        header += '\r\n'
+        return Response(header.encode(), keep_alive=keep_alive, content=content)
+
+    # Serve byte ranges unless If-Range shows the client's partial copy is out of date
+    if 'range' in headers and if_range_matches(headers.get('if-range'), entry):
+        ranges = parse_byte_ranges(headers['range'], entry.size)
+        if ranges == []:
+            debug_log("Unsatisfiable range for %s: %s", client_address, headers['range'])
+            header = (
+                'HTTP/1.1 416 Range Not Satisfiable\r\n'
+                f'Content-Range: bytes */{entry.size}\r\n'
+                'Content-Length: 0\r\n'
+            )
+            return Response(header.encode() + connection_line, keep_alive=keep_alive)
+        if ranges:
+            debug_log("Sending 206 Partial Content for ranges %s", ranges)
+            return range_response(entry, ranges, connection_line, keep_alive)
+
+    if representation.body is not None:
+        # Hot small files are answered from memory in a single write
+        return Response(representation.ok_prefix + connection_line, [representation.body], keep_alive=keep_alive)
+
+    # Larger files go out with an exact Content-Length and are sent with sendfile()
+    return Response(representation.ok_prefix + connection_line, [FileSlice(representation.path, 0, representation.size)], keep_alive=keep_alive)
+
+def mux_request(head, client_address):
+    """Answers one request of a multiplexed connection, from the request head carried by its HEADERS frame.
+
+    Returns (response header, body parts, access record, Priority header
+    value) for MuxSession. The header loses its Connection line, which
+    means nothing on a stream; the body is framed as on HTTP/1.1.
+    """
+    start = time.perf_counter()
+    timer = timing.start()
+    method = path = '-'
+    priority = None
+    parser = HTTPRequestParser()
+    parser.feed(head)
+    try:
+        request = parser.next_request()
+        if request is None:
+            raise HTTPParseError('400 Bad Request', "Incomplete request header block")
+        timer.mark('parse')
+        method, path, priority = request.method, request.path, request.headers.get('priority')
+        response = process_request(request, client_address)
+        timer.mark('build')
+    except HTTPParseError as e:
+        logging.debug("Bad request from %s: %s", client_address, e)
+        response = error_response(e.status, f"<h1>{e.status}</h1>")
+    except Exception as e:
+        logging.error(f"Unexpected error with {client_address}: {e}")
+        response = error_response('500 Internal Server Error', "<h1>500 Internal Server Error</h1>")
+
+    header = response.header
+    for connection_line in (CONNECTION_KEEP_ALIVE, CONNECTION_CLOSE):
+        if header.endswith(connection_line):
+            header = header[:-len(connection_line)] + b'\r\n'
+    parts = response.parts
+    if response.content is not None:
+        parts = parts + [encode_chunked(response.content, HOL_CHUNK_SIZE)]
+    record = AccessRecord(client_address, method, path, response.status(), response.length(), start, METRICS, timer)
+    return header, parts, record, priority
+
+def send_queued(sock, outbuf):
+    """Writes queued memoryviews and FileSlices to a non-blocking socket, running callbacks as the writer reaches them.
+
+    Raises BlockingIOError once the socket takes no more.
+    """
+    while outbuf:
+        part = outbuf[0]
+        if isinstance(part, FileSlice):
+            send_file_slice(sock, part)
+            if part.count == 0:
+                part.close()
+                outbuf.popleft()
+        elif callable(part):
+            part()
+            outbuf.popleft()
+        else:
+            sent = sock.send(part)
+            if sent == len(part):
+                outbuf.popleft()
+            else:
+                outbuf[0] = part[sent:]
+
+def write_mux(sock, session):
+    """Sends frames of a multiplexed connection until the socket is full or no stream can send; returns whether output is left."""
+    try:
+        while session.outbuf or session.schedule():
+            send_queued(sock, session.outbuf)
+    except BlockingIOError:
+        return True
+    return False
+
+def serve_mux(client_connection, client_address, data):
+    """Serves a connection that opened with MUX_PREFACE from this thread, reading and writing without blocking.
+
+    `data` holds whatever followed the preface. Once the client stops
+    sending (or the server shuts down) no new streams are accepted, and the
+    connection closes when the open ones are done. It is also closed when
+    nothing moves for KEEPALIVE_TIMEOUT with no streams open, or for
+    SEND_TIMEOUT with some waiting.
+    """
+    logging.debug("Multiplexed connection from %s", client_address)
+    session = MuxSession(lambda head: mux_request(head, client_address))
+    client_connection.setblocking(False)
+    sel = selectors.DefaultSelector()
+    sel.register(client_connection, selectors.EVENT_READ)
+    reading = True
+    last_activity = time.monotonic()
+    try:
+        while True:
+            if data:
+                try:
+                    session.feed(data)
+                except MuxError as e:
+                    logging.debug("Protocol error from %s: %s", client_address, e)
+                    session.goaway(e.code)
+            if not reading or SHUTTING_DOWN.is_set():
+                session.goaway()
+            pending = write_mux(client_connection, session)
+            if session.finished() and not pending:
+                break
+            events = (selectors.EVENT_READ if reading else 0) | (selectors.EVENT_WRITE if pending else 0)
+            if not events:
+                break  # Streams wait for window the client can no longer send
+            sel.modify(client_connection, events)
+            limit = SEND_TIMEOUT if session.streams or pending else KEEPALIVE_TIMEOUT
+            ready = sel.select(timeout=max(last_activity + limit - time.monotonic(), 0))
+            if not ready:
+                logging.debug("Timed out connection with %s", client_address)
+                break
+            last_activity = time.monotonic()
+            data = b''
+            if ready[0][1] & selectors.EVENT_READ:
+                try:
+                    data = client_connection.recv(BUFFER_SIZE)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    reading = False
+    except OSError as e:
+        logging.error(f"Unexpected error with {client_address}: {e}")
+    finally:
+        sel.close()
+        session.close()
+
+def send_interleaved(client_connection, content):
+    """Sends content in interleaved chunks (simulating frame-based transmission)."""
+    for i in range(0, len(content), HOL_CHUNK_SIZE):
+        chunk = content[i:i+HOL_CHUNK_SIZE]
+        # Simulate HOL blocking by sending chunks interleaved
+        client_connection.sendall(f"{len(chunk):X}\r\n".encode())
+        client_connection.sendall(chunk + b"\r\n")
+        time.sleep(HOL_CHUNK_DELAY)  # Simulate small delay to interleave the frame transmission
+
+    # Send the terminating chunk
+    client_connection.sendall(b"0\r\n\r\n")
+
+def send_response(client_connection, response, record=None):
+    """Writes a Response on a blocking socket, using sendfile() for file slices.
+
+    The access record, if given, is marked at the first byte and finished once everything is sent.
+    """
+    if record is not None:
+        record.first_byte()
+    pending = [response.header]
+    for part in response.parts:
+        if isinstance(part, FileSlice):
+            client_connection.sendall(b''.join(pending))
+            pending = []
+            with open(part.path, 'rb') as f:
+                sent = client_connection.sendfile(f, part.offset, part.count)
+            if sent != part.count:
+                # The file shrank after Content-Length was sent; the response can't be completed
+                raise IOError(f"Short sendfile for {part.path}: {sent} of {part.count} bytes")
+        else:
+            pending.append(part)
+    if pending:
+        client_connection.sendall(b''.join(pending))
+    if response.content is not None:
+        send_interleaved(client_connection, response.content)
+    if record is not None:
+        record.finish()
+
+def handle_client(client_connection, client_address):
+    parser = HTTPRequestParser()
+    METRICS.connection_opened()
+    idle = False
+    requests_served = 0
+    header_deadline = None  # Set when the first byte of a request arrives
+    try:
+        logging.debug("Connection established with %s", client_address)
+        while True:
+            if parser.pending() == 0:
+                # Waiting for a new request, not the rest of one
+                METRICS.connection_idle(True)
+                idle = True
+                header_deadline = None
+                client_connection.settimeout(KEEPALIVE_TIMEOUT)
+            else:
+                if header_deadline is None:
+                    header_deadline = time.monotonic() + HEADER_READ_TIMEOUT
+                client_connection.settimeout(max(header_deadline - time.monotonic(), 0.001))
+            try:
+                data = client_connection.recv(BUFFER_SIZE)
+            except socket.timeout:
+                if parser.pending():
+                    logging.debug("Timed out reading a request from %s", client_address)
+                    send_response(client_connection, error_response('408 Request Timeout', "<h1>408 Request Timeout</h1>"))
+                else:
+                    logging.debug("Closing idle connection with %s", client_address)
+                break
+            if idle:
+                METRICS.connection_idle(False)
+                idle = False
+            if not data:
+                logging.debug("Connection closed by %s", client_address)
+                break
+            if requests_served == 0 and parser.pending() == 0 and data.startswith(MUX_PREFACE):
+                serve_mux(client_connection, client_address, data[len(MUX_PREFACE):])
+                break
+            timer = timing.start()
+            parser.feed(data)
+
+            # Answer every complete request buffered so far, in order (pipelining)
+            keep_alive = True
+            client_connection.settimeout(SEND_TIMEOUT)
+            try:
+                for request in parser:
+                    start = time.perf_counter()
+                    timer.mark('parse')
+                    requests_served += 1
+                    # The last request allowed on this connection (or any during shutdown) is answered with Connection: close
+                    allow_keep_alive = requests_served < MAX_REQUESTS_PER_CONNECTION and not SHUTTING_DOWN.is_set()
+                    response = process_request(request, client_address, allow_keep_alive)
+                    timer.mark('build')
+                    record = AccessRecord(client_address, request.method, request.path, response.status(), response.length(), start, METRICS, timer)
+                    send_response(client_connection, response, record)
+                    if not response.keep_alive:
+                        keep_alive = False
+                        break
+                    timer = timing.start()  # The next pipelined request, if there is one
+            except HTTPParseError as e:
+                logging.debug("Bad request from %s: %s", client_address, e)
+                start = time.perf_counter()
+                response = error_response(e.status, f"<h1>{e.status}</h1>")
+                record = AccessRecord(client_address, '-', '-', response.status(), response.length(), start, METRICS)
+                send_response(client_connection, response, record)
+                break  # Close connection after bad request
 
             # If not keeping the connection alive, close it
             if not keep_alive:
-                logging.info(f"Closing connection with {client_address} as per Connection header.")
+                logging.debug("Closing connection with %s as per Connection header.", client_address)
                 break  # Exit the loop to close the connection
+            header_deadline = None  # A partial next request gets a fresh header timeout
 
+    except socket.timeout:
+        logging.debug("Timed out sending to %s", client_address)
     except Exception as e:
         logging.error(f"Unexpected error with {client_address}: {e}")
         try:
@@ -193,31 +586,127 @@ def handle_client(client_connection, client_address):
         except:
             pass  # Ignore errors while sending error response
         finally:
-            logging.info(f"Closing connection with {client_address} due to an error.")
+            logging.debug("Closing connection with %s due to an error.", client_address)
 
     finally:
         client_connection.close()
-        logging.info(f"Closed connection with {client_address}")
+        logging.debug("Closed connection with %s", client_address)
+        if idle:
+            METRICS.connection_idle(False)
+        METRICS.connection_closed()
+        METRICS.release_thread()
+
+def shed_connection(client_connection, client_address):
+    """Answers a connection the server has no capacity for with an immediate 503 and hands it to the drainer to close."""
+    global SHED_DRAINER
+    logging.debug("Server saturated; shedding connection from %s", client_address)
+    start = time.perf_counter()
+    try:
+        client_connection.setblocking(False)
+        client_connection.send(SERVICE_UNAVAILABLE)
+        client_connection.shutdown(socket.SHUT_WR)
+    except OSError:
+        client_connection.close()  # Best effort: a full send buffer or a reset just means the client doesn't see the 503
+    else:
+        # Closing now, with the request unread, would send a RST that can destroy the 503 before the client reads it
+        if SHED_DRAINER is None:
+            SHED_DRAINER = threading.Thread(target=drain_shed_connections, name='shed-drainer', daemon=True)
+            SHED_DRAINER.start()
+        SHED_QUEUE.put(client_connection)
+    elapsed = time.perf_counter() - start
+    METRICS.record_request(503, len(SERVICE_UNAVAILABLE), elapsed, elapsed)
+
+def drain_shed_connections():
+    """Reads and discards what shed clients send until they close or SHED_LINGER passes, then closes their sockets."""
+    sel = selectors.DefaultSelector()
 
-def start_server():
+    def close(sock):
+        sel.unregister(sock)
+        sock.close()
+
+    while True:
+        # Block for the next shed connection only while there is nothing to drain
+        while True:
+            try:
+                sock = SHED_QUEUE.get(block=not sel.get_map())
+            except queue.Empty:
+                break
+            sel.register(sock, selectors.EVENT_READ, time.monotonic() + SHED_LINGER)
+        for key, _ in sel.select(timeout=0.05):
+            try:
+                if not key.fileobj.recv(BUFFER_SIZE):
+                    close(key.fileobj)
+            except BlockingIOError:
+                pass
+            except OSError:
+                close(key.fileobj)
+        now = time.monotonic()
+        for key in list(sel.get_map().values()):
+            if key.data <= now:
+                close(key.fileobj)
+
+def create_listen_socket(reuse_port=False):
     listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Each worker gets its own accept queue and the kernel balances connections between them
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     listen_socket.bind((HOST, PORT))
     listen_socket.listen(100)  # Allow up to 100 connections
-    logging.info(f'Serving HTTP on port {PORT} ...')
+    return listen_socket
+
+def reuse_port_works():
+    """Whether a SO_REUSEPORT listener can be bound on PORT; the option may exist and still be refused at runtime."""
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        return False
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # Bound but never listening, so no connection is ever queued on it
+        probe.bind((HOST, PORT))
+    except OSError as e:
+        logging.warning(f"Can't bind a SO_REUSEPORT listener on port {PORT}: {e}")
+        return False
+    finally:
+        probe.close()
+    return True
+
+def start_server(listen_socket=None):
+    if listen_socket is None:
+        listen_socket = create_listen_socket()
+    logging.info(f'Serving HTTP on port {PORT} ({MAX_CONNECTIONS} connection threads) ...')
+
+    # A fixed pool of threads serves connections; a connection beyond MAX_CONNECTIONS gets a 503
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONNECTIONS, thread_name_prefix='conn')
+    slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+    open_connections = set()
+    open_lock = threading.Lock()
+
+    def serve_connection(client_connection, client_address):
+        try:
+            PROFILER.call(handle_client, client_connection, client_address)
+        finally:
+            with open_lock:
+                open_connections.discard(client_connection)
+            slots.release()
 
     while True:
         try:
             client_connection, client_address = listen_socket.accept()
-            logging.info(f"Accepted connection from {client_address}")
+            logging.debug("Accepted connection from %s", client_address)
 
-            # Create a new thread for each client connection
-            client_thread = threading.Thread(target=handle_client, args=(client_connection, client_address))
-            client_thread.daemon = True
-            client_thread.start()
+            if not slots.acquire(blocking=False):
+                shed_connection(client_connection, client_address)
+                continue
+            with open_lock:
+                open_connections.add(client_connection)
+            pool.submit(serve_connection, client_connection, client_address)
 
         except KeyboardInterrupt:
             logging.info("Shutting down the server.")
+            logging.info(f"File cache stats: {FILE_CACHE.stats()}")
+            logging.info(f"Variant cache stats: {VARIANT_CACHE.stats()}")
             listen_socket.close()
             break
         except Exception as e:
@@ -225,5 +714,403 @@ def start_server():
             listen_socket.close()
             break
 
+    # Let in-flight responses finish; idle keep-alive connections are woken up so their threads exit
+    SHUTTING_DOWN.set()
+    with open_lock:
+        for client_connection in open_connections:
+            try:
+                client_connection.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+    pool.shutdown(wait=True)
+
+class Connection:
+    """Per-connection state for the event-loop server.
+
+    An idle keep-alive connection is just its socket plus this object; there
+    is no thread parked in recv().
+    """
+    __slots__ = ('sock', 'address', 'parser', 'outbuf', 'close_after_write', 'idle', 'deadline', 'requests_served', 'mux',
+                 'profile')
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.parser = HTTPRequestParser()
+        # memoryviews and FileSlices still to be written, plus callbacks to run when the writer reaches them
+        self.outbuf = collections.deque()
+        self.close_after_write = False
+        self.idle = False
+        self.deadline = 0.0  # time.monotonic() after which the connection is timed out
+        self.requests_served = 0
+        self.mux = None  # MuxSession once the client has sent MUX_PREFACE
+        self.profile = PROFILER.start()  # cProfile.Profile enabled around this connection's events, if sampled
+
+    def set_idle(self, idle):
+        if idle != self.idle:
+            self.idle = idle
+            METRICS.connection_idle(idle)
+        if idle:
+            self.deadline = time.monotonic() + KEEPALIVE_TIMEOUT
+
+    def queue_response(self, response, record):
+        """Queues a response between its access record's first_byte and finish callbacks."""
+        self.outbuf.append(record.first_byte)
+        self.outbuf.append(memoryview(response.header))
+        for part in response.parts:
+            self.outbuf.append(part if isinstance(part, FileSlice) else memoryview(part))
+        if response.content is not None:
+            self.outbuf.append(memoryview(encode_chunked(response.content, HOL_CHUNK_SIZE)))
+        self.outbuf.append(record.finish)
+
+def close_connection(sel, conn):
+    try:
+        sel.unregister(conn.sock)
+    except (KeyError, ValueError):
+        pass
+    for part in conn.outbuf:
+        if isinstance(part, FileSlice):
+            part.close()
+        elif callable(part):
+            part()  # Requests are still logged with the bytes queued, even though the client went away
+    conn.outbuf.clear()
+    if conn.mux is not None:
+        conn.mux.close()
+    if conn.profile is not None:
+        PROFILER.add(conn.profile)
+        conn.profile = None
+    conn.sock.close()
+    logging.debug("Closed connection with %s", conn.address)
+    conn.set_idle(False)
+    METRICS.connection_closed()
+
+def accept_connections(sel, listen_socket):
+    """Accepts every pending connection on the (non-blocking) listening socket."""
+    while True:
+        try:
+            client_connection, client_address = listen_socket.accept()
+        except BlockingIOError:
+            return
+        logging.debug("Accepted connection from %s", client_address)
+        if len(sel.get_map()) > MAX_CONNECTIONS:  # The listening socket is registered too
+            shed_connection(client_connection, client_address)
+            continue
+        client_connection.setblocking(False)
+        conn = Connection(client_connection, client_address)
+        sel.register(client_connection, selectors.EVENT_READ, conn)
+        METRICS.connection_opened()
+        conn.set_idle(True)
+
+def read_connection(sel, conn):
+    try:
+        data = conn.sock.recv(BUFFER_SIZE)
+    except BlockingIOError:
+        return
+    except OSError as e:
+        logging.error(f"Unexpected error with {conn.address}: {e}")
+        close_connection(sel, conn)
+        return
+    if conn.mux is None and conn.requests_served == 0 and conn.parser.pending() == 0 and data.startswith(MUX_PREFACE):
+        logging.debug("Multiplexed connection from %s", conn.address)
+        conn.mux = MuxSession(lambda head: mux_request(head, conn.address))
+        data = data[len(MUX_PREFACE):]
+    if conn.mux is not None:
+        if not data:
+            conn.close_after_write = True  # Answer the open streams, then close
+        try:
+            conn.mux.feed(data)
+        except MuxError as e:
+            logging.debug("Protocol error from %s: %s", conn.address, e)
+            conn.mux.goaway(e.code)
+        write_mux_connection(sel, conn)
+        return
+    if not data:
+        logging.debug("Connection closed by %s", conn.address)
+        close_connection(sel, conn)
+        return
+
+    if conn.idle:
+        # First bytes of a new request: it has to be complete within HEADER_READ_TIMEOUT
+        conn.set_idle(False)
+        conn.deadline = time.monotonic() + HEADER_READ_TIMEOUT
+    timer = timing.start()
+    conn.parser.feed(data)
+    # Queue a response for every complete request buffered so far, in order (pipelining)
+    method = path = '-'
+    try:
+        for request in conn.parser:
+            start = time.perf_counter()
+            timer.mark('parse')
+            method, path = request.method, request.path
+            conn.requests_served += 1
+            # The last request allowed on this connection (or any during shutdown) is answered with Connection: close
+            allow_keep_alive = conn.requests_served < MAX_REQUESTS_PER_CONNECTION and not SHUTTING_DOWN.is_set()
+            response = process_request(request, conn.address, allow_keep_alive)
+            timer.mark('build')
+            conn.queue_response(response, AccessRecord(conn.address, method, path, response.status(), response.length(), start, METRICS, timer))
+            if not response.keep_alive:
+                break
+            method = path = '-'
+            timer = timing.start()
+    except HTTPParseError as e:
+        logging.debug("Bad request from %s: %s", conn.address, e)
+        start = time.perf_counter()
+        response = error_response(e.status, f"<h1>{e.status}</h1>")
+        conn.queue_response(response, AccessRecord(conn.address, '-', '-', response.status(), response.length(), start, METRICS))
+    except Exception as e:
+        logging.error(f"Unexpected error with {conn.address}: {e}")
+        start = time.perf_counter()
+        response = error_response('500 Internal Server Error', "<h1>500 Internal Server Error</h1>")
+        conn.queue_response(response, AccessRecord(conn.address, method, path, response.status(), response.length(), start, METRICS))
+    else:
+        if not conn.outbuf:
+            return  # Waiting for the rest of a request
+    if not response.keep_alive:
+        # Stop reading; the connection is closed once the response is flushed
+        conn.close_after_write = True
+    conn.deadline = time.monotonic() + SEND_TIMEOUT
+    write_connection(sel, conn)
+
+def send_file_slice(sock, part):
+    """Sends as much of a FileSlice as the non-blocking socket accepts; returns bytes sent."""
+    if part.file is None:
+        part.file = open(part.path, 'rb')
+    if hasattr(os, 'sendfile'):
+        sent = os.sendfile(sock.fileno(), part.file.fileno(), part.offset, part.count)
+    else:
+        # Send straight out of a memory map so the slice is never copied into a bytes object
+        if part.mapping is None:
+            part.mapping = mmap.mmap(part.file.fileno(), 0, access=mmap.ACCESS_READ)
+        with memoryview(part.mapping) as view:
+            sent = sock.send(view[part.offset:part.offset + part.count])
+    if sent == 0:
+        # The file shrank after Content-Length was sent; the response can't be completed
+        raise IOError(f"Short sendfile for {part.path}: {part.count} bytes left")
+    part.offset += sent
+    part.count -= sent
+    return sent
+
+def write_connection(sel, conn):
+    """Writes as much pending output as the socket accepts without blocking."""
+    if conn.mux is not None:
+        write_mux_connection(sel, conn)
+        return
+    try:
+        send_queued(conn.sock, conn.outbuf)
+    except BlockingIOError:
+        # The client is still reading, so it gets another SEND_TIMEOUT to drain the rest
+        conn.deadline = time.monotonic() + SEND_TIMEOUT
+    except OSError as e:
+        logging.error(f"Unexpected error with {conn.address}: {e}")
+        close_connection(sel, conn)
+        return
+
+    if conn.outbuf:
+        # Stop reading until the queued responses are flushed, so a pipelining client can't grow outbuf without bound
+        sel.modify(conn.sock, selectors.EVENT_WRITE, conn)
+    elif conn.close_after_write or SHUTTING_DOWN.is_set():
+        logging.debug("Closing connection with %s as per Connection header.", conn.address)
+        close_connection(sel, conn)
+    else:
+        sel.modify(conn.sock, selectors.EVENT_READ, conn)
+        if conn.parser.pending() == 0:
+            conn.set_idle(True)
+        else:
+            conn.deadline = time.monotonic() + HEADER_READ_TIMEOUT
+
+def write_mux_connection(sel, conn):
+    """write_connection() for a multiplexed connection, which keeps reading (window updates, new streams) while it writes."""
+    session = conn.mux
+    if conn.close_after_write or SHUTTING_DOWN.is_set():
+        session.goaway()
+    try:
+        pending = write_mux(conn.sock, session)
+    except OSError as e:
+        logging.error(f"Unexpected error with {conn.address}: {e}")
+        close_connection(sel, conn)
+        return
+    events = (0 if conn.close_after_write else selectors.EVENT_READ) | (selectors.EVENT_WRITE if pending else 0)
+    if session.finished() and not pending or not events:
+        close_connection(sel, conn)
+        return
+    sel.modify(conn.sock, events, conn)
+    conn.set_idle(not session.streams and not pending)
+    if not conn.idle:
+        conn.deadline = time.monotonic() + SEND_TIMEOUT
+
+def expire_connections(sel):
+    """Closes connections past their idle, header-read or send deadline."""
+    now = time.monotonic()
+    for key in list(sel.get_map().values()):
+        conn = key.data
+        if conn is None or conn.deadline > now:
+            continue
+        if not conn.outbuf and conn.parser.pending():
+            logging.debug("Timed out reading a request from %s", conn.address)
+            try:
+                conn.sock.send(b'HTTP/1.1 408 Request Timeout\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            except OSError:
+                pass
+        else:
+            logging.debug("Timed out connection with %s", conn.address)
+        close_connection(sel, conn)
+
+def run_event_loop(sel, listen_socket):
+    last_sweep = time.monotonic()
+    while True:
+        for key, mask in sel.select(timeout=1.0):
+            if key.data is None:
+                accept_connections(sel, listen_socket)
+                continue
+            conn = key.data
+            profile = conn.profile
+            if profile is not None:
+                profile.enable()
+            try:
+                if mask & selectors.EVENT_WRITE:
+                    write_connection(sel, conn)
+                    if conn.sock.fileno() == -1:
+                        continue
+                if mask & selectors.EVENT_READ and not conn.close_after_write:
+                    read_connection(sel, conn)
+            finally:
+                if profile is not None:
+                    profile.disable()
+
+        if time.monotonic() - last_sweep >= 1.0:
+            expire_connections(sel)
+            last_sweep = time.monotonic()
+            if SHUTTING_DOWN.is_set() and not sel.get_map():
+                return
+
+def drain_connections(sel, listen_socket):
+    """Stops accepting, closes idle connections and lets the rest finish their responses."""
+    SHUTTING_DOWN.set()
+    sel.unregister(listen_socket)
+    listen_socket.close()
+    now = time.monotonic()
+    for key in list(sel.get_map().values()):
+        conn = key.data
+        if conn.idle:
+            close_connection(sel, conn)
+        else:
+            conn.deadline = min(conn.deadline, now + SEND_TIMEOUT)
+    if sel.get_map():
+        logging.info(f"Waiting for {len(sel.get_map())} connections to finish ...")
+        run_event_loop(sel, listen_socket)
+
+def start_event_loop_server(listen_socket=None):
+    """Serves every connection from a single selectors loop instead of one thread each."""
+    if listen_socket is None:
+        listen_socket = create_listen_socket()
+    listen_socket.setblocking(False)
+    sel = selectors.DefaultSelector()
+    sel.register(listen_socket, selectors.EVENT_READ, None)
+    logging.info(f'Serving HTTP on port {PORT} (event loop) ...')
+
+    try:
+        run_event_loop(sel, listen_socket)
+    except KeyboardInterrupt:
+        logging.info("Shutting down the server.")
+        logging.info(f"File cache stats: {FILE_CACHE.stats()}")
+        logging.info(f"Variant cache stats: {VARIANT_CACHE.stats()}")
+        drain_connections(sel, listen_socket)
+    finally:
+        for key in list(sel.get_map().values()):
+            key.fileobj.close()
+        sel.close()
+
+def dump_profile(signum=None, frame=None):
+    """Writes the profile of the connections sampled so far to PROFILE_PATH and logs the top functions."""
+    logging.info(PROFILER.dump(PROFILE_PATH.format(pid=os.getpid())))
+
+def serve(mode, listen_socket=None):
+    # Stop on SIGTERM the same way as on Ctrl-C, so queued log records are flushed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if PROFILER.rate > 0:
+        signal.signal(signal.SIGUSR1, dump_profile)
+    # Started per serving process: the background log writer thread doesn't survive fork()
+    access_log.start(DEBUG_SAMPLE_RATE)
+    try:
+        if mode == 'event':
+            start_event_loop_server(listen_socket)
+        else:
+            start_server(listen_socket)
+    finally:
+        if PROFILER.rate > 0:
+            dump_profile()
+        access_log.stop()
+
+def start_workers(num_workers, mode):
+    """Pre-forks num_workers serving processes and supervises them until SIGTERM or Ctrl-C."""
+    # SIGUSR1 to the supervisor makes every worker dump its own profile
+    forward_signals = (signal.SIGUSR1,) if PROFILER.rate > 0 else ()
+    # Tried here rather than in the workers, which would otherwise die and be restarted forever
+    if reuse_port_works():
+        # Every worker binds its own SO_REUSEPORT listener
+        logging.info(f"Starting {num_workers} workers with SO_REUSEPORT listeners on port {PORT}")
+        workers.supervise(num_workers, lambda slot: serve(mode, create_listen_socket(reuse_port=True)), forward_signals)
+    else:
+        # Fall back to one listener created before forking and shared by every worker
+        logging.info(f"Starting {num_workers} workers sharing one listener on port {PORT}")
+        listen_socket = create_listen_socket()
+        try:
+            workers.supervise(num_workers, lambda slot: serve(mode, listen_socket), forward_signals)
+        finally:
+            listen_socket.close()
+
+def main():
+    global TRANSFER_MODE, DEBUG_SAMPLE_RATE, METRICS_ENABLED, PROFILE_PATH
+    global MAX_CONNECTIONS, KEEPALIVE_TIMEOUT, HEADER_READ_TIMEOUT, MAX_REQUESTS_PER_CONNECTION
+    parser = argparse.ArgumentParser(description='Simple HTTP/1.1 web server')
+    parser.add_argument('--mode', choices=['thread', 'event'], default=SERVE_MODE,
+                        help="'thread' starts a thread per connection, 'event' serves all connections from one selectors loop")
+    parser.add_argument('--cache-mb', type=int, default=CACHE_MAX_BYTES // (1024 * 1024),
+                        help='memory budget in MB for cached static file bodies (0 disables body caching)')
+    parser.add_argument('--transfer', choices=['sendfile', 'hol-demo'], default=TRANSFER_MODE,
+                        help="'sendfile' sends files zero-copy with Content-Length, 'hol-demo' simulates HOL blocking with delayed interleaved chunks")
+    parser.add_argument('--debug-sample', type=float, default=DEBUG_SAMPLE_RATE,
+                        help='fraction of requests (0-1) to log in full detail at DEBUG level (default: none)')
+    parser.add_argument('--metrics', action='store_true',
+                        help=f'serve runtime metrics at {METRICS_PATH} (per worker process)')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help='concurrent connections per process; beyond this new connections get an immediate 503')
+    parser.add_argument('--keepalive-timeout', type=float, default=KEEPALIVE_TIMEOUT,
+                        help='seconds an idle keep-alive connection is kept open')
+    parser.add_argument('--header-timeout', type=float, default=HEADER_READ_TIMEOUT,
+                        help='seconds a client has to finish sending a request once it starts (408 after that)')
+    parser.add_argument('--max-requests', type=int, default=MAX_REQUESTS_PER_CONNECTION,
+                        help='requests served on one connection before it is closed')
+    parser.add_argument('--slow-ms', type=float, default=SLOW_REQUEST_MS,
+                        help='log how long each phase (parse, stat, read, encode, build, send) of a request slower than this took')
+    parser.add_argument('--profile-sample', type=float, default=PROFILE_SAMPLE_RATE,
+                        help='fraction of connections (0-1) to run under cProfile; SIGUSR1 writes the aggregated stats')
+    parser.add_argument('--profile-out', default=PROFILE_PATH,
+                        help='file the aggregated profile is written to; {pid} is replaced by the process id')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='pre-fork N worker processes, each serving with --mode (default: serve from this process)')
+    args = parser.parse_args()
+
+    TRANSFER_MODE = args.transfer
+    DEBUG_SAMPLE_RATE = args.debug_sample
+    METRICS_ENABLED = args.metrics
+    MAX_CONNECTIONS = args.max_connections
+    KEEPALIVE_TIMEOUT = args.keepalive_timeout
+    HEADER_READ_TIMEOUT = args.header_timeout
+    MAX_REQUESTS_PER_CONNECTION = args.max_requests
+    FILE_CACHE.max_bytes = args.cache_mb * 1024 * 1024
+    if METRICS_ENABLED:
+        timing.add_hook(PHASE_STATS)
+        METRICS.add_source('phase', PHASE_STATS.stats)
+    if args.slow_ms > 0:
+        timing.add_hook(timing.slow_request_logger(args.slow_ms, logging.warning))
+    PROFILER.rate = args.profile_sample
+    PROFILE_PATH = args.profile_out
+
+    if args.workers > 0:
+        start_workers(args.workers, args.mode)
+    else:
+        serve(args.mode)
+
 if __name__ == "__main__":
-    start_server()
+    main()
@@ -0,0 +1,33 @@
+from coalesce import Coalescer
+
+CHUNKED = [('Transfer-Encoding', 'chunked')]
+
+def test_body_of_unknown_length_is_shared_once_complete():
+    coalescer = Coalescer(max_size=100)
+    leader, _ = coalescer.join('http://a/', {})
+    follower, leading = coalescer.join('http://a/', {})
+    assert follower is leader and not leading
+    leader.start(200, 'OK', CHUNKED)
+    leader.append(b'5\r\nhello\r\n')
+    assert leader.shared is None  # Not handed out while it might still outgrow max_size
+    leader.append(b'0\r\n\r\n')
+    leader.finish(True)
+    assert follower.wait_started()
+    assert b''.join(follower.pieces()) == b'5\r\nhello\r\n0\r\n\r\n'
+
+def test_body_growing_past_max_size_is_dropped_and_followers_fetch_for_themselves():
+    coalescer = Coalescer(max_size=100)
+    leader, _ = coalescer.join('http://a/', {})
+    leader.start(200, 'OK', CHUNKED)
+    for _ in range(10):
+        leader.append(b'x' * 20)
+    assert leader.chunks == []
+    assert leader.wait_started() is False
+    leader.finish(True)
+    assert leader.shared is False
+
+def test_body_of_known_length_is_streamed_at_once():
+    coalescer = Coalescer(max_size=100)
+    leader, _ = coalescer.join('http://a/', {})
+    leader.start(200, 'OK', [('Content-Length', '5')])
+    assert leader.wait_started()
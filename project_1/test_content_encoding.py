@@ -0,0 +1,30 @@
+import gzip
+import os
+from file_cache import FileCache
+from content_encoding import VariantCache
+
+def test_replaced_gz_sibling_is_not_served_stale(tmp_path):
+    source = tmp_path / 'page.html'
+    source.write_bytes(b'hello world ' * 100)
+    sibling = tmp_path / 'page.html.gz'
+    sibling.write_bytes(gzip.compress(b'first version'))
+    entry = FileCache().lookup(str(source))
+    variants = VariantCache()
+    assert gzip.decompress(variants.get(entry, 'gzip').body) == b'first version'
+
+    # Replace the sibling only; the source file and its cache entry are unchanged
+    sibling.write_bytes(gzip.compress(b'second, longer version'))
+    st = sibling.stat()
+    os.utime(sibling, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    assert gzip.decompress(variants.get(entry, 'gzip').body) == b'second, longer version'
+    assert variants.stats()['misses'] == 2
+
+def test_unchanged_sibling_is_a_hit(tmp_path):
+    source = tmp_path / 'page.html'
+    source.write_bytes(b'hello world ' * 100)
+    (tmp_path / 'page.html.gz').write_bytes(gzip.compress(b'precompressed'))
+    entry = FileCache().lookup(str(source))
+    variants = VariantCache()
+    first = variants.get(entry, 'gzip')
+    assert variants.get(entry, 'gzip') is first
+    assert variants.stats()['hits'] == 1
@@ -0,0 +1,23 @@
+import asyncio
+import pytest
+from http_parser import HTTPParseError
+from http_stream import parse_chunk_size, relay_body_async
+
+def test_chunk_size_accepts_hex_and_extensions():
+    assert parse_chunk_size(b'1a\r\n') == 26
+    assert parse_chunk_size(b'FF;name=value\r\n') == 255
+    assert parse_chunk_size(b'0\r\n') == 0
+
+@pytest.mark.parametrize('line', [b'-1\r\n', b'+5\r\n', b'0x10\r\n', b'1_0\r\n', b'\r\n', b'; ext\r\n'])
+def test_chunk_size_rejects_anything_but_hex_digits(line):
+    with pytest.raises(HTTPParseError):
+        parse_chunk_size(line)
+
+def test_negative_chunk_size_does_not_read_to_eof():
+    async def relay():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b'-1\r\n' + b'x' * 100000)
+        reader.feed_eof()
+        return await relay_body_async(reader, None, 'chunked')
+    with pytest.raises(HTTPParseError):
+        asyncio.run(relay())
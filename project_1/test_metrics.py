@@ -0,0 +1,16 @@
+from metrics import Metrics, percentile, bucket_index, LATENCY_BUCKETS_MS
+
+def test_percentile_never_exceeds_the_largest_value_seen():
+    buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    buckets[bucket_index(300)] = 10  # Ten requests of 300 ms, in the 250-500 ms bucket
+    assert percentile(buckets, 90) > 300  # Interpolated towards the bucket's upper bound
+    assert percentile(buckets, 90, max_ms=300) == 300
+
+def test_rendered_quantiles_are_capped_by_the_observed_max():
+    metrics = Metrics()
+    for _ in range(10):
+        metrics.record_request(200, 0, 0.001, 0.6)  # 600 ms, in the 500-1000 ms bucket
+    lines = dict(line.rsplit(' ', 1) for line in metrics.render().splitlines())
+    for p in (50, 90, 99):
+        assert float(lines[f'response_ms{{quantile="0.{p}"}}']) <= 600
+    assert float(lines['response_ms{quantile="0.50"}']) > 500
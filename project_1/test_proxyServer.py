@@ -0,0 +1,17 @@
+import pytest
+from proxyServer import split_url
+
+@pytest.mark.parametrize('url, expected', [
+    ('http://example.com/a', ('example.com', 80, '/a')),
+    ('http://example.com:8080', ('example.com', 8080, '/')),
+    ('http://[::1]:8080/a', ('::1', 8080, '/a')),
+    ('http://[::1]/', ('::1', 80, '/')),
+])
+def test_split_url(url, expected):
+    assert split_url(url) == expected
+
+@pytest.mark.parametrize('url', ['http://127.0.0.1:abc/', 'http://[::1/', 'http://[::1]x/', 'http://::1/',
+                                 'http://:80/', 'http://host:70000/'])
+def test_split_url_rejects_malformed_authorities(url):
+    with pytest.raises(ValueError):
+        split_url(url)
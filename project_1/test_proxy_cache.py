@@ -0,0 +1,13 @@
+from proxy_cache import ResponseCache, CachedResponse
+
+def test_refresh_keeps_current_bytes_in_step_with_the_entries():
+    cache = ResponseCache(1024 * 1024, 1024 * 1024)
+    entry = CachedResponse('http://a/', 200, 'OK', [('Cache-Control', 'max-age=0'), ('ETag', '"1"')],
+                           b'x' * 100, {}, 0)
+    assert cache.store(entry)
+    fresh = cache.refresh(entry, [('Cache-Control', 'max-age=60'), ('X-Extra', 'y' * 50)])
+    assert fresh is not entry and fresh.is_fresh(fresh.stored_at)
+    assert fresh.body is entry.body
+    assert cache.current_bytes == sum(e.size for e in cache.entries.values()) == fresh.size
+    cache.remove('http://a/')
+    assert cache.current_bytes == 0
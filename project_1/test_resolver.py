@@ -0,0 +1,40 @@
+import socket
+import threading
+import time
+import pytest
+from resolver import ResolverCache
+
+def failing_resolver(host, port):
+    time.sleep(0.05)  # Long enough for concurrent lookups to join this one
+    raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+
+def test_each_failed_lookup_raises_its_own_gaierror():
+    resolver = ResolverCache(failing_resolver)
+    errors = []
+
+    def resolve():
+        try:
+            resolver.resolve('nowhere.invalid', 80, timeout=5)
+        except socket.gaierror as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=resolve) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    resolve()  # Answered from the negative cache
+    resolver.close()
+
+    assert len(errors) == 5
+    assert len({id(e) for e in errors}) == 5
+    assert all(e.errno == socket.EAI_NONAME and e.strerror == 'Name or service not known' for e in errors)
+    assert resolver.stats()['negative_hits'] == 1
+
+def test_failure_without_errno_is_raised_as_gaierror():
+    def broken(host, port):
+        raise UnicodeError('label too long')
+    resolver = ResolverCache(broken)
+    with pytest.raises(socket.gaierror, match='label too long'):
+        resolver.resolve('x' * 100, 80, timeout=5)
+    resolver.close()
@@ -0,0 +1,121 @@
+import contextvars
+import threading
+import time
+from metrics import LATENCY_BUCKETS_MS, PERCENTILES, bucket_index, percentile
+
+HOOKS = []  # Callables given each finished RequestTimer; timing is off while this is empty
+
+class RequestTimer:
+    """Per-phase timings of one request, in perf_counter_ns() nanoseconds.
+
+    mark(phase) closes the phase that ran since the previous mark (or since
+    the timer started), so the phases add up to the request's total time.
+    A phase name may repeat, for instance when a connect is retried.
+    finish() records the outcome and hands the timer to every hook.
+    """
+    __slots__ = ('start', 'last', 'phases', 'method', 'path', 'status', 'nbytes')
+
+    def __init__(self):
+        self.start = self.last = time.perf_counter_ns()
+        self.phases = []  # (phase, nanoseconds) in the order they ran
+        self.method = self.path = '-'
+        self.status = None
+        self.nbytes = 0
+
+    def mark(self, phase):
+        now = time.perf_counter_ns()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def label(self, method, path):
+        self.method, self.path = method, path
+
+    def total_ns(self):
+        return self.last - self.start
+
+    def finish(self, status, nbytes):
+        self.status, self.nbytes = status, nbytes
+        for hook in HOOKS:
+            hook(self)
+
+class NullTimer:
+    """Stands in for RequestTimer while no hooks are registered, so timing costs only the calls."""
+    __slots__ = ()
+
+    def mark(self, phase):
+        pass
+
+    def label(self, method, path):
+        pass
+
+    def finish(self, status, nbytes):
+        pass
+
+NULL_TIMER = NullTimer()
+
+# The timer of the request being handled, per thread and per asyncio task
+CURRENT = contextvars.ContextVar('request_timer', default=NULL_TIMER)
+
+def start():
+    """Starts timing a new request in the current thread or task and returns its timer."""
+    timer = RequestTimer() if HOOKS else NULL_TIMER
+    CURRENT.set(timer)
+    return timer
+
+def mark(phase):
+    """Ends `phase` of the current request, if it is being timed."""
+    CURRENT.get().mark(phase)
+
+def label(method, path):
+    CURRENT.get().label(method, path)
+
+def add_hook(hook):
+    """Registers a callable taking a finished RequestTimer; it runs on the thread that finished the request."""
+    HOOKS.append(hook)
+
+def remove_hook(hook):
+    HOOKS.remove(hook)
+
+def describe(timer):
+    """One line with a request's outcome and the milliseconds each phase took."""
+    phases = ' '.join(f'{phase}={ns / 1e6:.3f}' for phase, ns in timer.phases)
+    return (f'method={timer.method} path={timer.path} status={timer.status} bytes={timer.nbytes} '
+            f'total_ms={timer.total_ns() / 1e6:.3f} {phases}')
+
+def slow_request_logger(threshold_ms, log):
+    """Returns a hook that passes describe() of every request slower than threshold_ms to `log`."""
+    threshold_ns = threshold_ms * 1e6
+    def hook(timer):
+        if timer.total_ns() >= threshold_ns:
+            log(f'slow request: {describe(timer)}')
+    return hook
+
+class PhaseStats:
+    """A hook keeping a latency histogram per phase, exported through Metrics.add_source()."""
+    def __init__(self):
+        self.buckets = {}  # Phase -> counts per LATENCY_BUCKETS_MS bucket
+        self.max_ns = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, timer):
+        with self.lock:
+            for phase, ns in timer.phases:
+                buckets = self.buckets.get(phase)
+                if buckets is None:
+                    buckets = self.buckets[phase] = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+                    self.max_ns[phase] = 0
+                buckets[bucket_index(ns / 1e6)] += 1
+                if ns > self.max_ns[phase]:
+                    self.max_ns[phase] = ns
+
+    def stats(self):
+        with self.lock:
+            snapshot = {phase: list(buckets) for phase, buckets in self.buckets.items()}
+            max_ns = dict(self.max_ns)
+        stats = {}
+        for phase, buckets in snapshot.items():
+            stats[f'{phase}_count'] = sum(buckets)
+            for p in PERCENTILES:
+                stats[f'{phase}_p{p}_ms'] = f'{percentile(buckets, p, max_ns[phase] / 1e6):.3f}'
+            stats[f'{phase}_max_ms'] = f'{max_ns[phase] / 1e6:.3f}'
+        return stats
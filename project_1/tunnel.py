@@ -0,0 +1,219 @@
+import asyncio
+import os
+import selectors
+import socket
+import threading
+import time
+
+TUNNEL_BUFFER_SIZE = 64 * 1024
+# os.splice() moves bytes socket -> pipe -> socket inside the kernel, without copying them into Python
+USE_SPLICE = hasattr(os, 'splice')
+
+class TunnelStats:
+    """Counters for CONNECT tunnels, shared by every connection of the proxy."""
+    def __init__(self):
+        self.active = 0
+        self.opened = 0
+        self.idle_closed = 0
+        self.bytes_up = 0  # Client to origin
+        self.bytes_down = 0  # Origin to client
+        self.lock = threading.Lock()
+
+    def tunnel_opened(self):
+        with self.lock:
+            self.active += 1
+            self.opened += 1
+
+    def tunnel_closed(self, up, down, idle):
+        with self.lock:
+            self.active -= 1
+            self.bytes_up += up
+            self.bytes_down += down
+            self.idle_closed += idle
+
+    def stats(self):
+        with self.lock:
+            return {
+                'active': self.active,
+                'opened': self.opened,
+                'idle_closed': self.idle_closed,
+                'bytes_up': self.bytes_up,
+                'bytes_down': self.bytes_down,
+            }
+
+class Pump:
+    """Moves bytes one way through a tunnel, from src to dst, without blocking.
+
+    Data goes through a pipe with os.splice() where available, or through
+    one preallocated buffer otherwise. While bytes are waiting for dst to
+    accept them, nothing more is read from src.
+    """
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.count = 0  # Bytes delivered to dst
+        self.eof = False
+        self.pending = 0  # Bytes read from src but not yet written to dst
+        if USE_SPLICE:
+            self.pipe_r, self.pipe_w = os.pipe()
+            os.set_blocking(self.pipe_r, False)
+            os.set_blocking(self.pipe_w, False)
+        else:
+            self.buffer = bytearray(TUNNEL_BUFFER_SIZE)
+            self.view = memoryview(self.buffer)
+            self.start = 0
+
+    def done(self):
+        return self.eof and not self.pending
+
+    def wants_read(self):
+        return not self.eof and not self.pending
+
+    def wants_write(self):
+        return self.pending > 0
+
+    def on_readable(self):
+        """Reads what src has ready; at EOF passes the half-close on to dst once everything is written."""
+        try:
+            if USE_SPLICE:
+                n = os.splice(self.src.fileno(), self.pipe_w, TUNNEL_BUFFER_SIZE, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            else:
+                n = self.src.recv_into(self.buffer)
+                self.start = 0
+        except BlockingIOError:
+            return
+        if n == 0:
+            self.eof = True
+        self.pending = n
+        self.on_writable()
+
+    def on_writable(self):
+        try:
+            while self.pending:
+                if USE_SPLICE:
+                    n = os.splice(self.pipe_r, self.dst.fileno(), self.pending, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                else:
+                    n = self.dst.send(self.view[self.start:self.start + self.pending])
+                    self.start += n
+                self.pending -= n
+                self.count += n
+        except BlockingIOError:
+            return
+        if self.eof:
+            try:
+                self.dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def close(self):
+        if USE_SPLICE:
+            os.close(self.pipe_r)
+            os.close(self.pipe_w)
+
+def tunnel(client_socket, upstream_socket, idle_timeout, initial=b''):
+    """Relays bytes both ways between two sockets from the calling thread alone.
+
+    `initial` holds bytes the client already sent past the CONNECT request.
+    Runs until both sides have closed their end, either side fails, or no
+    byte moves for idle_timeout seconds. Returns (bytes client -> origin,
+    bytes origin -> client, whether it ended by idling out).
+    """
+    upstream_socket.sendall(initial)
+    client_socket.setblocking(False)
+    upstream_socket.setblocking(False)
+    up = Pump(client_socket, upstream_socket)
+    up.count = len(initial)
+    down = Pump(upstream_socket, client_socket)
+    sel = selectors.DefaultSelector()
+    registered = {}  # socket -> events it is registered for
+    idle = False
+    try:
+        last_activity = time.monotonic()
+        while not (up.done() and down.done()):
+            wanted = {client_socket: 0, upstream_socket: 0}
+            for pump in (up, down):
+                if pump.wants_read():
+                    wanted[pump.src] |= selectors.EVENT_READ
+                if pump.wants_write():
+                    wanted[pump.dst] |= selectors.EVENT_WRITE
+            for sock, events in wanted.items():
+                if events == registered.get(sock, 0):
+                    continue
+                if not events:
+                    sel.unregister(sock)
+                elif sock in registered:
+                    sel.modify(sock, events)
+                else:
+                    sel.register(sock, events)
+                registered[sock] = events
+            registered = {sock: events for sock, events in registered.items() if events}
+
+            ready = sel.select(timeout=max(0, last_activity + idle_timeout - time.monotonic()))
+            if not ready:
+                if time.monotonic() - last_activity >= idle_timeout:
+                    idle = True
+                    break
+                continue
+            last_activity = time.monotonic()
+            for key, mask in ready:
+                for pump in (up, down):
+                    if mask & selectors.EVENT_WRITE and key.fileobj is pump.dst and pump.wants_write():
+                        pump.on_writable()
+                    if mask & selectors.EVENT_READ and key.fileobj is pump.src and pump.wants_read():
+                        pump.on_readable()
+    except OSError:
+        pass  # A reset on either side ends the tunnel
+    finally:
+        sel.close()
+        up.close()
+        down.close()
+    return up.count, down.count, idle
+
+async def tunnel_async(client_reader, client_writer, upstream_reader, upstream_writer, idle_timeout):
+    """tunnel() for asyncio streams: one pump coroutine per direction on the running loop.
+
+    Each pump waits on drain() after every write, so a slow side holds back
+    the other rather than buffering. A failure in either direction ends both.
+    """
+    up = down = 0
+    last_activity = time.monotonic()
+
+    async def pump(reader, writer, upstream):
+        nonlocal up, down, last_activity
+        try:
+            while True:
+                data = await reader.read(TUNNEL_BUFFER_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+                if upstream:
+                    up += len(data)
+                else:
+                    down += len(data)
+                last_activity = time.monotonic()
+            if writer.can_write_eof():
+                writer.write_eof()
+        except OSError:
+            return False
+        return True
+
+    tasks = {asyncio.ensure_future(pump(client_reader, upstream_writer, True)),
+             asyncio.ensure_future(pump(upstream_reader, client_writer, False))}
+    idle = False
+    try:
+        pending = tasks
+        while pending:
+            timeout = last_activity + idle_timeout - time.monotonic()
+            done, pending = await asyncio.wait(pending, timeout=max(0, timeout))
+            if any(not task.result() for task in done):
+                break
+            if not done and time.monotonic() - last_activity >= idle_timeout:
+                idle = True
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        upstream_writer.close()
+    return up, down, idle
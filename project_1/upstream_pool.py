@@ -0,0 +1,231 @@
+import asyncio
+import socket
+import threading
+import time
+from collections import deque
+from resolver import connect, connect_async
+
+class UpstreamPool:
+    """Keep-alive connections to origin servers, keyed by (host, port).
+
+    At most `max_per_host` connections to one origin exist at a time, idle or
+    checked out; acquire() waits for one to be released beyond that. Idle
+    connections are closed after `idle_timeout` seconds, which should be
+    shorter than the origin's own keep-alive timeout, and are checked for a
+    close from the origin before being handed out again. Host names are
+    looked up through `resolver` (a ResolverCache) when one is given.
+    """
+    def __init__(self, max_per_host=8, idle_timeout=10, connect_timeout=10, resolver=None):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.resolver = resolver
+        self.idle = {}  # (host, port) -> [(socket, time it went idle), ...], most recent last
+        self.in_use = {}  # (host, port) -> number of checked-out connections
+        self.opened = 0
+        self.reused = 0
+        self.discarded = 0
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+
+    def acquire(self, host, port):
+        """Returns (socket, reused) for a connection to (host, port), opening one if none is idle."""
+        key = (host, port)
+        deadline = time.monotonic() + self.connect_timeout
+        with self.lock:
+            while True:
+                idle = self.idle.get(key)
+                while idle:
+                    sock, since = idle.pop()
+                    if time.monotonic() - since < self.idle_timeout and is_alive(sock):
+                        self.in_use[key] = self.in_use.get(key, 0) + 1
+                        self.reused += 1
+                        return sock, True
+                    self.discarded += 1
+                    sock.close()
+                if self.in_use.get(key, 0) < self.max_per_host:
+                    self.in_use[key] = self.in_use.get(key, 0) + 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"no free connection to {host}:{port}")
+                self.released.wait(remaining)
+
+        try:
+            if self.resolver is not None:
+                sock = connect(self.resolver.resolve(host, port, self.connect_timeout), self.connect_timeout)
+            else:
+                sock = socket.create_connection(key, timeout=self.connect_timeout)
+                sock.settimeout(None)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            self._checked_in(key)
+            raise
+        with self.lock:
+            self.opened += 1
+        return sock, False
+
+    def release(self, host, port, sock, reusable):
+        """Returns a checked-out connection; it is kept for reuse only if `reusable`."""
+        key = (host, port)
+        if not reusable:
+            sock.close()
+            self._checked_in(key)
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.in_use[key] -= 1
+            self.idle.setdefault(key, []).append((sock, now))
+            expired = self._expire(now)
+            self.released.notify_all()
+        for old in expired:
+            old.close()
+
+    def _checked_in(self, key):
+        with self.lock:
+            self.in_use[key] -= 1
+            self.released.notify_all()
+
+    def _expire(self, now):
+        # Called with the lock held; removes and returns idle connections past idle_timeout
+        expired = []
+        for key, idle in list(self.idle.items()):
+            while idle and now - idle[0][1] >= self.idle_timeout:
+                expired.append(idle.pop(0)[0])
+            if not idle:
+                del self.idle[key]
+        self.discarded += len(expired)
+        return expired
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for sock, _ in connections:
+                sock.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'idle': sum(len(idle) for idle in self.idle.values()),
+                'in_use': sum(self.in_use.values()),
+                'opened': self.opened,
+                'reused': self.reused,
+                'discarded': self.discarded,
+            }
+
+class AsyncUpstreamPool:
+    """UpstreamPool for asyncio streams, holding (reader, writer) pairs.
+
+    Used from a single event loop, so it needs no lock; acquire() waits on a
+    per-origin queue of futures when max_per_host is reached.
+    """
+    def __init__(self, max_per_host=8, idle_timeout=10, connect_timeout=10, limit=64 * 1024, resolver=None):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.resolver = resolver
+        self.limit = limit  # StreamReader buffer limit for origin connections
+        self.idle = {}  # (host, port) -> [(reader, writer, time it went idle), ...], most recent last
+        self.in_use = {}  # (host, port) -> number of checked-out connections
+        self.waiters = {}  # (host, port) -> deque of futures waiting for a free slot
+        self.opened = 0
+        self.reused = 0
+        self.discarded = 0
+
+    async def acquire(self, host, port):
+        """Returns (reader, writer, reused) for a connection to (host, port), opening one if none is idle."""
+        key = (host, port)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.connect_timeout
+        while True:
+            idle = self.idle.get(key)
+            while idle:
+                reader, writer, since = idle.pop()
+                if (loop.time() - since < self.idle_timeout and not reader.at_eof() and not has_buffered(reader)
+                        and not writer.is_closing()):
+                    self.in_use[key] = self.in_use.get(key, 0) + 1
+                    self.reused += 1
+                    return reader, writer, True
+                self.discarded += 1
+                writer.close()
+            if self.in_use.get(key, 0) < self.max_per_host:
+                self.in_use[key] = self.in_use.get(key, 0) + 1
+                break
+            waiter = loop.create_future()
+            self.waiters.setdefault(key, deque()).append(waiter)
+            try:
+                await asyncio.wait_for(waiter, deadline - loop.time())
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"no free connection to {host}:{port}")
+
+        try:
+            if self.resolver is not None:
+                addresses = await self.resolver.resolve_async(host, port, self.connect_timeout)
+                sock = await connect_async(addresses, self.connect_timeout)
+                reader, writer = await asyncio.open_connection(sock=sock, limit=self.limit)
+            else:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port, limit=self.limit),
+                                                        self.connect_timeout)
+        except BaseException:
+            self.in_use[key] -= 1
+            self._wake(key)
+            raise
+        self.opened += 1
+        return reader, writer, False
+
+    def release(self, host, port, reader, writer, reusable):
+        """Returns a checked-out connection; it is kept for reuse only if `reusable`."""
+        key = (host, port)
+        self.in_use[key] -= 1
+        now = asyncio.get_running_loop().time()
+        if reusable:
+            self.idle.setdefault(key, []).append((reader, writer, now))
+        else:
+            writer.close()
+        for idle in list(self.idle.values()):
+            while idle and now - idle[0][2] >= self.idle_timeout:
+                idle.pop(0)[1].close()
+                self.discarded += 1
+        self._wake(key)
+
+    def _wake(self, key):
+        waiters = self.waiters.get(key)
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def close_all(self):
+        idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for _, writer, _ in connections:
+                writer.close()
+
+    def stats(self):
+        return {
+            'idle': sum(len(idle) for idle in self.idle.values()),
+            'in_use': sum(self.in_use.values()),
+            'opened': self.opened,
+            'reused': self.reused,
+            'discarded': self.discarded,
+        }
+
+def is_alive(sock):
+    """Whether an idle connection is still open: no EOF or unexpected bytes waiting on it."""
+    try:
+        sock.setblocking(False)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        finally:
+            sock.setblocking(True)
+        return False  # EOF, or bytes nobody asked for
+    except OSError:
+        return False
+
+def has_buffered(reader):
+    """Whether an asyncio StreamReader holds received bytes nobody has read; it has no public accessor for this."""
+    return bool(reader._buffer)
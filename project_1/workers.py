@@ -0,0 +1,97 @@
+import os
+import signal
+import logging
+import time
+
+SHUTDOWN_TIMEOUT = 10  # Seconds workers get to finish in-flight requests after SIGTERM
+RESTART_BACKOFF = 1  # Minimum seconds between restarts of the same worker slot
+
+def spawn_worker(slot, worker_main):
+    """Forks a worker process that runs worker_main(slot) and exits."""
+    pid = os.fork()
+    if pid == 0:
+        # The supervisor forwards Ctrl-C as SIGTERM; SIGTERM stops the worker like Ctrl-C would
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        exit_code = 0
+        try:
+            worker_main(slot)
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            logging.error(f"Worker {slot} crashed: {e}")
+            exit_code = 1
+        finally:
+            logging.shutdown()
+            os._exit(exit_code)
+    logging.info(f"Started worker {slot} (pid {pid})")
+    return pid
+
+def stop_workers(workers):
+    """Sends SIGTERM to every worker and waits for them, killing any that outlive SHUTDOWN_TIMEOUT."""
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    remaining = set(workers)
+    while remaining and time.monotonic() < deadline:
+        for pid in list(remaining):
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done:
+                remaining.discard(pid)
+        time.sleep(0.05)
+
+    for pid in remaining:
+        logging.warning(f"Worker pid {pid} did not exit in time; killing it")
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+def supervise(num_workers, worker_main, forward_signals=()):
+    """Pre-forks num_workers processes running worker_main(slot) and restarts any that die.
+
+    Signals in forward_signals sent to the supervisor are passed on to every
+    worker. Returns after SIGTERM or Ctrl-C, once every worker has shut down.
+    """
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    workers = {}  # pid -> slot
+
+    def forward(signum, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    for signum in forward_signals:
+        signal.signal(signum, forward)
+    started = {}  # slot -> time of last start
+    try:
+        for slot in range(num_workers):
+            workers[spawn_worker(slot, worker_main)] = slot
+            started[slot] = time.monotonic()
+
+        while True:
+            pid, status = os.wait()
+            slot = workers.pop(pid, None)
+            if slot is None:
+                continue
+            logging.warning(f"Worker {slot} (pid {pid}) exited with code {os.waitstatus_to_exitcode(status)}; restarting it")
+            # Don't spin if a worker keeps crashing right after it starts
+            wait = started[slot] + RESTART_BACKOFF - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            workers[spawn_worker(slot, worker_main)] = slot
+            started[slot] = time.monotonic()
+    except KeyboardInterrupt:
+        logging.info("Shutting down workers.")
+    finally:
+        stop_workers(workers)
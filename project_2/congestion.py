@@ -0,0 +1,53 @@
+# A congestion controller decides how many packets UDPSender keeps in flight. It is any object with:
+#   window()              the congestion window, in packets
+#   on_ack(acked)         `acked` packets were newly acknowledged (cumulatively or by SACK)
+#   on_loss(in_flight)    a packet was found lost by duplicate ACKs or SACK, at most once per window of data
+#   on_timeout(in_flight) the retransmission timer expired
+INITIAL_WINDOW = 10  # Packets sent before the first ACK (RFC 6928)
+MIN_SSTHRESH = 2  # The slow start threshold never drops below this, however little was in flight
+
+class FixedWindow:
+    """Keeps the same number of packets in flight whatever happens, i.e. no congestion control."""
+    def __init__(self, size):
+        self.size = size
+
+    def window(self):
+        return self.size
+
+    def on_ack(self, acked):
+        pass
+
+    def on_loss(self, in_flight):
+        pass
+
+    def on_timeout(self, in_flight):
+        pass
+
+class Reno:
+    """Reno-style AIMD, counted in packets rather than bytes (RFC 5681).
+
+    In slow start the window grows by one packet per packet acknowledged,
+    doubling every round trip, until it reaches ssthresh; above it, in
+    congestion avoidance, it grows by one packet per round trip. A loss
+    halves it, a timeout sends it back to one packet and slow start.
+    """
+    def __init__(self, initial=INITIAL_WINDOW):
+        self.cwnd = float(initial)
+        self.ssthresh = float('inf')
+
+    def window(self):
+        return max(int(self.cwnd), 1)
+
+    def on_ack(self, acked):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self.cwnd += acked / self.cwnd
+
+    def on_loss(self, in_flight):
+        self.ssthresh = max(in_flight / 2, MIN_SSTHRESH)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, in_flight):
+        self.ssthresh = max(in_flight / 2, MIN_SSTHRESH)
+        self.cwnd = 1.0
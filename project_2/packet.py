@@ -0,0 +1,47 @@
+import struct
+import zlib
+
+# Datagram layout: transfer ID, sequence number, ack number, flags, window, payload length, CRC32, then the payload.
+# The CRC32 covers every other header field and the payload. The sender picks a random transfer ID per run,
+# and the receiver echoes it in its ACKs, so neither mistakes packets of an earlier transfer for this one.
+HEADER = struct.Struct('!IIIHHHI')
+FIELDS = struct.Struct('!IIIHHH')  # The header up to the checksum
+CHECKSUM = struct.Struct('!I')
+SACK_BLOCK = struct.Struct('!II')  # First and last sequence number of one SACK range, in an ACK's payload
+MAX_PAYLOAD = 1400  # Bytes of data per packet, so a datagram fits a 1500-byte Ethernet MTU
+MAX_DATAGRAM = HEADER.size + MAX_PAYLOAD
+
+# Flags
+DATA = 0x1
+ACK = 0x2
+META = 0x4  # File transfer: first packet, its payload the file size (FILE_SIZE)
+FIN = 0x8  # File transfer: last packet, its payload the SHA-256 digest of the file
+FILE_SIZE = struct.Struct('!Q')
+
+def encode_header(transfer_id, seq_num, ack_num, flags, window, payload=b''):
+    """Returns the header for a datagram carrying payload; send the two together with sendmsg()."""
+    fields = FIELDS.pack(transfer_id, seq_num, ack_num, flags, window, len(payload))
+    return fields + CHECKSUM.pack(zlib.crc32(payload, zlib.crc32(fields)))
+
+def decode(view, nbytes):
+    """Checks a received datagram in `view` (a memoryview of nbytes filled by recv_into()).
+
+    Returns (transfer ID, seq, ack, flags, window, payload as a memoryview into
+    the same buffer), or None if the datagram is truncated or fails its checksum.
+    """
+    if nbytes < HEADER.size:
+        return None
+    transfer_id, seq_num, ack_num, flags, window, length, checksum = HEADER.unpack_from(view)
+    if HEADER.size + length != nbytes:
+        return None
+    payload = view[HEADER.size:nbytes]
+    if zlib.crc32(payload, zlib.crc32(view[:FIELDS.size])) != checksum:
+        return None
+    return transfer_id, seq_num, ack_num, flags, window, payload
+
+def encode_sacks(ranges):
+    return b''.join(SACK_BLOCK.pack(first, last) for first, last in ranges)
+
+def decode_sacks(payload):
+    """The (first, last) SACK ranges carried by an ACK's payload."""
+    return list(SACK_BLOCK.iter_unpack(payload[:len(payload) - len(payload) % SACK_BLOCK.size]))
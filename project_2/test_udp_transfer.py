@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+import time
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def run_sender(*args):
+    return subprocess.run([sys.executable, 'udp_sender.py', '--loss', '0', '--quiet', *args],
+                          cwd=HERE, capture_output=True, text=True, timeout=60)
+
+@pytest.mark.parametrize('transfers', [
+    ('greetings', 'file'),
+    ('greetings', 'greetings'),
+    ('file', 'greetings'),
+    ('file', 'file'),
+])
+def test_consecutive_transfers_on_one_receiver(tmp_path, transfers):
+    source = tmp_path / 'source.bin'
+    source.write_bytes(os.urandom(200_000))
+    output = tmp_path / 'received.bin'
+    receiver = subprocess.Popen([sys.executable, 'udp_receiver.py', '--output', str(output), '--corruption', '0', '--quiet'],
+                                cwd=HERE, stdout=subprocess.PIPE, text=True)
+    try:
+        time.sleep(0.5)
+        for transfer in transfers:
+            if output.exists():
+                output.unlink()
+            if transfer == 'file':
+                result = run_sender('--file', str(source))
+                assert result.returncode == 0, result.stdout
+                assert output.read_bytes() == source.read_bytes()
+            else:
+                result = run_sender('--packets', '20')
+                assert result.returncode == 0, result.stdout
+                assert '20 packets' in result.stdout
+    finally:
+        receiver.terminate()
+        receiver.wait()
@@ -1,57 +1,144 @@
 import socket
 import random
+import argparse
+import hashlib
+import os
+import time
+from collections import deque
+from packet import MAX_DATAGRAM, DATA, ACK, META, FIN, FILE_SIZE, encode_header, decode, encode_sacks
 
 # Constants
 LOCAL_ADDRESS = ('localhost', 10000)
 PACKET_CORRUPTION_PROBABILITY = 0.1  # Probability to simulate packet corruption
+MAX_SACK_BLOCKS = 4  # Ranges of buffered out-of-order packets reported with each ACK
+RECEIVE_BUFFER = 256  # Out-of-order packets held at most; the free part is advertised as the window
+OUTPUT_PATH = 'received.bin'  # Where a file sent with udp_sender.py --file is written
+PAST_TRANSFERS = 64  # IDs of earlier transfers remembered, so their late packets don't restart one
+
+def log(*args):
+    print(*args)
+
+def quiet(*args):
+    pass
 
 class UDPReceiver:
-    def __init__(self):
+    def __init__(self, output_path=OUTPUT_PATH):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind(LOCAL_ADDRESS)
+        self.transfer_id = None  # Of the transfer being received; a packet with a new one starts over
+        self.past_transfers = deque(maxlen=PAST_TRANSFERS)
+        self.expected_seq_num = 0
+        self.buffer = {}  # seq -> (flags, payload) of packets received out of order
+        self.output_path = output_path
+        self.output = None  # File being received, from its META packet to its FIN
+        self.digest = None
+        self.started_at = None
+        # Every datagram is received into this one buffer and parsed in place
+        self.recv_buffer = bytearray(MAX_DATAGRAM)
+        self.recv_view = memoryview(self.recv_buffer)
+
+    def sack_ranges(self):
+        """The lowest MAX_SACK_BLOCKS runs of consecutive buffered sequence numbers, as (first, last) pairs."""
+        ranges = []
+        for seq_num in sorted(self.buffer):
+            if ranges and seq_num == ranges[-1][1] + 1:
+                ranges[-1][1] = seq_num
+            elif len(ranges) == MAX_SACK_BLOCKS:
+                break
+            else:
+                ranges.append([seq_num, seq_num])
+        return ranges
+
+    def start_transfer(self, transfer_id):
+        """Forgets the previous transfer, abandoning its file if unfinished; the new one starts from sequence number 0."""
+        if self.transfer_id is not None:
+            self.past_transfers.append(self.transfer_id)
+        self.transfer_id = transfer_id
+        if self.output is not None:
+            print(f"Abandoning the unfinished file after {self.output.tell()} bytes")
+            self.output.close()
+            self.output = None
         self.expected_seq_num = 0
-        self.buffer = {}
+        self.buffer.clear()
+
+    def deliver(self, flags, payload):
+        """Takes the next packet in sequence; file data is written straight to the output file."""
+        if flags & META:
+            size, = FILE_SIZE.unpack(payload)
+            self.output = open(self.output_path, 'wb')
+            # Reserve the space up front, so the file is laid out in one go rather than grown write by write
+            if hasattr(os, 'posix_fallocate') and size:
+                os.posix_fallocate(self.output.fileno(), 0, size)
+            else:
+                self.output.truncate(size)
+            self.digest = hashlib.sha256()
+            self.started_at = time.monotonic()
+            print(f"Receiving a file of {size} bytes into {self.output_path}")
+        elif flags & FIN:
+            if self.output is None:
+                return
+            nbytes = self.output.tell()
+            self.output.close()
+            self.output = None
+            elapsed = time.monotonic() - self.started_at
+            verdict = "digest OK" if self.digest.digest() == bytes(payload) else "DIGEST MISMATCH"
+            print(f"Received {nbytes} bytes in {elapsed:.2f} s ({nbytes / elapsed / 1e6:.2f} MB/s): {verdict}")
+        elif self.output is not None:
+            self.output.write(payload)
+            self.digest.update(payload)
+
+    def send_ack(self, address):
+        """Sends the next expected sequence number, plus SACK ranges of what is buffered beyond it."""
+        ranges = self.sack_ranges()
+        sacks = encode_sacks(ranges)
+        header = encode_header(self.transfer_id, 0, self.expected_seq_num, ACK, RECEIVE_BUFFER - len(self.buffer), sacks)
+        self.sock.sendto(header + sacks, address)
+        log(f"Sent ACK: {self.expected_seq_num}" + (f" SACK: {ranges}" if ranges else ""))
 
     def run(self):
         print('Receiver is running...')
         while True:
             try:
-                data, address = self.sock.recvfrom(1024)
-                
-                # Simulate packet corruption
-                if random.random() < PACKET_CORRUPTION_PROBABILITY:
-                    print("Simulated corruption: Packet received is corrupted")
-                    continue  # Discard the packet
-                
-                # Decode and parse the packet
-                try:
-                    packet = data.decode()
-                    seq_num_str, message = packet.split(':', 1)
-                    seq_num = int(seq_num_str)
-                except (ValueError, IndexError):
-                    print("Malformed packet received. Ignoring.")
+                nbytes, address = self.sock.recvfrom_into(self.recv_buffer)
+
+                # Simulate corruption on the wire: flip one bit, which the checksum has to catch
+                if nbytes and random.random() < PACKET_CORRUPTION_PROBABILITY:
+                    self.recv_buffer[random.randrange(nbytes)] ^= 1 << random.randrange(8)
+
+                packet = decode(self.recv_view, nbytes)
+                if packet is None:
+                    log("Corrupted packet received (bad checksum or length). Ignoring.")
+                    continue
+                transfer_id, seq_num, _, flags, _, payload = packet
+                if not flags & DATA:
                     continue
-                
-                print(f"Received Packet: {seq_num} with message: {message}")
+                if transfer_id != self.transfer_id:
+                    if transfer_id in self.past_transfers:
+                        log(f"Packet {seq_num} belongs to an earlier transfer. Ignoring.")
+                        continue
+                    self.start_transfer(transfer_id)
+
+                log(f"Received Packet: {seq_num} with {len(payload)} bytes")
 
                 if seq_num == self.expected_seq_num:
-                    print(f"Packet {seq_num} is in order.")
+                    log(f"Packet {seq_num} is in order.")
+                    self.deliver(flags, payload)
                     self.expected_seq_num += 1
                     # Deliver any buffered packets
                     while self.expected_seq_num in self.buffer:
-                        print(f"Delivering buffered Packet {self.expected_seq_num}")
-                        del self.buffer[self.expected_seq_num]
+                        log(f"Delivering buffered Packet {self.expected_seq_num}")
+                        self.deliver(*self.buffer.pop(self.expected_seq_num))
                         self.expected_seq_num += 1
+                elif seq_num >= self.expected_seq_num + RECEIVE_BUFFER:
+                    log(f"Packet {seq_num} is beyond the receive window. Dropping it.")
                 elif seq_num > self.expected_seq_num:
-                    print(f"Packet {seq_num} is out of order. Buffering it.")
-                    self.buffer[seq_num] = message
+                    log(f"Packet {seq_num} is out of order. Buffering it.")
+                    # recv_buffer is reused for the next datagram, so the payload is copied out
+                    self.buffer[seq_num] = (flags, bytes(payload))
                 else:
-                    print(f"Packet {seq_num} is a duplicate. Ignoring.")
+                    log(f"Packet {seq_num} is a duplicate. Ignoring.")
 
-                # Send ACK for the last in-order packet
-                ack_packet = str(self.expected_seq_num - 1).encode()
-                self.sock.sendto(ack_packet, address)
-                print(f"Sent ACK: {self.expected_seq_num - 1}")
+                self.send_ack(address)
             except KeyboardInterrupt:
                 print("Receiver shutting down.")
                 break
@@ -59,5 +146,14 @@ class UDPReceiver:
                 print(f"Error occurred: {e}")
 
 if __name__ == '__main__':
-    receiver = UDPReceiver()
+    parser = argparse.ArgumentParser(description='Reliable receiver over UDP')
+    parser.add_argument('--output', default=OUTPUT_PATH, help='where a file sent with udp_sender.py --file is written')
+    parser.add_argument('--corruption', type=float, default=PACKET_CORRUPTION_PROBABILITY,
+                        help='probability of flipping a bit in each packet received')
+    parser.add_argument('--quiet', action='store_true', help='print only transfer summaries, not every packet')
+    args = parser.parse_args()
+    PACKET_CORRUPTION_PROBABILITY = args.corruption
+    if args.quiet:
+        log = quiet
+    receiver = UDPReceiver(args.output)
     receiver.run()
@@ -2,24 +2,96 @@ import socket
 import threading
 import random
 import time
+import argparse
+import hashlib
+import os
+from packet import MAX_DATAGRAM, MAX_PAYLOAD, DATA, ACK, META, FIN, FILE_SIZE, encode_header, decode, decode_sacks
+from congestion import FixedWindow, Reno
 
 # Constants
 SERVER_ADDRESS = ('localhost', 10000)
 LOSS_PROBABILITY = 0.1  # Probability to simulate packet loss
 TOTAL_PACKETS = 20
-TIMEOUT = 2  # Timeout in seconds
+MESSAGE = b'Hello Receiver!'
+INITIAL_RTO = 1.0  # Retransmission timeout in seconds until the first RTT sample (RFC 6298)
+MIN_RTO = 0.01  # Lower bound on the timeout; loopback RTTs are far below it
+MAX_RTO = 60.0  # Upper bound, however often the timeout backs off
+CLOCK_GRANULARITY = 0.001  # G in RFC 6298: the variance term never drops below it
+RTT_ALPHA = 1 / 8  # Gain of the smoothed RTT
+RTT_BETA = 1 / 4  # Gain of the RTT variation
+WINDOW_SIZE = 5  # Packets in flight at once with --cc fixed
+MAX_RECEIVE_WINDOW = 0xFFFF  # Assumed until the first ACK advertises the receiver's window
+PACING_GAIN = 2  # Paced sends spread a window over half a round trip, so pacing alone never caps throughput
+PACING_SLACK = 0.001  # Seconds of sends a late pacing timer may catch up on in one burst
+MODE = 'sr'  # 'sr' (Selective Repeat: only missing packets are resent) or 'gbn' (Go-Back-N)
+DUP_THRESH = 3  # Duplicate ACKs, or SACKed sequence numbers above a hole, that mark a packet as lost
+
+def log(*args):
+    print(*args)
+
+def quiet(*args):
+    pass
 
 class UDPSender:
-    def __init__(self):
+    """Sends TOTAL_PACKETS copies of MESSAGE or, given a `source` path, the contents of that file.
+
+    A file goes as a META packet with its size, then one packet per
+    MAX_PAYLOAD-byte segment, then a FIN packet with its SHA-256 digest.
+    Segments are read from the file when they are (re)sent, so only the
+    packets in flight are ever in memory.
+    """
+    def __init__(self, mode=MODE, source=None, controller=None, pacing=False):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.mode = mode
+        self.transfer_id = random.getrandbits(32)
+        self.cc = controller if controller is not None else Reno()
+        self.pacing = pacing
+        self.fd = None
+        self.total_packets = TOTAL_PACKETS
+        self.total_bytes = self.total_packets * len(MESSAGE)
+        if source is not None:
+            self.fd = os.open(source, os.O_RDONLY)
+            self.file_size = os.fstat(self.fd).st_size
+            self.segments = -(-self.file_size // MAX_PAYLOAD)
+            self.total_packets = self.segments + 2
+            self.total_bytes = self.file_size
+            self.digest = hashlib.sha256()  # Fed each segment as it is first sent, which is in order
         self.base = 0
         self.next_seq_num = 0
-        self.lock = threading.Lock()
+        self.highest_sent = -1
+        self.receive_window = MAX_RECEIVE_WINDOW  # Packets past base the receiver last said it has room for
+        self.recover = 0  # Losses below this sequence number belong to a window the controller already cut
+        self.next_send_at = 0.0  # Pacing: earliest time of the next new packet
+        self.pace_timer = None
+        # Re-entrant: ACK and timeout handlers send more packets while holding it
+        self.lock = threading.RLock()
         self.timer = None
+        self.done = threading.Event()  # Set once every packet is acknowledged
+        self.deadlines = {}  # Selective Repeat: seq -> retransmission deadline of each unacknowledged packet
+        self.sent_at = {}  # seq -> time of the last transmission, until the packet is acknowledged
+        self.retransmitted = set()  # Sent more than once, so an ACK for it gives no RTT sample (Karn's rule)
+        self.fast_resent = set()  # Resent on duplicate ACKs or SACK holes; not resent that way again
+        self.highest_sacked = -1
+        self.dup_acks = 0
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.transmissions = 0
+        self.retransmissions = 0
+        self.timeouts = 0
+        self.corrupted = 0
+        # ACKs are received into this one buffer and parsed in place
+        self.recv_buffer = bytearray(MAX_DATAGRAM)
+        self.recv_view = memoryview(self.recv_buffer)
 
     def start_timer(self):
         if self.timer is None:
-            self.timer = threading.Timer(TIMEOUT, self.timeout_handler)
+            delay = self.rto
+            if self.deadlines:
+                # One timer serves every packet: it fires at the earliest deadline
+                delay = max(min(self.deadlines.values()) - time.monotonic(), 0)
+            self.timer = threading.Timer(delay, self.timeout_handler)
+            self.timer.daemon = True
             self.timer.start()
 
     def stop_timer(self):
@@ -27,55 +99,258 @@ class UDPSender:
             self.timer.cancel()
             self.timer = None
 
+    def sample_rtt(self, rtt):
+        """Updates SRTT, RTTVAR and the retransmission timeout from one RTT measurement (RFC 6298)."""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+        self.rto = min(max(self.srtt + max(CLOCK_GRANULARITY, 4 * self.rttvar), MIN_RTO), MAX_RTO)
+
+    def back_off(self):
+        """Exponential backoff: the next RTT sample brings the timeout back to the estimate."""
+        self.timeouts += 1
+        self.rto = min(self.rto * 2, MAX_RTO)
+        self.cc.on_timeout(self.in_flight())
+        self.recover = self.next_seq_num
+
     def timeout_handler(self):
         with self.lock:
-            print(f"Timeout occurred. Resending packets from base: {self.base}")
             self.stop_timer()
+            if self.base >= self.total_packets:
+                return
+            if self.mode == 'gbn':
+                self.back_off()
+                log(f"Timeout occurred. Resending packets from base: {self.base} (RTO now {self.rto:.3f} s)")
+                self.retransmissions += self.next_seq_num - self.base
+                self.next_seq_num = self.base
+                self.send_packets()
+                return
+            now = time.monotonic()
+            expired = [seq_num for seq_num, deadline in sorted(self.deadlines.items()) if deadline <= now]
+            # The deadlines of one window's packets expire one after another: that is one timeout,
+            # and only a retransmission timing out as well backs off again
+            if any(seq_num >= self.recover or seq_num in self.retransmitted for seq_num in expired):
+                self.back_off()
+            for seq_num in expired:
+                log(f"Timeout occurred. Resending packet {seq_num} (RTO now {self.rto:.3f} s)")
+                self.resend(seq_num)
+            self.start_timer()
+
+    def packet_payload(self, seq_num, first_send):
+        """Returns (flags, payload) of a sequence number."""
+        if self.fd is None:
+            return DATA, MESSAGE
+        if seq_num == 0:
+            return DATA | META, FILE_SIZE.pack(self.file_size)
+        if seq_num > self.segments:
+            return DATA | FIN, self.digest.digest()
+        segment = os.pread(self.fd, MAX_PAYLOAD, (seq_num - 1) * MAX_PAYLOAD)
+        if first_send:
+            self.digest.update(segment)
+        return DATA, segment
+
+    def send_packet(self, seq_num):
+        self.transmissions += 1
+        first_send = seq_num > self.highest_sent
+        if not first_send:
+            self.retransmitted.add(seq_num)
+        self.highest_sent = max(self.highest_sent, seq_num)
+        flags, payload = self.packet_payload(seq_num, first_send)
+        now = time.monotonic()
+        self.sent_at[seq_num] = now
+        if self.mode == 'sr':
+            self.deadlines[seq_num] = now + self.rto
+        if random.random() > LOSS_PROBABILITY:  # Simulate packet loss
+            # Header and payload go out as one datagram without being joined first
+            self.sock.sendmsg([encode_header(self.transfer_id, seq_num, 0, flags, 0, payload), payload], [], 0, SERVER_ADDRESS)
+            log(f"Sent: Packet {seq_num}")
+        else:
+            log(f"Simulated loss: Packet {seq_num} not sent")
+
+    def resend(self, seq_num):
+        self.retransmissions += 1
+        self.send_packet(seq_num)
+
+    def in_flight(self):
+        """Packets sent and not acknowledged yet; in Selective Repeat, SACKed packets no longer count."""
+        if self.mode == 'gbn':
+            return self.next_seq_num - self.base
+        return len(self.sent_at)
+
+    def can_send(self):
+        if self.next_seq_num >= self.total_packets:
+            return False
+        # Flow control; a zero window still lets one packet through to probe it
+        if self.next_seq_num >= self.base + max(self.receive_window, 1):
+            return False
+        return self.in_flight() < self.cc.window()
+
+    def pace(self):
+        """Returns whether a new packet may go now; if not, arranges for send_packets() to run when it may."""
+        if not self.pacing or self.srtt is None:
+            return True
+        now = time.monotonic()
+        if now < self.next_send_at:
+            if self.pace_timer is None:
+                self.pace_timer = threading.Timer(self.next_send_at - now, self.pace_handler)
+                self.pace_timer.daemon = True
+                self.pace_timer.start()
+            return False
+        interval = self.srtt / (self.cc.window() * PACING_GAIN)
+        self.next_send_at = max(self.next_send_at, now - PACING_SLACK) + interval
+        return True
+
+    def pace_handler(self):
+        with self.lock:
+            self.pace_timer = None
             self.send_packets()
 
     def send_packets(self):
+        """Sends new packets while the congestion window, the receiver's window and pacing allow."""
         with self.lock:
-            while self.next_seq_num < self.base + 5 and self.next_seq_num < TOTAL_PACKETS:  # Window size = 5
-                message = f"{self.next_seq_num}:Hello Receiver!"
-                if random.random() > LOSS_PROBABILITY:  # Simulate packet loss
-                    self.sock.sendto(message.encode(), SERVER_ADDRESS)
-                    print(f"Sent: {message}")
-                else:
-                    print(f"Simulated loss: Packet {self.next_seq_num} not sent")
-                if self.base == self.next_seq_num:
-                    self.start_timer()
+            while self.can_send() and self.pace():
+                self.send_packet(self.next_seq_num)
                 self.next_seq_num += 1
+            if self.base < self.next_seq_num:
+                self.start_timer()
+
+    def congestion_signal(self, seq_num):
+        """Tells the controller about a lost packet, once per window of data, like NewReno's recovery point."""
+        if seq_num >= self.recover:
+            self.cc.on_loss(self.in_flight())
+            self.recover = self.next_seq_num
+
+    def acknowledge(self, seq_num):
+        """Forgets a packet the receiver has; returns when it was last sent, or None if it was already acknowledged."""
+        self.deadlines.pop(seq_num, None)
+        self.fast_resent.discard(seq_num)
+        sent_at = self.sent_at.pop(seq_num, None)
+        if sent_at is not None and seq_num in self.retransmitted:
+            self.retransmitted.discard(seq_num)
+            return None  # Karn's rule: no way to tell which transmission this ACK is for
+        return sent_at
+
+    def handle_ack(self, ack_num, window, sack_ranges):
+        """Slides the window up to the cumulative ACK (the next sequence number the receiver expects),
+        samples the RTT, feeds the congestion controller and resends packets shown to be lost.
+
+        In Selective Repeat, SACKed packets stop being resent.
+        """
+        now = time.monotonic()
+        unacknowledged = len(self.sent_at)
+        newest = None  # (seq, send time) of the highest packet newly acknowledged by this ACK
+        acked = [range(self.base, ack_num)]
+        acked += [range(max(first, self.base), last + 1) for first, last in sack_ranges]
+        for seq_range in acked:
+            for seq_num in seq_range:
+                sent_at = self.acknowledge(seq_num)
+                if sent_at is not None and (newest is None or seq_num > newest[0]):
+                    newest = (seq_num, sent_at)
+        if newest is not None:
+            # Normally one packet is new per ACK: the one whose arrival triggered it
+            self.sample_rtt(now - newest[1])
+        acked = unacknowledged - len(self.sent_at)
+        if acked:
+            self.cc.on_ack(acked)
+        self.receive_window = window
+
+        if ack_num > self.base:
+            self.base = ack_num
+            self.dup_acks = 0
+            self.stop_timer()
+        elif ack_num == self.base:
+            self.dup_acks += 1
+            if self.dup_acks == DUP_THRESH and self.base < self.next_seq_num and self.base not in self.fast_resent:
+                # Fast retransmit: the receiver keeps getting packets but not the one it waits for
+                log(f"{DUP_THRESH} duplicate ACKs. Resending packet {self.base}")
+                self.congestion_signal(self.base)
+                self.fast_resent.add(self.base)
+                self.resend(self.base)
+
+        if self.mode == 'sr':
+            for first, last in sack_ranges:
+                self.highest_sacked = max(self.highest_sacked, last)
+            # Holes the receiver reported well below what it already has are lost: resend them now, not at their timeout
+            for seq_num in sorted(self.deadlines):
+                if seq_num + DUP_THRESH > self.highest_sacked:
+                    break
+                if seq_num not in self.fast_resent:
+                    log(f"SACK shows packet {seq_num} missing. Resending it")
+                    self.congestion_signal(seq_num)
+                    self.fast_resent.add(seq_num)
+                    self.resend(seq_num)
+        if self.base < self.total_packets:
+            self.send_packets()
 
     def receive_acks(self):
         while True:
             try:
-                self.sock.settimeout(TIMEOUT)
-                data, _ = self.sock.recvfrom(1024)
-                ack_num = int(data.decode())
-                print(f"Received ACK: {ack_num}")
-                
+                self.sock.settimeout(MAX_RTO)
+                nbytes, _ = self.sock.recvfrom_into(self.recv_buffer)
+                packet = decode(self.recv_view, nbytes)
+                if packet is None:
+                    self.corrupted += 1
+                    log("Corrupted ACK received. Ignoring.")
+                    continue
+                transfer_id, _, ack_num, flags, window, payload = packet
+                if not flags & ACK:
+                    continue
+                if transfer_id != self.transfer_id:
+                    log(f"ACK {ack_num} belongs to another transfer. Ignoring.")
+                    continue
+                sack_ranges = decode_sacks(payload)
+                log(f"Received ACK: {ack_num}" + (f" SACK: {sack_ranges}" if sack_ranges else ""))
+
                 with self.lock:
-                    if ack_num >= self.base:
-                        self.base = ack_num + 1
+                    self.handle_ack(ack_num, window, sack_ranges)
+                    if self.base == self.total_packets:
                         self.stop_timer()
-                        if self.base < TOTAL_PACKETS:
-                            self.send_packets()
-                        if self.base == TOTAL_PACKETS:
-                            print("All packets acknowledged.")
-                            break
+                        log("All packets acknowledged.")
+                        self.done.set()
+                        break
             except socket.timeout:
-                self.timeout_handler()
+                continue  # Retransmissions are driven by the timer
             except Exception as e:
-                print(f"Error while receiving ACK: {e}")
+                log(f"Error while receiving ACK: {e}")
 
     def run(self):
+        start = time.monotonic()
         threading.Thread(target=self.receive_acks, daemon=True).start()
         self.send_packets()
-        while self.base < TOTAL_PACKETS:
-            time.sleep(0.1)
+        self.done.wait()
+        elapsed = time.monotonic() - start
         self.sock.close()
+        if self.fd is not None:
+            os.close(self.fd)
         print("Sender completed transmission.")
+        print(f"{self.total_packets} packets, {self.total_bytes} bytes in {elapsed:.2f} s "
+              f"({self.total_bytes / elapsed / 1e6:.2f} MB/s), "
+              f"{self.transmissions} transmissions, {self.retransmissions} retransmissions, {self.timeouts} timeouts, "
+              f"SRTT {(self.srtt or 0) * 1000:.3f} ms, RTO {self.rto * 1000:.1f} ms, cwnd {self.cc.window()}")
 
 if __name__ == '__main__':
-    sender = UDPSender()
+    parser = argparse.ArgumentParser(description='Reliable sender over UDP')
+    parser.add_argument('--mode', choices=['sr', 'gbn'], default=MODE,
+                        help="'sr' resends only the packets the receiver is missing, 'gbn' resends the whole window")
+    parser.add_argument('--packets', type=int, default=TOTAL_PACKETS, help='packets to send')
+    parser.add_argument('--cc', choices=['reno', 'fixed'], default='reno',
+                        help="congestion control: 'reno' adapts the window to losses, 'fixed' keeps --window packets in flight")
+    parser.add_argument('--window', type=int, default=WINDOW_SIZE, help='packets in flight at once with --cc fixed')
+    parser.add_argument('--pacing', action='store_true', help='spread packets over each round trip instead of sending bursts')
+    parser.add_argument('--loss', type=float, default=LOSS_PROBABILITY, help='probability of dropping each packet sent')
+    parser.add_argument('--file', help='send this file instead of --packets greetings')
+    parser.add_argument('--quiet', action='store_true', help='print only the summary, not every packet')
+    parser.add_argument('--min-rto', type=float, default=MIN_RTO, help='lower bound on the retransmission timeout in seconds')
+    args = parser.parse_args()
+    TOTAL_PACKETS = args.packets
+    WINDOW_SIZE = args.window
+    LOSS_PROBABILITY = args.loss
+    MIN_RTO = args.min_rto
+    if args.quiet:
+        log = quiet
+    controller = FixedWindow(args.window) if args.cc == 'fixed' else Reno()
+    sender = UDPSender(args.mode, args.file, controller, args.pacing)
     sender.run()